@@ -0,0 +1,273 @@
+# Renders a camera path through a scene to an image sequence, e.g.
+#   python BatchRender.py scene.json path.json -o renders/frame_%05d.png --fps 30 --renderer cpu
+# Frame i is rendered at time i / fps whatever the frame takes, so a run always produces the same images.
+# Frames already on disk are skipped, so an interrupted run carries on where it stopped.
+# Without a display set PYOPENGL_PLATFORM=egl (and EGL_PLATFORM=surfaceless on Mesa) for the GL renderers
+#
+# scene.json: {"ambientLight": 0.1,
+#              "lights": [{"position": [0, 5, -5], "colour": [1, 1, 1], "attenuation": [0.2, 0.2, 0.2]}],
+#              "entities": [{"type": "Ellipsoid", "position": [0, 0, -5], "radius": [1, 1, 1], "colour": [...]},
+#                           {"type": "Tree", "position": [0, 0, -10], "rotation": [0, 0, 0], "scale": [1, 1, 1]}]}
+# path.json:  [{"time": 0, "position": [0, 0, 0], "yaw": -90, "pitch": 0}, {"time": 4, ...}, ...]
+#
+# The ray tracers are orthographic and look down -z, they follow the path's position but not its yaw and pitch
+
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+from types import SimpleNamespace
+
+import numpy as np
+
+RENDERERS = ("raster", "gpu", "cpu")
+# extensions kept as floats, the ray tracers write their RGBA32F output without clamping
+FLOAT_EXTENSIONS = (".npy", ".exr", ".raw")
+
+
+def loadSceneDescription(filepath):
+    with open(filepath) as file:
+        description = json.load(file)
+    description.setdefault("ambientLight", 0.1)
+    description.setdefault("lights", [])
+    description.setdefault("entities", [])
+    return description
+
+
+def createLights(description):
+    from core.RenderEngine import Light
+    return [Light(np.array(light["position"], dtype=np.float32), light.get("colour", [1, 1, 1]),
+                  np.array(light.get("attenuation", [1, 0, 0]), dtype=np.float32))
+            for light in description["lights"]]
+
+
+def createEntities(description):
+    # real entities for the rasterizer, needs a GL context
+    from entities import Entities
+    entities = []
+    for entry in description["entities"]:
+        entity = getattr(Entities, entry["type"])()
+        for name, value in entry.items():
+            if name != "type":
+                setattr(entity, name, value)
+        entities.append(entity)
+    return entities
+
+
+def createTraceScene(description):
+    # The packed ray tracing scene straight from the description, without creating any GL resources. Only
+    # ellipsoids are traced, like Scene.fromEntities
+    from entities.Entities import Ellipsoid
+    from raytracing.Scene import Scene
+    ellipsoids = []
+    for entry in description["entities"]:
+        if entry["type"] != "Ellipsoid":
+            continue
+        ellipsoids.append(SimpleNamespace(
+            position=entry.get("position", [0, 0, 0]),
+            radius=entry.get("radius", entry.get("scale", [1, 1, 1])),
+            colour=entry.get("colour", Ellipsoid.colour),
+            specular=entry.get("specular", Ellipsoid.specular),
+            shininess=entry.get("shininess", Ellipsoid.shininess),
+            lit=entry.get("lit", True)))
+    return Scene.fromEntities(ellipsoids, createLights(description), description["ambientLight"])
+
+
+def getFramePaths(pattern, frames):
+    return [pattern % frame for frame in range(frames)]
+
+
+def makeDirectories(paths):
+    for directory in {os.path.dirname(path) for path in paths}:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+
+def renderRaster(args, description, path, framePaths, todo):
+    from OpenGL.GL import glClear, glClearColor, GL_COLOR_BUFFER_BIT, GL_DEPTH_BUFFER_BIT
+    from core import DisplayManager, RenderEngine
+    from core.Camera import Camera
+
+    window = DisplayManager.Window(headless=True, width=args.width, height=args.height)
+    window.startCapture(args.output)
+    camera = Camera()
+    masterRenderer = RenderEngine.MasterRenderer()
+    masterRenderer.registerEntities(createEntities(description))
+    lights = createLights(description)
+    glClearColor(*args.clear_colour)
+
+    frameTimes = []
+    todo = set(todo)
+    for frame in range(len(framePaths)):
+        path.apply(camera, frame / args.fps)
+        if frame not in todo:
+            # level of detail has hysteresis, so it has to see every frame for a resumed run to match
+            masterRenderer.lodSystem.update(camera.position)
+            continue
+        start = time.perf_counter()
+        window.startFrame()
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        masterRenderer.renderScene(camera, lights)
+        window.frameIndex = frame
+        window.updateDisplay()
+        frameTimes.append((frame, time.perf_counter() - start))
+
+    errors = window.frameCapture.writer.errors
+    window.cleanUp()
+    return frameTimes, errors
+
+
+def renderGPU(args, description, path, framePaths, todo):
+    from OpenGL.GL import glClear, GL_COLOR_BUFFER_BIT
+    from core import DisplayManager
+    from core.Camera import Camera
+    from core.Offscreen import FrameCapture
+    from raytracing.RayTracer import RayTracer
+
+    window = DisplayManager.Window(headless=True, width=args.width, height=args.height)
+    floatingPoint = os.path.splitext(args.output)[1].lower() in FLOAT_EXTENSIONS
+    if floatingPoint:
+        # the RGBA32F output texture itself, rather than the 8 bit quad it is drawn to
+        frameCapture = FrameCapture(args.width, args.height, floatingPoint=True)
+    else:
+        window.startCapture(args.output)
+        frameCapture = window.frameCapture
+    camera = Camera()
+    rayTracer = RayTracer(args.width, args.height, progressive=args.samples > 1, maxSamples=args.samples,
+                          scene=createTraceScene(description))
+
+    frameTimes = []
+    for frame in todo:
+        path.apply(camera, frame / args.fps)
+        start = time.perf_counter()
+        window.startFrame()
+        glClear(GL_COLOR_BUFFER_BIT)
+        rayTracer.scene.setCamera(camera.position)
+        for _ in range(args.samples - 1):
+            rayTracer.trace()
+        rayTracer.render(camera)
+        if floatingPoint:
+            frameCapture.captureTexture(rayTracer.texOutput, framePaths[frame])
+        window.frameIndex = frame
+        window.updateDisplay()
+        frameTimes.append((frame, time.perf_counter() - start))
+
+    errors = frameCapture.writer.errors
+    if floatingPoint:
+        frameCapture.delete()
+    window.cleanUp()
+    return frameTimes, errors
+
+
+# Per-process state for the CPU frame workers, set up once by initFrameWorker
+frameTracer = None
+
+
+def initFrameWorker(texWidth, texHeight, scene):
+    global frameTracer
+    from raytracing.CPURayTracer import CPURayTracer
+    frameTracer = CPURayTracer(texWidth, texHeight, scene=scene)
+
+
+def renderFrameWorker(task):
+    # Traces and writes one whole frame. Frames are independent, so every process works on its own frame
+    # instead of sharing tiles of one
+    from core.Offscreen import writeImage
+    from raytracing.CPURayTracer import sampleJitter
+    frame, cameraPos, filepath, samples = task
+    start = time.perf_counter()
+    frameTracer.scene.setCamera(cameraPos)
+    for sample in range(samples):
+        jitter = sampleJitter(sample) if samples > 1 else (0.0, 0.0)
+        frameTracer.render(jitter, sample)
+    # the framebuffer's row 0 is the bottom one
+    writeImage(filepath, frameTracer.framebuffer[::-1])
+    return frame, time.perf_counter() - start
+
+
+def renderCPU(args, description, path, framePaths, todo):
+    positions = path.sample(np.array(todo, dtype=np.float64) / args.fps)[0].astype(np.float32)
+    scene = createTraceScene(description)
+    tasks = [(frame, position, framePaths[frame], args.samples) for frame, position in zip(todo, positions)]
+
+    frameTimes = []
+    errors = []
+    if args.processes == 1:
+        initFrameWorker(args.width, args.height, scene)
+        frameTimes = [renderFrameWorker(task) for task in tasks]
+    else:
+        with Pool(args.processes, initializer=initFrameWorker, initargs=(args.width, args.height, scene)) as pool:
+            frameTimes = list(pool.imap_unordered(renderFrameWorker, tasks))
+    return sorted(frameTimes), errors
+
+
+def summarise(frameTimes, skipped, wallTime, workers):
+    times = np.array([seconds for _, seconds in frameTimes], dtype=np.float64) * 1000
+    summary = {"frames": len(times), "skipped": skipped, "seconds": wallTime, "workers": workers,
+               "fps": len(times) / wallTime if wallTime > 0 else 0.0,
+               "frameTimes": {str(frame): seconds * 1000 for frame, seconds in frameTimes}}
+    print("rendered %d frames (%d already done) in %.2f s, %.2f fps" % (len(times), skipped, wallTime, summary["fps"]))
+    if len(times):
+        p50, p95 = np.percentile(times, (50, 95))
+        summary.update({"mean": float(times.mean()), "p50": float(p50), "p95": float(p95), "max": float(times.max())})
+        # with several processes the per frame times overlap, so they add up to more than the wall time
+        print("per frame %.2f ms (p50 %.2f p95 %.2f max %.2f)" % (summary["mean"], p50, p95, summary["max"]))
+    return summary
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Render a camera path through a scene to an image sequence")
+    parser.add_argument("scene", help="scene description (JSON)")
+    parser.add_argument("path", help="camera path keyframes (JSON)")
+    parser.add_argument("-o", "--output", default="renders/frame_%05d.png",
+                        help="output pattern, %%d is the frame number, the extension picks the format")
+    parser.add_argument("--renderer", choices=RENDERERS, default="cpu",
+                        help="raster (rasterizer), gpu (compute shader ray tracer) or cpu (NumPy ray tracer)")
+    parser.add_argument("--fps", type=float, default=30.0, help="fixed timestep of the camera path")
+    parser.add_argument("--frames", type=int, default=None, help="frame count, defaults to the whole path")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--samples", type=int, default=1, help="jittered ray tracing samples averaged per pixel")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="frames traced at once by the cpu renderer, defaults to every core")
+    parser.add_argument("--clear-colour", type=float, nargs=4, default=(0.0, 0.0, 0.0, 1.0))
+    parser.add_argument("--overwrite", action="store_true", help="render every frame, even ones already on disk")
+    parser.add_argument("--summary", default=None, help="also write the timing summary to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArguments()
+    if args.samples < 1:
+        raise SystemExit("--samples must be at least 1")
+    args.processes = args.processes or os.cpu_count()
+
+    from core.CameraPath import CameraPath
+    description = loadSceneDescription(args.scene)
+    path = CameraPath.fromFile(args.path)
+
+    frames = args.frames
+    if frames is None:
+        frames = int(round(path.getDuration() * args.fps)) + 1
+    framePaths = getFramePaths(args.output, frames)
+    makeDirectories(framePaths)
+    todo = [frame for frame in range(frames) if args.overwrite or not os.path.exists(framePaths[frame])]
+
+    renderer = {"raster": renderRaster, "gpu": renderGPU, "cpu": renderCPU}[args.renderer]
+    start = time.perf_counter()
+    frameTimes, errors = renderer(args, description, path, framePaths, todo) if todo else ([], [])
+    wallTime = time.perf_counter() - start
+
+    for filepath, error in errors:
+        print("could not write %s: %s" % (filepath, error))
+    workers = args.processes if args.renderer == "cpu" else 1
+    summary = summarise(frameTimes, frames - len(todo), wallTime, workers)
+    if args.summary is not None:
+        with open(args.summary, "w") as file:
+            json.dump(summary, file, indent=1)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
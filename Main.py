@@ -2,10 +2,14 @@ import glfw
 import pyrr
 from OpenGL.GL import *
 
-from core import Audio, GUI, DisplayManager, RenderEngine
+from core import Audio, GUI, DisplayManager, Loader, RenderEngine
+from core.Assets import getAssetManager, releasePlaceholderModels
 from core.Camera import Camera
+from core.GameLoop import GameLoop
+from core.Profiler import profiler, ProfilerOverlay
 from entities import Entities
 from raytracing.RayTracer import RayTracer
+from raytracing.Scene import Scene
 
 window = DisplayManager.Window()
 
@@ -13,14 +17,21 @@ cam = Camera(window)
 
 masterRenderer = RenderEngine.MasterRenderer()
 
+# models and textures load in the background, entities show a placeholder until theirs are ready
+assets = getAssetManager()
+
 entities = []
-ellipsoid = Entities.Ellipsoid()
+ellipsoid = Entities.Ellipsoid(assets=assets)
 entities.append(ellipsoid)
+ellipsoid.position = pyrr.Vector3([0, 0, -5])
 
-tree = Entities.Tree()
+tree = Entities.Tree(assets=assets)
 entities.append(tree)
 tree.position = pyrr.Vector3([0, 0, -10])
 
+# entities are queued once, renderScene() then draws whatever is registered
+masterRenderer.registerEntities(entities)
+
 # LIGHTING
 lights = []
 light1 = RenderEngine.Light(pyrr.Vector3([0, 5, -5]), [1, 1, 1], [0.2, 0.2, 0.2])
@@ -38,6 +49,12 @@ div1.addComponent(text)
 # div2.addComponent(text1)
 myGUI.addComponent(div1)
 
+# PROFILER overlay, F12 writes the frame history to profile.csv and profile.json
+profilerGUI = GUI.GUI()
+profilerOverlay = ProfilerOverlay(font)
+profilerGUI.addComponent(profilerOverlay)
+exportHeld = False
+
 # AUDIO
 audioContext = Audio.createContext()
 Audio.setListenerData(0, 0, 0)
@@ -45,20 +62,14 @@ buffer = Audio.loadSound("res/sounds/bounce.wav")
 source = Audio.Source()
 
 # RAY TRACING
-rayTracer = RayTracer(1024, 1024)
+rayTracer = RayTracer(1024, 1024, scene=Scene.fromEntities(entities, lights))
 
 # LOOP
-glClearColor(1.0, 0.0, 0.0, 1.0)
-while not window.shouldClose():
-    window.startFrame()
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-    cam.handleKeyboardInput()
-
-    # masterRenderer.renderScene(cam, entities, [], lights)
-    # masterRenderer.renderGUI(myGUI)
-
-    rayTracer.render()
+# the camera moves in fixed updates, rendering interpolates between the last two of them
+def update(timestep):
+    global exportHeld
+    cam.storePreviousState()
+    cam.handleKeyboardInput(timestep)
 
     if window.getKeyState(glfw.KEY_M) == glfw.PRESS:
         if not source.isPlaying():
@@ -67,13 +78,45 @@ while not window.shouldClose():
     if window.getKeyState(glfw.KEY_P) == glfw.PRESS:
         print(cam.position)
 
+    exportPressed = window.getKeyState(glfw.KEY_F12) == glfw.PRESS
+    if exportPressed and not exportHeld:
+        profiler.exportCSV("profile.csv")
+        profiler.exportJSON("profile.json")
+    exportHeld = exportPressed
+
     if window.getKeyState(glfw.KEY_ESCAPE) == glfw.PRESS:
         window.setCursorLock(False)
 
-    window.updateDisplay()
 
-# renderEngine.cleanUp() TODO: reminder to fix this
+def render(alpha):
+    # GL uploads of finished assets, a few milliseconds' worth per frame
+    assets.update()
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    with cam.interpolated(alpha):
+        # masterRenderer.renderScene(cam, lights)
+        # masterRenderer.renderGUI(myGUI)
+
+        rayTracer.updateScene(entities, lights)
+        rayTracer.render(cam)
+
+    profilerOverlay.update()
+    masterRenderer.renderGUI(profilerGUI)
+
+
+glClearColor(1.0, 0.0, 0.0, 1.0)
+gameLoop = GameLoop(window, update, render)
+gameLoop.run()
+
+# GL objects go before the context, anything not released by its owner is reported as a leak
+assets.shutdown()
+masterRenderer.cleanUp()
+rayTracer.cleanUp()
+font.delete()
+profiler.deleteGPUTimers()
+Entities.releaseSharedModels()
+releasePlaceholderModels()
+Loader.cleanUp()
 source.delete()
 Audio.cleanUp(audioContext)
-glfw.terminate()
+window.cleanUp()
 exit(0)
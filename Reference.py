@@ -4,5 +4,14 @@ WINDOW_WIDTH = 900
 WINDOW_HEIGHT = 900
 CAMERA_FOV = 90
 
+# game loop, see core/GameLoop.py
+UPDATE_RATE = 120  # fixed simulation updates per second
+FRAME_CAP = None  # frames per second, None renders as fast as vsync allows
+VSYNC = True
+
+# vertex layout of loaded meshes, see core/VertexFormat.py: "float" (32 bytes) or "packed" (20 bytes, half float
+# texture coordinates and 10 bit normals, which can shift shading by one 8 bit level)
+VERTEX_FORMAT = "float"
+
 global deltaTime
 deltaTime = 0
@@ -0,0 +1,250 @@
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from core.Loader import DecodedImage, OBJModel, TextureAtlas, TexturedModel, cachedObjects, cachedTextures, \
+    decodeImage, loadTextureLevels
+from core.Profiler import profiler
+
+
+class Asset:
+    # value is None until ready, then() callbacks run on the main thread
+
+    def __init__(self, key):
+        self.key = key
+        self.ready = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def then(self, callback):
+        if self.ready:
+            callback(self.value)
+        elif self.error is None:
+            self.callbacks.append(callback)
+        return self
+
+    def resolve(self, value):
+        self.value = value
+        self.ready = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(value)
+
+    def fail(self, error):
+        self.error = error
+        self.callbacks = []
+
+
+def loadMesh(filepath, indexed=False):
+    # module level so process pools can pickle it
+    return OBJModel(filepath, indexed)
+
+
+class AssetManager:
+    # Loads assets on a thread pool (or a process pool, whose functions and results must pickle). update()
+    # uploads finished ones on the GL thread within uploadBudget seconds a frame
+
+    def __init__(self, workers=None, processes=False, uploadBudget=0.004):
+        self.executor = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers)
+        self.uploadBudget = uploadBudget
+        self.assets = {}  # key -> Asset
+        self.completed = queue.Queue()  # (asset, upload, result, error) from the pool's callbacks
+        self.pending = 0
+        self.uploaded = 0
+        self.errors = []  # (key, error)
+
+    def load(self, key, function, *args, upload=None):
+        # function(*args) runs on the pool, then upload(result) on the GL thread
+        if key in self.assets:
+            return self.assets[key]
+        asset = Asset(key)
+        self.assets[key] = asset
+        self.pending += 1
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda done: self.completed.put(
+            (asset, upload, None if done.exception() else done.result(), done.exception())))
+        return asset
+
+    def ready(self, key, value):
+        if key not in self.assets:
+            asset = Asset(key)
+            asset.resolve(value)
+            self.assets[key] = asset
+        return self.assets[key]
+
+    def combine(self, key, assets, build):
+        # build(*values) runs once all the assets are ready
+        if key in self.assets:
+            return self.assets[key]
+        combined = Asset(key)
+        self.assets[key] = combined
+        values = [None] * len(assets)
+        waiting = [len(assets)]
+
+        def onReady(index, value):
+            values[index] = value
+            waiting[0] -= 1
+            if waiting[0] == 0:
+                combined.resolve(build(*values))
+
+        for index, asset in enumerate(assets):
+            asset.then(lambda value, index=index: onReady(index, value))
+        return combined
+
+    def loadOBJ(self, filepath, indexed=False):
+        key = (filepath, indexed)
+        if key in cachedObjects:
+            return self.ready(("mesh",) + key, cachedObjects[key])
+
+        def upload(model):
+            cachedObjects[key] = model
+            return model
+        return self.load(("mesh",) + key, loadMesh, filepath, indexed, upload=upload)
+
+    def loadRawModel(self, filepath, indexed=False):
+        return self.combine(("rawModel", filepath, indexed), [self.loadOBJ(filepath, indexed)],
+                            lambda model: model.createRawModel())
+
+    def loadTexture(self, filepath, nTextures=1, flipped=True, compression=None):
+        if filepath in cachedTextures:
+            return self.ready(("texture", filepath), cachedTextures[filepath])
+
+        def upload(levels):
+            texture = TextureAtlas(filepath, nTextures, flipped, levels=levels)
+            cachedTextures[filepath] = texture
+            return texture
+        return self.load(("texture", filepath), loadTextureLevels, filepath, flipped, compression, upload=upload)
+
+    def forget(self, *keys):
+        # drops finished assets so asking again loads them again
+        for key in keys:
+            asset = self.assets.get(key)
+            if asset is not None and (asset.ready or asset.error is not None):
+                del self.assets[key]
+
+    def finishOne(self, asset, upload, result, error):
+        self.pending -= 1
+        if error is None and upload is not None:
+            try:
+                result = upload(result)
+            except Exception as uploadError:
+                error = uploadError
+        if error is not None:
+            asset.fail(error)
+            self.errors.append((asset.key, error))
+            print("Could not load %s: %s" % (asset.key, error))
+            return
+        asset.resolve(result)
+        self.uploaded += 1
+
+    def update(self, budget=None):
+        # uploads finished assets for up to budget seconds, at least one. Returns how many
+        budget = self.uploadBudget if budget is None else budget
+        finished = 0
+        with profiler.scope("assets"):
+            start = time.perf_counter()
+            while finished == 0 or time.perf_counter() - start < budget:
+                try:
+                    item = self.completed.get_nowait()
+                except queue.Empty:
+                    break
+                self.finishOne(*item)
+                finished += 1
+        return finished
+
+    def waitFor(self, assets=None):
+        assets = list(self.assets.values()) if assets is None else assets
+        while any(not asset.ready and asset.error is None for asset in assets):
+            if self.pending == 0:
+                # only combined assets left, one of their parts failed
+                break
+            self.finishOne(*self.completed.get())
+
+    def isLoading(self):
+        return self.pending > 0 or not self.completed.empty()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+assetManager = None
+
+
+def getAssetManager():
+    global assetManager
+    if assetManager is None:
+        assetManager = AssetManager()
+    return assetManager
+
+
+# stand-ins drawn while an entity's assets load: a unit cube with a grey 1x1 texture
+placeholderModels = {}
+
+CUBE_CORNERS = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=np.float32)
+CUBE_FACES = np.array([
+    [0, 1, 3, 2], [4, 6, 7, 5],  # -x, +x
+    [0, 4, 5, 1], [2, 3, 7, 6],  # -y, +y
+    [0, 2, 6, 4], [1, 5, 7, 3],  # -z, +z
+])
+
+
+def createCubeMesh():
+    # 24 vertices so every face gets its own flat normal
+    normals = np.repeat(np.array([[-1, 0, 0], [1, 0, 0], [0, -1, 0], [0, 1, 0], [0, 0, -1], [0, 0, 1]],
+                                 dtype=np.float32), 4, axis=0)
+    textureCoords = np.tile(np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32), (6, 1))
+    quads = np.arange(24, dtype=np.uint32).reshape(6, 4)
+    indices = np.concatenate((quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]), axis=1).reshape(-1)
+    return OBJModel.fromArrays(CUBE_CORNERS[CUBE_FACES.reshape(-1)], textureCoords, normals, indices)
+
+
+def getPlaceholderModel(textured=True):
+    if "untextured" not in placeholderModels:
+        placeholderModels["untextured"] = createCubeMesh().createRawModel()
+    if textured and "textured" not in placeholderModels:
+        grey = TextureAtlas(None, 1, image=DecodedImage(1, 1, bytes((128, 128, 128, 255))))
+        placeholderModels["textured"] = TexturedModel(placeholderModels["untextured"].retain(), grey)
+        grey.release()
+    return placeholderModels["textured" if textured else "untextured"]
+
+
+def releasePlaceholderModels():
+    for model in placeholderModels.values():
+        model.release()
+    placeholderModels.clear()
+
+
+def benchmarkLoading(meshPaths, texturePaths, workers=None):
+    # Time to load and upload every mesh and texture on this thread against the AssetManager, with the
+    # caches skipped
+    from core.Loader import meshCache
+    enabled = meshCache.enabled
+    meshCache.enabled = False
+
+    start = time.perf_counter()
+    loaded = [OBJModel(filepath, indexed=True).createRawModel() for filepath in meshPaths]
+    loaded += [TextureAtlas(None, 1, image=decodeImage(filepath)) for filepath in texturePaths]
+    sequential = time.perf_counter() - start
+    for value in loaded:
+        value.release()
+
+    manager = AssetManager(workers)
+    start = time.perf_counter()
+    assets = [manager.load(("benchmark", filepath), loadMesh, filepath, True,
+                           upload=lambda model: model.createRawModel()) for filepath in meshPaths]
+    assets += [manager.load(("benchmark", filepath), decodeImage, filepath,
+                            upload=lambda image: TextureAtlas(None, 1, image=image)) for filepath in texturePaths]
+    manager.waitFor(assets)
+    pooled = time.perf_counter() - start
+    manager.shutdown()
+    for asset in assets:
+        if asset.ready:
+            asset.value.release()
+
+    meshCache.enabled = enabled
+    print(f"{len(meshPaths)} meshes, {len(texturePaths)} textures: sequential {sequential * 1000:.1f} ms, "
+          f"asset manager {pooled * 1000:.1f} ms ({sequential / pooled:.1f}x)")
+    return sequential, pooled
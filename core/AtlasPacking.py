@@ -0,0 +1,192 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from core.Loader import DecodedImage, OBJModel, TextureAtlas, TextureLevels, TexturedModel, loadTextureLevels, \
+    textureCache, textureLevelArrays, textureLevelsFromArrays
+from core.TextureCompression import chooseCompression, encodeLevel, generateMipmaps
+
+# Where one packed image sits in its atlas, in texels, row 0 at the bottom like the flipped images
+AtlasRegion = namedtuple("AtlasRegion", ["x", "y", "width", "height"])
+
+
+class SkylinePacker:
+    # Bottom-left skyline packing, the filled area is kept as its top outline of (x, y, width) segments
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.skyline = [(0, 0, width)]
+
+    def findPosition(self, width, height):
+        # (segment index, x, y) of the best spot, None if it doesn't fit anywhere
+        best = None
+        bestKey = None
+        for index, (x, _, _) in enumerate(self.skyline):
+            if x + width > self.width:
+                break
+            # the rectangle rests on the highest segment it spans
+            y = 0
+            remaining = width
+            spanned = index
+            while remaining > 0:
+                _, segmentY, segmentWidth = self.skyline[spanned]
+                y = max(y, segmentY)
+                remaining -= segmentWidth
+                spanned += 1
+            if y + height > self.height:
+                continue
+            key = (y + height, spanned - index)
+            if bestKey is None or key < bestKey:
+                best = (index, x, y)
+                bestKey = key
+        return best
+
+    def insert(self, width, height):
+        # (x, y) of the placed rectangle, or None when the packer is full
+        position = self.findPosition(width, height)
+        if position is None:
+            return None
+        index, x, y = position
+
+        # a partly covered segment keeps its right hand part
+        newSkyline = self.skyline[:index] + [(x, y + height, width)]
+        right = x + width
+        for segmentX, segmentY, segmentWidth in self.skyline[index:]:
+            segmentRight = segmentX + segmentWidth
+            if segmentRight <= right:
+                continue
+            if segmentX < right:
+                newSkyline.append((right, segmentY, segmentRight - right))
+            else:
+                newSkyline.append((segmentX, segmentY, segmentWidth))
+
+        # neighbours at the same height merge back into one segment
+        self.skyline = []
+        for segment in newSkyline:
+            if self.skyline and self.skyline[-1][1] == segment[1]:
+                lastX, lastY, lastWidth = self.skyline[-1]
+                self.skyline[-1] = (lastX, lastY, lastWidth + segment[2])
+            else:
+                self.skyline.append(segment)
+        return x, y
+
+
+def packRectangles(sizes, maxSize=4096):
+    # (atlasWidth, atlasHeight, [(x, y)]) of the smallest power of two atlas the rectangles fit in
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    area = sum(width * height for width, height in sizes)
+    width = height = 1
+    while width * height < area or width < max(size[0] for size in sizes) or height < max(size[1] for size in sizes):
+        if width <= height:
+            width *= 2
+        else:
+            height *= 2
+
+    while width <= maxSize and height <= maxSize:
+        packer = SkylinePacker(width, height)
+        positions = [None] * len(sizes)
+        for i in order:
+            positions[i] = packer.insert(*sizes[i])
+            if positions[i] is None:
+                break
+        else:
+            return width, height, positions
+        if width <= height:
+            width *= 2
+        else:
+            height *= 2
+    raise ValueError("Images don't fit in a %dx%d atlas" % (maxSize, maxSize))
+
+
+def atlasVariant(images, padding, compression, mipmaps):
+    # cached under the first image, so the variant has to change with any of the others
+    parts = []
+    for name, filepath in images.items():
+        stat = os.stat(filepath)
+        parts.append("%s=%s:%d:%d" % (name, os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns))
+    return "atlas:%d:%s:%s:%s" % (padding, compression or "rgba8", "mipmaps" if mipmaps else "", "|".join(parts))
+
+
+def loadImageLevels(image, mipmaps):
+    # (height, width, 4) arrays
+    if isinstance(image, DecodedImage):
+        pixels = np.frombuffer(image.data, dtype=np.uint8).reshape(image.height, image.width, 4)
+        return generateMipmaps(pixels) if mipmaps else [pixels]
+    levels = loadTextureLevels(image, mipmaps=mipmaps)
+    return [np.asarray(data).reshape(height, width, 4) for (width, height), data in zip(levels.sizes, levels.data)]
+
+
+def buildAtlasLevels(images, padding=32, compression=None, mipmaps=True, maxSize=4096):
+    # {name: filepath or DecodedImage} -> (TextureLevels, {name: AtlasRegion}), runs on the loader pool.
+    # Slots are aligned to 2^(levels - 1) so every atlas level is built from each image's own mip, with an edge
+    # border that halves per level
+    names = list(images)
+    cached = all(isinstance(images[name], str) for name in names)
+    if cached:
+        variant = atlasVariant(images, padding, compression, mipmaps)
+        arrays = textureCache.load(images[names[0]], variant)
+        if arrays is not None:
+            regions = arrays["regions"].reshape(-1, 4)
+            return textureLevelsFromArrays(arrays), {name: AtlasRegion(*map(int, region))
+                                                    for name, region in zip(names, regions)}
+
+    chains = [loadImageLevels(images[name], mipmaps) for name in names]
+    smallest = min(min(chain[0].shape[:2]) for chain in chains)
+    alignment = 2 ** int(np.log2(max(min(2 * padding, smallest), 1))) if mipmaps else 1
+    levelCount = int(np.log2(alignment)) + 1
+    padding = alignment // 2 if mipmaps else padding
+
+    slots = [(-(-(chain[0].shape[1] + 2 * padding) // alignment), -(-(chain[0].shape[0] + 2 * padding) // alignment))
+             for chain in chains]
+    _, _, positions = packRectangles(slots, maxSize // alignment)
+    width = max(x + slotWidth for (x, _), (slotWidth, _) in zip(positions, slots)) * alignment
+    height = max(y + slotHeight for (_, y), (_, slotHeight) in zip(positions, slots)) * alignment
+
+    pixelLevels = []
+    for level in range(levelCount):
+        pixels = np.zeros((height >> level, width >> level, 4), dtype=np.uint8)
+        border = padding >> level
+        for chain, (x, y) in zip(chains, positions):
+            padded = np.pad(chain[level], ((border, border), (border, border), (0, 0)), mode="edge")
+            left, bottom = (x * alignment) >> level, (y * alignment) >> level
+            pixels[bottom:bottom + padded.shape[0], left:left + padded.shape[1]] = padded
+        pixelLevels.append(pixels)
+
+    compression = chooseCompression(pixelLevels[0], compression)
+    levels = TextureLevels(compression or "rgba8", [(pixels.shape[1], pixels.shape[0]) for pixels in pixelLevels],
+                           [encodeLevel(pixels, compression) for pixels in pixelLevels])
+    regions = {name: AtlasRegion(x * alignment + padding, y * alignment + padding, chain[0].shape[1],
+                                 chain[0].shape[0])
+               for name, chain, (x, y) in zip(names, chains, positions)}
+
+    if cached:
+        arrays = textureLevelArrays(levels)
+        arrays["regions"] = np.array([regions[name] for name in names], dtype=np.int32)
+        textureCache.store(images[names[0]], arrays, variant)
+    return levels, regions
+
+
+def buildTextureAtlas(images, padding=32, compression=None, mipmaps=True, maxSize=4096, anisotropy=16,
+                      built=None):
+    # built is the result of buildAtlasLevels() when it already ran
+    levels, regions = buildAtlasLevels(images, padding, compression, mipmaps, maxSize) if built is None else built
+    atlas = TextureAtlas(None, len(regions), levels=levels, anisotropy=anisotropy)
+    atlas.regions = regions
+    return atlas
+
+
+def remapTextureCoords(textureCoords, atlas, name):
+    # clamped to [0, 1] first, as the image's own GL_CLAMP_TO_EDGE would have done
+    region = atlas.regions[name]
+    textureCoords = np.clip(np.asarray(textureCoords, dtype=np.float32).reshape(-1, 2), 0, 1)
+    offset = np.array([region.x / atlas.width, region.y / atlas.height], dtype=np.float32)
+    scale = np.array([region.width / atlas.width, region.height / atlas.height], dtype=np.float32)
+    return (offset + textureCoords * scale).reshape(-1)
+
+
+def createAtlasModel(mesh, atlas, name):
+    textureCoords = remapTextureCoords(mesh.textureCoords, atlas, name)
+    remapped = OBJModel.fromArrays(mesh.vertices, textureCoords, mesh.normals, mesh.indices)
+    return TexturedModel(remapped.createRawModel(), atlas)
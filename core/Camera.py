@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from math import sin, cos, radians
 
 import glfw
@@ -15,7 +16,8 @@ class Camera:
 
     sensitivity = 0.05
 
-    def __init__(self, window):
+    def __init__(self, window=None):
+        # without a window (batch rendering) the camera is only moved by setting position, yaw and pitch
         self.position = pyrr.Vector3([0, 0, 0.1], dtype=np.float32)
         self.target = pyrr.Vector3([0, 0, 0], dtype=np.float32)
         self.cameraUp = pyrr.Vector3([0, 1, 0], dtype=np.float32)
@@ -26,13 +28,36 @@ class Camera:
             pyrr.vector3.cross(pyrr.Vector3([0, 1, 0], dtype=np.float32), self.direction))
         self.cameraUp = pyrr.vector3.normalize(pyrr.vector3.cross(self.direction, self.cameraRight))
         self.window = window
-        window.bindCursorMove(self.updateRotationWithCursor)
-        cpos = window.getCursorPos()
-        self.lastX = cpos[0]
-        self.lastY = cpos[1]
-
-    def handleKeyboardInput(self):
-        speed = self.cameraSpeed * Reference.deltaTime
+        self.lastX = 0
+        self.lastY = 0
+        if window is not None:
+            window.bindCursorMove(self.updateRotationWithCursor)
+            cpos = window.getCursorPos()
+            self.lastX = cpos[0]
+            self.lastY = cpos[1]
+        # position at the previous fixed update, see interpolated()
+        self.previousPosition = self.position.copy()
+
+    def storePreviousState(self):
+        # call at the start of every fixed update, before moving
+        self.previousPosition = self.position.copy()
+
+    @contextmanager
+    def interpolated(self, alpha):
+        # Positions the camera alpha of the way from the previous fixed update to the latest one while rendering,
+        # so movement stays smooth when frames and updates don't line up. The simulated position is put back after
+        simulated = self.position
+        self.position = self.previousPosition + (simulated - self.previousPosition) * np.float32(alpha)
+        try:
+            yield self
+        finally:
+            self.position = simulated
+
+    def handleKeyboardInput(self, deltaTime=None):
+        # deltaTime defaults to the last frame's duration, the GameLoop passes its fixed timestep
+        if deltaTime is None:
+            deltaTime = Reference.deltaTime
+        speed = self.cameraSpeed * deltaTime
 
         if self.window.getKeyState(glfw.KEY_W) == glfw.PRESS:
             self.position += speed * self.cameraFront
@@ -69,10 +94,12 @@ class Camera:
         self.yaw += deltaX
         self.pitch += deltaY
 
-        if self.pitch > 89:
-            self.pitch = 89
-        elif self.pitch < -89:
-            self.pitch = -89
+        self.setOrientation(self.yaw, self.pitch)
+
+    def setOrientation(self, yaw, pitch):
+        # degrees, pitch is clamped so the view never flips over
+        self.yaw = yaw
+        self.pitch = min(max(pitch, -89), 89)
 
         front = pyrr.Vector3([
             cos(radians(self.pitch)) * cos(radians(self.yaw)),
@@ -0,0 +1,39 @@
+import json
+
+import numpy as np
+
+
+class CameraPath:
+    # Keyframed camera motion, linearly interpolated. Yaw isn't wrapped, write 190 rather than -170 after 170
+
+    def __init__(self, keyframes):
+        if not keyframes:
+            raise ValueError("A camera path needs at least one keyframe")
+        keyframes = sorted(keyframes, key=lambda keyframe: keyframe["time"])
+        self.times = np.array([keyframe["time"] for keyframe in keyframes], dtype=np.float64)
+        self.positions = np.array([keyframe["position"] for keyframe in keyframes], dtype=np.float64)
+        self.yaws = np.array([keyframe.get("yaw", -90.0) for keyframe in keyframes], dtype=np.float64)
+        self.pitches = np.array([keyframe.get("pitch", 0.0) for keyframe in keyframes], dtype=np.float64)
+
+    @classmethod
+    def fromFile(cls, filepath):
+        # a JSON list of keyframes, or an object with a "keyframes" list
+        with open(filepath) as file:
+            data = json.load(file)
+        if isinstance(data, dict):
+            data = data["keyframes"]
+        return cls(data)
+
+    def getDuration(self):
+        return float(self.times[-1] - self.times[0])
+
+    def sample(self, times):
+        # (positions, yaws, pitches) at an array of times
+        times = np.asarray(times, dtype=np.float64) + self.times[0]
+        positions = np.stack([np.interp(times, self.times, self.positions[:, axis]) for axis in range(3)], axis=-1)
+        return positions, np.interp(times, self.times, self.yaws), np.interp(times, self.times, self.pitches)
+
+    def apply(self, camera, time):
+        positions, yaws, pitches = self.sample([time])
+        camera.position = positions[0].astype(np.float32)
+        camera.setOrientation(float(yaws[0]), float(pitches[0]))
@@ -0,0 +1,118 @@
+import numpy as np
+
+
+class Frustum:
+    # The six planes of the camera's view volume as (a, b, c, d) with a*x + b*y + c*z + d >= 0 inside,
+    # normalised so plugging in a point gives its signed distance
+
+    def __init__(self):
+        self.planes = np.zeros((6, 4), dtype=np.float32)
+
+    def update(self, projectionMatrix, viewMatrix):
+        # pyrr matrices use row vectors, clip = point * view * projection, so the planes are built from the
+        # columns of the combined matrix (Gribb & Hartmann)
+        columns = (np.asarray(viewMatrix, dtype=np.float64) @ np.asarray(projectionMatrix, dtype=np.float64)).T
+        planes = np.array([
+            columns[3] + columns[0],  # left
+            columns[3] - columns[0],  # right
+            columns[3] + columns[1],  # bottom
+            columns[3] - columns[1],  # top
+            columns[3] + columns[2],  # near
+            columns[3] - columns[2],  # far
+        ])
+        planes /= np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+        self.planes = planes.astype(np.float32)
+
+    def testSpheres(self, centres, radii):
+        # True for every sphere at least partly inside
+        distances = centres @ self.planes[:, :3].T + self.planes[:, 3]
+        return (distances >= -radii[:, None]).all(axis=1)
+
+    def classifyBoxes(self, mins, maxs):
+        # (outside, inside) masks for axis aligned boxes, boxes in neither straddle a plane
+        normals = self.planes[:, :3]
+        # the corner furthest along each plane normal, and the one furthest against it
+        positive = np.where(normals >= 0, maxs[:, None, :], mins[:, None, :])
+        negative = np.where(normals >= 0, mins[:, None, :], maxs[:, None, :])
+        outside = ((positive * normals).sum(axis=2) + self.planes[:, 3] < 0).any(axis=1)
+        inside = ((negative * normals).sum(axis=2) + self.planes[:, 3] >= 0).all(axis=1)
+        return outside, inside & ~outside
+
+
+class SpatialGrid:
+    # Loose uniform grid over bounding spheres, cells grown by their largest radius so whole cells can be
+    # accepted or rejected against the frustum
+
+    def __init__(self, cellSize=16.0):
+        self.cellSize = cellSize
+        self.clear()
+
+    def clear(self):
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.centres = np.zeros((0, 3), dtype=np.float32)
+        self.radii = np.zeros(0, dtype=np.float32)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.cellMins = np.zeros((0, 3), dtype=np.float32)
+        self.cellMaxs = np.zeros((0, 3), dtype=np.float32)
+        # rows without finite bounds, always visible
+        self.unbounded = np.zeros(0, dtype=np.int64)
+
+    def build(self, rows, centres, radii):
+        bounded = np.isfinite(radii)
+        unbounded = rows[~bounded]
+        rows, centres, radii = rows[bounded], centres[bounded], radii[bounded]
+        if len(rows) == 0:
+            self.clear()
+            self.unbounded = unbounded
+            return
+        self.unbounded = unbounded
+
+        cells = np.floor(centres / self.cellSize).astype(np.int64)
+        keys, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        # entries sorted by cell, so each cell is one contiguous run of counts[cell] entries
+        order = np.argsort(inverse, kind="stable")
+        self.rows = rows[order]
+        self.centres = centres[order]
+        self.radii = radii[order]
+        self.counts = np.bincount(inverse, minlength=len(keys))
+
+        looseness = np.zeros(len(keys), dtype=np.float32)
+        np.maximum.at(looseness, inverse, radii)
+        self.cellMins = (keys * self.cellSize - looseness[:, None]).astype(np.float32)
+        self.cellMaxs = ((keys + 1) * self.cellSize + looseness[:, None]).astype(np.float32)
+
+    def query(self, frustum):
+        # rows whose sphere is at least partly inside the frustum
+        outside, inside = frustum.classifyBoxes(self.cellMins, self.cellMaxs)
+        visible = np.repeat(inside, self.counts)
+        straddling = np.repeat(~(outside | inside), self.counts)
+        visible[straddling] = frustum.testSpheres(self.centres[straddling], self.radii[straddling])
+        return np.concatenate((self.rows[visible], self.unbounded))
+
+
+class FrustumCuller:
+    # Keeps a SpatialGrid over every live row of an EntityStore, rebuilt only when the store changes,
+    # and turns a frustum into a per row visibility mask
+
+    def __init__(self, store, cellSize=16.0):
+        self.store = store
+        self.grid = SpatialGrid(cellSize)
+        self.builtVersion = None
+
+    def updateGrid(self):
+        self.store.updateMatrices()
+        if self.store.version == self.builtVersion:
+            return
+        rows = np.flatnonzero(self.store.alive[:self.store.count])
+        centres, radii = self.store.getWorldSpheres(rows)
+        self.grid.build(rows, centres, radii)
+        self.builtVersion = self.store.version
+
+    def getVisibleMask(self, frustum):
+        # bool per store row, True if it should be drawn
+        self.updateGrid()
+        visible = np.zeros(len(self.store.alive), dtype=bool)
+        visible[self.grid.query(frustum)] = True
+        return visible
@@ -1,7 +1,12 @@
+import time
+
 import glfw
 from OpenGL.GL import *
 
 import Reference
+from core.Loader import glCallCounter
+from core.Offscreen import Framebuffer, FrameCapture, createEGLContext, destroyEGLContext
+from core.Profiler import profiler
 
 
 class Window:
@@ -10,34 +15,109 @@ class Window:
 
     onCursorMethods = []
 
-    def __init__(self):
-        # initialize glfw
-        if not glfw.init():
-            glfw.terminate()
-            exit(0)
+    def __init__(self, headless=False, width=None, height=None):
+        # Headless windows render into an offscreen Framebuffer instead of a visible window, see startCapture()
+        self.headless = headless
+        if width is not None:
+            self.w_width = width
+        if height is not None:
+            self.w_height = height
+
+        self.windowID = None
+        self.eglContext = None
+        self.framebuffer = None
+        self.frameCapture = None
+        self.capturePattern = None
+        self.frameIndex = 0
+        self.closeRequested = False
+
+        if headless:
+            self.createHeadlessContext()
+        else:
+            # initialize glfw
+            if not glfw.init():
+                glfw.terminate()
+                exit(0)
+
+            self.setContextHints()
+
+            # glfw.window_hint(glfw.RESIZABLE, GL_FALSE)
+            self.windowID = glfw.create_window(self.w_width, self.w_height, "My OpenGL window", None, None)
+
+            if not self.windowID:
+                glfw.terminate()
+                exit(0)
+
+            glfw.make_context_current(self.windowID)
+
+        print("Supported GLSL version is: ", glGetString(GL_SHADING_LANGUAGE_VERSION))
 
+        if self.headless:
+            self.framebuffer = Framebuffer(self.w_width, self.w_height)
+            self.framebuffer.bind()
+        else:
+            glfw.set_window_size_callback(self.windowID, self.onWindowResize)
+            glfw.set_cursor_pos_callback(self.windowID, self.onCursorMove)
+            glfw.set_input_mode(self.windowID, glfw.CURSOR, glfw.CURSOR_DISABLED)
+
+        self.lastFrame = self.getTime()
+        self.deltaTime = 0
+
+    def setContextHints(self):
         glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 4)
         glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
         glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
         glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL_TRUE)
 
-        # glfw.window_hint(glfw.RESIZABLE, GL_FALSE)
-        self.windowID = glfw.create_window(self.w_width, self.w_height, "My OpenGL window", None, None)
-
-        if not self.windowID:
+    def createHeadlessContext(self):
+        # a hidden GLFW window where there is a window system, otherwise a bare EGL context (Mesa on CI)
+        if glfw.init():
+            self.setContextHints()
+            glfw.window_hint(glfw.VISIBLE, GL_FALSE)
+            self.windowID = glfw.create_window(self.w_width, self.w_height, "Headless", None, None)
+            if self.windowID:
+                glfw.make_context_current(self.windowID)
+                return
             glfw.terminate()
-            exit(0)
-
-        glfw.make_context_current(self.windowID)
-
-        print("Supported GLSL version is: ", glGetString(GL_SHADING_LANGUAGE_VERSION))
-
-        glfw.set_window_size_callback(self.windowID, self.onWindowResize)
-        glfw.set_cursor_pos_callback(self.windowID, self.onCursorMove)
-        glfw.set_input_mode(self.windowID, glfw.CURSOR, glfw.CURSOR_DISABLED)
-
-        self.lastFrame = glfw.get_time()
-        self.deltaTime = 0
+        self.eglContext = createEGLContext(self.w_width, self.w_height)
+
+    def getTime(self):
+        if self.eglContext is not None:
+            return time.perf_counter()
+        return glfw.get_time()
+
+    def startCapture(self, pattern="captures/frame_%05d.png", ringSize=3):
+        # Every frame from now on is read back asynchronously and written to pattern % frameIndex on a writer thread
+        if not self.headless:
+            raise RuntimeError("Frame capture needs a headless Window")
+        self.stopCapture()
+        self.capturePattern = pattern
+        self.frameIndex = 0
+        self.frameCapture = FrameCapture(self.w_width, self.w_height, ringSize=ringSize)
+
+    def stopCapture(self):
+        # waits for the frames still in flight to reach the disk
+        if self.frameCapture is not None:
+            self.frameCapture.delete()
+            self.frameCapture = None
+
+    def setVsync(self, enabled):
+        # swap interval 1 waits for the monitor's refresh, 0 swaps straight away. Headless frames are never shown
+        if self.windowID is not None and not self.headless:
+            glfw.swap_interval(1 if enabled else 0)
+
+    def close(self):
+        self.closeRequested = True
+
+    def cleanUp(self):
+        self.stopCapture()
+        if self.framebuffer is not None:
+            self.framebuffer.delete()
+        if self.eglContext is None:
+            glfw.terminate()
+        else:
+            destroyEGLContext(*self.eglContext)
+            self.eglContext = None
 
     # glfw methods
     def onWindowResize(self, window, width, height):
@@ -46,29 +126,49 @@ class Window:
         glViewport(0, 0, width, height)
 
     def startFrame(self):
-        glfw.poll_events()
-        currentTime = glfw.get_time()
+        profiler.beginFrame()
+        with profiler.scope("input"):
+            if self.windowID is not None:
+                glfw.poll_events()
+        currentTime = self.getTime()
         Reference.deltaTime = currentTime - self.lastFrame
         self.lastFrame = currentTime
 
     def updateDisplay(self):
-        glfw.swap_buffers(self.windowID)
+        with profiler.scope("swap"):
+            if self.headless:
+                if self.frameCapture is not None:
+                    self.frameCapture.capture(self.capturePattern % self.frameIndex, self.framebuffer.ID)
+                self.framebuffer.bind()
+            else:
+                glfw.swap_buffers(self.windowID)
+        self.frameIndex += 1
+        glCallCounter.endFrame()
+        profiler.endFrame()
 
     def shouldClose(self):
-        return glfw.window_should_close(self.windowID)
+        if self.closeRequested:
+            return True
+        return self.windowID is not None and glfw.window_should_close(self.windowID)
 
     def onCursorMove(self, window, xpos, ypos):
         for method in self.onCursorMethods:
             method(xpos, ypos)
 
     def getCursorPos(self):
+        if self.headless:
+            return 0.0, 0.0
         return glfw.get_cursor_pos(self.windowID)
 
     def bindCursorMove(self, method):
         self.onCursorMethods.append(method)
 
     def getKeyState(self, key):
+        if self.headless:
+            return glfw.RELEASE
         return glfw.get_key(self.windowID, key)
 
     def setCursorLock(self, lock):
+        if self.headless:
+            return
         glfw.set_input_mode(self.windowID, glfw.CURSOR, glfw.CURSOR_DISABLED if lock else glfw.CURSOR_NORMAL)
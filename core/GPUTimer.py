@@ -0,0 +1,76 @@
+import ctypes
+from collections import deque
+
+import numpy as np
+from OpenGL.GL import *
+# the wrapped glGetQueryObjectui64v can't convert its 64-bit output, call the raw entry point instead
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v as rawGetQueryObjectui64v
+
+from core.Resources import resources
+
+
+class GPUTimer:
+    # Times GPU work with GL_TIME_ELAPSED queries. Queries are kept in a small ring and only read once
+    # GL_QUERY_RESULT_AVAILABLE says so, so results arrive a frame or two late but reading them never stalls
+
+    def __init__(self, ringSize=4, history=240):
+        self.queryResources = [resources.register("query", query) for query in np.atleast_1d(glGenQueries(ringSize))]
+        self.queries = [query.ID for query in self.queryResources]
+        self.free = list(self.queries)
+        self.pending = deque()
+        # elapsed times in milliseconds, oldest first
+        self.times = deque(maxlen=history)
+        # results not yet handed out by takeNewTimes(), however they were collected
+        self.newTimes = deque(maxlen=history)
+        self.active = None
+        self.result = ctypes.c_uint64(0)
+
+    def begin(self):
+        if not self.free:
+            # every query is still in flight, wait on the oldest rather than dropping a measurement
+            self.collect(wait=True)
+        self.active = self.free.pop()
+        glBeginQuery(GL_TIME_ELAPSED, self.active)
+
+    def end(self):
+        glEndQuery(GL_TIME_ELAPSED)
+        self.pending.append(self.active)
+        self.active = None
+        self.collect()
+
+    def collect(self, wait=False):
+        # reads the finished queries, returns their times (milliseconds), empty if none had finished
+        collected = []
+        while self.pending:
+            query = self.pending[0]
+            if not wait and not glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE):
+                break
+            rawGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(self.result))
+            collected.append(self.result.value / 1e6)
+            self.free.append(self.pending.popleft())
+            wait = False
+        self.times.extend(collected)
+        self.newTimes.extend(collected)
+        return collected
+
+    def takeNewTimes(self):
+        # every result collected since the last call, including those collected by begin() and end()
+        times = list(self.newTimes)
+        self.newTimes.clear()
+        return times
+
+    def getLastTime(self):
+        # milliseconds, None until the first result is available
+        return self.times[-1] if self.times else None
+
+    def getAverageTime(self):
+        return sum(self.times) / len(self.times) if self.times else None
+
+    def delete(self):
+        for query in self.queryResources:
+            resources.release(query)
+        self.queryResources = []
+        self.queries = []
+        self.free = []
+        self.pending.clear()
+        self.newTimes.clear()
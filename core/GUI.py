@@ -1,7 +1,11 @@
+import ctypes
+
 import numpy as np
+from OpenGL.GL import *
 
 import Reference
-from core.Loader import TextureAtlas, RawModel
+from core.Loader import TextureAtlas
+from core.Resources import resources
 
 
 class GUI:
@@ -70,13 +74,28 @@ class GUIDivision(GUIComponent):
 
 
 class GUIText(GUIComponent):
-    def __init__(self, font, model, width, height, scale, colour):
-        super().__init__(0, 0, width, height)
+    # Mutable text, rewritten in place. The glyph range that changed is copied to its TextBatch slot
+
+    def __init__(self, font, text, scale, lineSpacing, colour, capacity=0):
+        super().__init__(0, 0, 0, 0)
 
-        self.model = model
         self.scale = scale
         self.font = font
         self.colour = colour
+        self.lineSpacing = lineSpacing
+        self.text = None
+
+        self.glyphCount = 0
+        self.capacity = 0
+        # (capacity * 4, TextBatch.VERTEX_SIZE) interleaved position, texture coords and colour
+        self.vertexData = np.zeros((0, TextBatch.VERTEX_SIZE), dtype=np.float32)
+        # [start, end) glyph range not yet copied to the GPU, None when clean
+        self.dirty = None
+        # the TextBatch holding this text's slot once it has been drawn
+        self.batch = None
+
+        self.reserve(capacity)
+        self.setText(text)
 
     def getWidth(self):
         return self.width * self.scale
@@ -84,22 +103,112 @@ class GUIText(GUIComponent):
     def getHeight(self):
         return self.height * self.scale
 
+    def reserve(self, glyphCount):
+        if glyphCount <= self.capacity:
+            return
+        self.capacity = max(glyphCount, 2 * self.capacity, 16)
+        grown = np.zeros((4 * self.capacity, TextBatch.VERTEX_SIZE), dtype=np.float32)
+        grown[:len(self.vertexData)] = self.vertexData
+        self.vertexData = grown
+        # a bigger text needs a new slot, which is written in full anyway
+        self.markDirty(0, self.capacity)
+
+    def markDirty(self, start, end):
+        if start >= end:
+            return
+        if self.dirty is None:
+            self.dirty = (start, end)
+        else:
+            self.dirty = (min(self.dirty[0], start), max(self.dirty[1], end))
+
+    def remove(self):
+        # gives this text's slot back, call when it won't be drawn again
+        if self.batch is not None:
+            self.batch.release(self)
+
+    def takeDirty(self):
+        # Returns the pending glyph range and marks the text clean
+        dirty = self.dirty
+        self.dirty = None
+        return dirty
+
+    def setText(self, text):
+        if text == self.text:
+            return
+        self.text = text
+        # glyph quads built by FontType.buildTextMesh, 4 vertices per glyph
+        self.vertices, self.textureCoords, self.width, self.height = self.font.buildTextMesh(text, self.lineSpacing)
+        oldCount = self.glyphCount
+        self.glyphCount = len(self.vertices) // 4
+        self.reserve(self.glyphCount)
+
+        # only the glyphs that differ from what is already there need to go to the GPU
+        vertexCount = len(self.vertices)
+        old = self.vertexData[:vertexCount]
+        changed = ((old[:, 0:2] != self.placeVertices(0, self.glyphCount)).any(axis=1)
+                   | (old[:, 2:4] != self.textureCoords).any(axis=1)
+                   | (old[:, 4:7] != self.colour[:3]).any(axis=1))
+        changed = np.flatnonzero(changed.reshape(self.glyphCount, 4).any(axis=1))
+        if len(changed):
+            self.writeVertices(changed[0], changed[-1] + 1)
+
+        # glyphs the text no longer uses are blanked
+        if oldCount > self.glyphCount:
+            self.vertexData[4 * self.glyphCount:4 * oldCount] = 0
+            self.markDirty(self.glyphCount, oldCount)
+
+    def placeVertices(self, start, end):
+        # layout positions of glyphs [start, end) scaled and moved to the text's position
+        return self.vertices[4 * start:4 * end] * self.scale + (self.x, self.y)
+
+    def writeVertices(self, start, end):
+        self.vertexData[4 * start:4 * end, 0:2] = self.placeVertices(start, end)
+        self.vertexData[4 * start:4 * end, 2:4] = self.textureCoords[4 * start:4 * end]
+        self.vertexData[4 * start:4 * end, 4:7] = self.colour[:3]
+        self.markDirty(start, end)
+
+    def setColour(self, colour):
+        if list(colour) == list(self.colour):
+            return
+        self.colour = colour
+        self.writeVertices(0, self.glyphCount)
+
+    def setScale(self, scale):
+        if scale == self.scale:
+            return
+        self.scale = scale
+        self.writeVertices(0, self.glyphCount)
+
+    def setPosition(self, x, y):
+        if (x, y) == (self.x, self.y):
+            return
+        self.x = x
+        self.y = y
+        self.writeVertices(0, self.glyphCount)
+
+
+def quadIndices(glyphCount):
+    # two triangles per glyph quad, uint16 while every vertex fits, uint32 beyond that
+    dtype = np.uint16 if 4 * glyphCount <= 65536 else np.uint32
+    quads = np.arange(glyphCount, dtype=np.uint32)[:, None] * 4 + FontType.rectIndices
+    return quads.astype(dtype).reshape(-1)
+
 
 # Holds information about a font
 class FontType:
     separator = " "
 
-    charTable = {}
-
     rectIndices = np.array([
         0, 1, 3,
         1, 2, 3
-    ], dtype=np.uint8)
+    ], dtype=np.uint32)
 
     def __init__(self, filepath):
         self.filepath = filepath
+        self.charTable = {}
         aspectRatio = Reference.WINDOW_WIDTH / Reference.WINDOW_HEIGHT
-        self.fontSheetTexture = TextureAtlas(filepath + ".png", 1, flipped=False)
+        # no mipmaps, glyphs are drawn near their native size and would only blur
+        self.fontSheetTexture = TextureAtlas(filepath + ".png", 1, flipped=False, mipmaps=False)
 
         with open(filepath + ".fnt", "r") as file:
             for line in file:
@@ -109,46 +218,219 @@ class FontType:
                     character.normalise(self.fontSheetTexture.width, self.fontSheetTexture.height, aspectRatio)
                     self.charTable[character.ID] = character
 
-    def constructGuiText(self, text, scale, lineSpacing, colour):
-        vertices = []
-        textureCoords = []
-        indices = np.array([], dtype=np.uint8)  # may be too small
-        iboCounter = 0
-        lines = text.split("\n")
-        for lineNo, line in enumerate(lines):
-            cursor = 0
-            lineOffset = lineNo * lineSpacing
-            for charNo, char in enumerate(line):
-                charInfo = self.charTable[ord(char)]
-                charVertexData = [
-                    cursor + charInfo.normXoffset, -charInfo.normYoffset - lineOffset,
-                    cursor + charInfo.normXoffset + charInfo.normWidth2, -charInfo.normYoffset - lineOffset,
-                    cursor + charInfo.normXoffset + charInfo.normWidth2,
-                    -charInfo.normYoffset - charInfo.normHeight - lineOffset,
-                    cursor + charInfo.normXoffset, -charInfo.normYoffset - charInfo.normHeight - lineOffset,
-                ]
-                vertices.extend(charVertexData)
-                charTexCoords = [
-                    charInfo.normX, charInfo.normY,
-                    charInfo.normX + charInfo.normWidth, charInfo.normY,
-                    charInfo.normX + charInfo.normWidth, charInfo.normY + charInfo.normHeight,
-                    charInfo.normX, charInfo.normY + charInfo.normHeight,
-                ]
-                textureCoords.extend(charTexCoords)
-                cursor += charInfo.normXadvance
-                newIndices = self.rectIndices + 4 * iboCounter
-                indices = np.append(indices, newIndices)
-                iboCounter += 1
-
-        vertices = np.array(vertices, dtype=np.float32)
-        textureCoords = np.array(textureCoords, dtype=np.float32)
-
-        width = vertices[0::2].max()
-        height = vertices[1::2].min()
-
-        model = RawModel.loadPTI(vertices, textureCoords, indices)
-
-        return GUIText(self, model, width, height, scale, colour)
+        self.buildGlyphTables()
+
+    def delete(self):
+        self.fontSheetTexture.release()
+
+    def buildGlyphTables(self):
+        # Quad corners (relative to the cursor), texture coords and advance of every glyph, indexed by character
+        # code. The extra last row is an empty glyph that codes missing from the font map to
+        size = max(self.charTable, default=0) + 2
+        self.glyphCorners = np.zeros((size, 4, 2), dtype=np.float64)
+        self.glyphTexCoords = np.zeros((size, 4, 2), dtype=np.float64)
+        self.glyphAdvances = np.zeros(size, dtype=np.float64)
+
+        for ID, charInfo in self.charTable.items():
+            left = charInfo.normXoffset
+            right = charInfo.normXoffset + charInfo.normWidth2
+            top = -charInfo.normYoffset
+            bottom = -charInfo.normYoffset - charInfo.normHeight
+            self.glyphCorners[ID] = ((left, top), (right, top), (right, bottom), (left, bottom))
+
+            u0, v0 = charInfo.normX, charInfo.normY
+            u1, v1 = charInfo.normX + charInfo.normWidth, charInfo.normY + charInfo.normHeight
+            self.glyphTexCoords[ID] = ((u0, v0), (u1, v0), (u1, v1), (u0, v1))
+
+            self.glyphAdvances[ID] = charInfo.normXadvance
+
+    def buildTextMesh(self, text, lineSpacing):
+        # Vectorized text layout, returns (vertices, texture coords, width, height) with 4 vertices per glyph
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+        newlines = codes == ord("\n")
+        lineNumbers = np.cumsum(newlines)[~newlines]
+        codes = codes[~newlines]
+        codes[codes >= len(self.glyphAdvances)] = len(self.glyphAdvances) - 1
+
+        if len(codes) == 0:
+            empty = np.zeros((0, 2), dtype=np.float32)
+            return empty, empty.copy(), 0.0, 0.0
+
+        # the cursor is the running sum of advances, restarting at the first glyph of each line
+        advances = self.glyphAdvances[codes]
+        cursors = np.cumsum(advances) - advances
+        lineStarts = np.zeros(len(codes), dtype=np.float64)
+        firstOfLine = np.flatnonzero(np.diff(lineNumbers, prepend=-1))
+        lineStarts[firstOfLine] = cursors[firstOfLine]
+        cursors -= np.maximum.accumulate(lineStarts)
+
+        origins = np.stack((cursors, -lineNumbers * lineSpacing), axis=1)
+        vertices = (self.glyphCorners[codes] + origins[:, None, :]).astype(np.float32).reshape(-1, 2)
+        textureCoords = self.glyphTexCoords[codes].astype(np.float32).reshape(-1, 2)
+
+        return vertices, textureCoords, float(vertices[:, 0].max()), float(vertices[:, 1].min())
+
+    def constructGuiText(self, text, scale, lineSpacing, colour, capacity=0):
+        # capacity reserves room for that many glyphs, so text that changes often doesn't need to grow
+        return GUIText(self, text, scale, lineSpacing, colour, capacity)
+
+
+class TextSlot:
+    # A run of glyphs in a TextBatch's vertex buffer
+    def __init__(self, start, capacity):
+        self.start = start
+        self.capacity = capacity
+        self.shown = False
+
+
+class TextBatch:
+    # All GUITexts of one font in one shared vertex buffer and a single draw, each text with a slot sized to
+    # its capacity. Only dirty glyph ranges are uploaded
+
+    VERTEX_SIZE = 7
+
+    def __init__(self, font):
+        self.font = font
+        self.capacity = 0  # glyphs the buffers hold
+        self.end = 0  # glyphs in use, including freed slots below it
+        self.indexType = GL_UNSIGNED_SHORT
+
+        # copy of the vertex buffer, written to first and then uploaded by range
+        self.vertexData = np.zeros((0, self.VERTEX_SIZE), dtype=np.float32)
+        self.slots = {}  # GUIText -> TextSlot
+        self.freeSlots = []
+
+        self.vao = resources.register("vertexArray", glGenVertexArrays(1), label="text")
+        self.vbo = resources.register("buffer", glGenBuffers(1), label="text vertices")
+        self.ibo = resources.register("buffer", glGenBuffers(1), label="text indices")
+        self.ID, self.vboID, self.iboID = self.vao.ID, self.vbo.ID, self.ibo.ID
+
+        stride = 4 * self.VERTEX_SIZE
+        glBindVertexArray(self.ID)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vboID)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.iboID)
+        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(0))
+        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(8))
+        glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(16))
+        for attribute in range(3):
+            glEnableVertexAttribArray(attribute)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def reserve(self, glyphCount):
+        if glyphCount <= self.capacity:
+            return
+        self.capacity = max(glyphCount, 2 * self.capacity, 64)
+        grown = np.zeros((4 * self.capacity, self.VERTEX_SIZE), dtype=np.float32)
+        grown[:len(self.vertexData)] = self.vertexData
+        self.vertexData = grown
+
+        indices = quadIndices(self.capacity)
+        self.indexType = GL_UNSIGNED_SHORT if indices.dtype == np.uint16 else GL_UNSIGNED_INT
+        glBindVertexArray(self.ID)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
+        glBindVertexArray(0)
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.vboID)
+        glBufferData(GL_ARRAY_BUFFER, self.vertexData.nbytes, self.vertexData, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        resources.resize(self.ibo, indices.nbytes)
+        resources.resize(self.vbo, self.vertexData.nbytes)
+
+    def delete(self):
+        for resource in (self.vao, self.vbo, self.ibo):
+            resources.release(resource)
+        self.slots = {}
+        self.freeSlots = []
+
+    def allocate(self, capacity):
+        # first fit among freed slots, splitting off what is left over, otherwise from the end
+        for i, (start, size) in enumerate(self.freeSlots):
+            if size >= capacity:
+                if size > capacity:
+                    self.freeSlots[i] = (start + capacity, size - capacity)
+                else:
+                    del self.freeSlots[i]
+                return TextSlot(start, capacity)
+        self.reserve(self.end + capacity)
+        slot = TextSlot(self.end, capacity)
+        self.end += capacity
+        return slot
+
+    def write(self, start, end):
+        # uploads glyphs [start, end) of vertexData
+        glBufferSubData(GL_ARRAY_BUFFER, 4 * start * 4 * self.VERTEX_SIZE, 4 * (end - start) * 4 * self.VERTEX_SIZE,
+                        self.vertexData[4 * start:4 * end])
+
+    def blank(self, slot):
+        self.vertexData[4 * slot.start:4 * (slot.start + slot.capacity)] = 0
+        self.write(slot.start, slot.start + slot.capacity)
+        slot.shown = False
+
+    def copyText(self, text, slot, start, end):
+        self.vertexData[4 * (slot.start + start):4 * (slot.start + end)] = text.vertexData[4 * start:4 * end]
+        self.write(slot.start + start, slot.start + end)
+
+    def freeSlot(self, slot):
+        # merges the slot with free neighbours, a free range at the end just shortens what is drawn
+        self.blank(slot)
+        start, end = slot.start, slot.start + slot.capacity
+        freeSlots = []
+        for freeStart, size in self.freeSlots:
+            if freeStart + size == start:
+                start = freeStart
+            elif freeStart == end:
+                end = freeStart + size
+            else:
+                freeSlots.append((freeStart, size))
+        if end == self.end:
+            self.end = start
+        else:
+            freeSlots.append((start, end - start))
+        self.freeSlots = freeSlots
+
+    def release(self, text):
+        # frees a text's slot, for texts that won't be drawn again
+        slot = self.slots.pop(text, None)
+        text.batch = None
+        if slot is not None:
+            glBindBuffer(GL_ARRAY_BUFFER, self.vboID)
+            self.freeSlot(slot)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def draw(self, texts):
+        glBindBuffer(GL_ARRAY_BUFFER, self.vboID)
+        for text in texts:
+            slot = self.slots.get(text)
+            if slot is None or slot.capacity < text.capacity:
+                if slot is not None:
+                    self.freeSlot(slot)
+                slot = self.slots[text] = self.allocate(text.capacity)
+                text.batch = self
+                # allocating may have grown (and rebound) the buffer
+                glBindBuffer(GL_ARRAY_BUFFER, self.vboID)
+                text.takeDirty()
+                self.copyText(text, slot, 0, text.capacity)
+            else:
+                dirty = text.takeDirty()
+                if not slot.shown:
+                    dirty = (0, text.capacity)
+                if dirty is not None:
+                    self.copyText(text, slot, *dirty)
+            slot.shown = True
+
+        # texts that were drawn before but aren't visible now
+        if len(self.slots) > len(texts):
+            visible = set(texts)
+            for text, slot in self.slots.items():
+                if slot.shown and text not in visible:
+                    self.blank(slot)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        if self.end:
+            glBindVertexArray(self.ID)
+            glDrawElements(GL_TRIANGLES, 6 * self.end, self.indexType, None)
+            glBindVertexArray(0)
 
 
 class Character:
@@ -0,0 +1,97 @@
+import time
+
+import Reference
+from core.Profiler import profiler
+
+
+class GameLoop:
+    # Fixed rate updates, then one render(alpha) a frame, alpha being how far real time is towards the next
+    # update. After a long stall at most maxUpdates updates run and the rest of the time is dropped
+
+    def __init__(self, window, update, render, updateRate=None, frameCap=None, vsync=None, maxUpdates=8):
+        self.window = window
+        self.update = update
+        self.render = render
+        self.timestep = 1 / (Reference.UPDATE_RATE if updateRate is None else updateRate)
+        self.maxUpdates = maxUpdates
+        self.setFrameCap(Reference.FRAME_CAP if frameCap is None else frameCap)
+        self.setVsync(Reference.VSYNC if vsync is None else vsync)
+
+        self.accumulator = 0.0
+        self.lastTime = None
+        self.nextFrame = None
+
+        # totals since the loop started
+        self.frames = 0
+        self.updates = 0
+        self.droppedTime = 0.0  # seconds of simulation skipped after stalls
+
+    def setFrameCap(self, framesPerSecond):
+        # None or 0 removes the cap
+        self.framePeriod = 1 / framesPerSecond if framesPerSecond else None
+        self.nextFrame = None
+
+    def setVsync(self, enabled):
+        self.vsync = enabled
+        self.window.setVsync(enabled)
+
+    def getAlpha(self):
+        return self.accumulator / self.timestep
+
+    def step(self):
+        # one frame: input, fixed updates, render, sleep to the frame cap and swap
+        self.window.startFrame()
+        now = time.perf_counter()
+        if self.lastTime is None:
+            self.lastTime = now
+        self.accumulator += now - self.lastTime
+        self.lastTime = now
+
+        with profiler.scope("update"):
+            updates = 0
+            while self.accumulator >= self.timestep and updates < self.maxUpdates:
+                self.update(self.timestep)
+                self.accumulator -= self.timestep
+                updates += 1
+            if self.accumulator >= self.timestep:
+                dropped = self.accumulator - self.accumulator % self.timestep
+                self.droppedTime += dropped
+                self.accumulator -= dropped
+        self.updates += updates
+
+        # CPU only, so the renderers' own GPU scopes inside still get timed
+        with profiler.scope("render"):
+            self.render(self.getAlpha())
+
+        if self.framePeriod is not None:
+            with profiler.scope("sleep"):
+                self.sleepUntilNextFrame()
+
+        self.window.updateDisplay()
+        self.frames += 1
+
+    def sleepUntilNextFrame(self):
+        # Frames are scheduled on a fixed grid rather than period after the last one finished, so sleep overshoot
+        # doesn't add up. A frame that ran over starts the grid again from now instead of rushing to catch up
+        now = time.perf_counter()
+        if self.nextFrame is None or now - self.nextFrame > self.framePeriod:
+            self.nextFrame = now
+        self.nextFrame += self.framePeriod
+        remaining = self.nextFrame - now
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def run(self):
+        while not self.window.shouldClose():
+            self.step()
+
+    def getStats(self):
+        # per stage profiler stats plus the loop's own totals
+        stats = {name: profiler.getStats(name) for name in ("frame", "input", "update", "render", "sleep", "swap")}
+        stats.update({
+            "frames": self.frames,
+            "updates": self.updates,
+            "updatesPerFrame": self.updates / self.frames if self.frames else 0.0,
+            "droppedTime": self.droppedTime,
+        })
+        return stats
@@ -0,0 +1,124 @@
+from math import radians, tan
+
+import numpy as np
+
+import Reference
+
+
+class LODModel:
+    # Several models of one entity type, finest first, switched by projected size ("screen", largest first) or
+    # camera distance ("distance", smallest first). Switch points are widened by +-hysteresis against flicker
+
+    def __init__(self, models, thresholds, metric="screen", hysteresis=0.15):
+        if len(thresholds) != len(models) - 1:
+            raise ValueError("LODModel needs one threshold per level change (%d models, %d thresholds)"
+                             % (len(models), len(thresholds)))
+        if metric not in ("screen", "distance"):
+            raise ValueError("Unknown LOD metric: %s" % metric)
+        self.models = list(models)
+        self.metric = metric
+        self.hysteresis = hysteresis
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        # both metrics are compared as a value that grows with distance, so screen sizes are inverted
+        self.switchPoints = 1 / thresholds if metric == "screen" else thresholds
+
+    def selectLevels(self, current, values):
+        # new level per entity from its current level and metric value
+        finest = (values[:, None] > self.switchPoints * (1 + self.hysteresis)).sum(axis=1)
+        coarsest = (values[:, None] > self.switchPoints * (1 - self.hysteresis)).sum(axis=1)
+        return np.clip(current, finest, coarsest)
+
+    def getMetric(self, distances, radii, fov):
+        if self.metric == "distance":
+            return distances
+        # projected radius as a fraction of half the screen height, inverted
+        return np.maximum(distances, 1e-6) * tan(radians(fov) / 2) / np.maximum(radii, 1e-6)
+
+
+class LODGroup:
+    # The entities sharing one LODModel, with their current levels
+
+    def __init__(self, lodModel):
+        self.lodModel = lodModel
+        self.entities = []
+        self.indices = {}  # entity -> position in entities
+        # levels[:len(entities)] is in use, grown by doubling
+        self.levels = np.zeros(16, dtype=np.int64)
+        self.rows = None
+
+    def add(self, entity):
+        index = len(self.entities)
+        if index == len(self.levels):
+            self.levels = np.concatenate((self.levels, np.zeros_like(self.levels)))
+        models = self.lodModel.models
+        self.levels[index] = models.index(entity.model) if entity.model in models else 0
+        self.indices[entity] = index
+        self.entities.append(entity)
+        self.rows = None
+
+    def remove(self, entity):
+        index = self.indices.pop(entity)
+        last = len(self.entities) - 1
+        if index != last:
+            self.entities[index] = self.entities[last]
+            self.indices[self.entities[index]] = index
+            self.levels[index] = self.levels[last]
+        self.entities.pop()
+        self.rows = None
+
+    def getLevels(self):
+        return self.levels[:len(self.entities)]
+
+    def getRows(self):
+        if self.rows is None:
+            self.rows = np.fromiter((entity.row for entity in self.entities), dtype=np.int64,
+                                    count=len(self.entities))
+        return self.rows
+
+
+class LODSystem:
+    # Picks the level of every entity with an lodModel once per frame. The distances and projected sizes are
+    # worked out for whole groups at once, only the entities whose level actually changes are touched.
+    # onChange(entity) is called after an entity's model was swapped, the renderer uses it to requeue the entity
+
+    def __init__(self, onChange=None, fov=Reference.CAMERA_FOV):
+        self.onChange = onChange
+        self.fov = fov
+        self.groups = {}  # LODModel -> LODGroup
+        self.switches = 0  # level changes in the last update
+
+    def add(self, entity):
+        lodModel = entity.lodModel
+        if lodModel not in self.groups:
+            self.groups[lodModel] = LODGroup(lodModel)
+        if entity not in self.groups[lodModel].indices:
+            self.groups[lodModel].add(entity)
+
+    def remove(self, entity):
+        group = self.groups.get(entity.lodModel)
+        if group is not None and entity in group.indices:
+            group.remove(entity)
+
+    def update(self, cameraPosition):
+        cameraPosition = np.asarray(cameraPosition, dtype=np.float32)
+        self.switches = 0
+        for lodModel, group in self.groups.items():
+            if not group.entities:
+                continue
+            centres, radii = group.entities[0].store.getWorldSpheres(group.getRows())
+            distances = np.linalg.norm(centres - cameraPosition, axis=1)
+            current = group.getLevels()
+            levels = lodModel.selectLevels(current, lodModel.getMetric(distances, radii, self.fov))
+
+            changed = np.flatnonzero(levels != current)
+            current[changed] = levels[changed]
+            for index in changed:
+                entity = group.entities[index]
+                entity.setModel(lodModel.models[levels[index]])
+                if self.onChange is not None:
+                    self.onChange(entity)
+            self.switches += len(changed)
+
+    def getLevelCounts(self, lodModel):
+        # number of entities at each level
+        return np.bincount(self.groups[lodModel].getLevels(), minlength=len(lodModel.models))
@@ -1,127 +1,469 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
 import numpy as np
 from OpenGL.GL import *
+from OpenGL.GL.EXT.texture_compression_s3tc import GL_COMPRESSED_RGB_S3TC_DXT1_EXT, \
+    GL_COMPRESSED_RGBA_S3TC_DXT5_EXT
+from OpenGL.GL.EXT.texture_filter_anisotropic import GL_MAX_TEXTURE_MAX_ANISOTROPY_EXT, \
+    GL_TEXTURE_MAX_ANISOTROPY_EXT
 from OpenGL.GL.shaders import *
 
 from PIL import Image
 
+import Reference
+from core.Resources import resources
+from core.TextureCompression import chooseCompression, encodeLevels
+from core.VertexFormat import getVertexFormat
+
 cachedObjects = {}
 cachedTextures = {}
 
-vaos = []
-vbos = []
-textures = []
+MESH_CACHE_DIR = os.path.join("res", "cache", "meshes")
+MESH_CACHE_VERSION = 2
+TEXTURE_CACHE_DIR = os.path.join("res", "cache", "textures")
 
+# Model space bounds of a mesh: an axis aligned box and a bounding sphere around the box centre
+Bounds = namedtuple("Bounds", ["min", "max", "centre", "radius"])
+# RGBA8 pixels ready for glTexImage2D, see decodeImage()
+DecodedImage = namedtuple("DecodedImage", ["width", "height", "data"])
+# a texture's mip levels, largest first: format is one of TEXTURE_FORMATS, data the uint8 bytes
+TextureLevels = namedtuple("TextureLevels", ["format", "sizes", "data"])
+TEXTURE_FORMATS = ("rgba8", "bc1", "bc3")
+COMPRESSED_FORMATS = {"bc1": GL_COMPRESSED_RGB_S3TC_DXT1_EXT, "bc3": GL_COMPRESSED_RGBA_S3TC_DXT5_EXT}
 
-class OBJModel:
 
-    def __init__(self, filepath):
+class MeshCache:
+    # On-disk cache of parsed mesh arrays, and as textureCache of texture levels. An entry is one .npy blob plus
+    # a json header, validated against the source's mtime/size and falling back to a content hash
 
-        self.vertices = []
-        self.textureCoords = []
-        self.normals = []
+    ALIGNMENT = 16
 
-        tempVertices = []
-        tempNormals = []
-        tempTexCoords = []
+    def __init__(self, directory=MESH_CACHE_DIR, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
 
-        verticesI = []
-        textureCoordsI = []
-        normalsI = []
+    def entryPaths(self, filepath, variant=""):
+        key = hashlib.sha1((os.path.abspath(filepath) + variant).encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + ".npy", base + ".json"
 
-        with open(filepath, "r") as file:
-            for line in file:
+    @staticmethod
+    def hashFile(filepath):
+        with open(filepath, "rb") as file:
+            return hashlib.sha1(file.read()).hexdigest()
+
+    def load(self, filepath, variant=""):
+        # read-only memory-mapped arrays, None on a miss or stale entry
+        if not self.enabled:
+            return None
+
+        dataPath, headerPath = self.entryPaths(filepath, variant)
+        try:
+            with open(headerPath, "r") as file:
+                header = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if header.get("version") != MESH_CACHE_VERSION:
+            return None
+
+        stat = os.stat(filepath)
+        if header["size"] != stat.st_size:
+            return None
+        if header["mtime"] != stat.st_mtime_ns:
+            if header["hash"] != self.hashFile(filepath):
+                return None
+            # touched but unchanged
+            header["mtime"] = stat.st_mtime_ns
+            self.writeHeader(headerPath, header)
+
+        try:
+            blob = np.load(dataPath, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+        arrays = {}
+        for name, dtype, offset, count in header["arrays"]:
+            dtype = np.dtype(dtype)
+            arrays[name] = blob[offset:offset + count * dtype.itemsize].view(dtype)
+        return arrays
+
+    def store(self, filepath, arrays, variant=""):
+        if not self.enabled:
+            return
+
+        layout = []
+        offset = 0
+        for name, array in arrays.items():
+            offset = -(-offset // self.ALIGNMENT) * self.ALIGNMENT
+            layout.append((name, array.dtype.str, offset, array.size))
+            offset += array.nbytes
+
+        blob = np.zeros(offset, dtype=np.uint8)
+        for (name, dtype, start, count), array in zip(layout, arrays.values()):
+            blob[start:start + array.nbytes] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+
+        stat = os.stat(filepath)
+        header = {
+            "version": MESH_CACHE_VERSION,
+            "path": os.path.abspath(filepath),
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": self.hashFile(filepath),
+            "arrays": layout,
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        dataPath, headerPath = self.entryPaths(filepath, variant)
+        temporaryPath = self.temporaryPath(dataPath, ".npy")
+        np.save(temporaryPath, blob)
+        os.replace(temporaryPath, dataPath)
+        self.writeHeader(headerPath, header)
+
+    @staticmethod
+    def temporaryPath(path, extension=""):
+        # unique per process and thread, so concurrent stores never share one
+        return "%s.%d.%d.tmp%s" % (path, os.getpid(), threading.get_ident(), extension)
+
+    @classmethod
+    def writeHeader(cls, headerPath, header):
+        temporaryPath = cls.temporaryPath(headerPath)
+        with open(temporaryPath, "w") as file:
+            json.dump(header, file)
+        os.replace(temporaryPath, headerPath)
 
-                if line.startswith("#"):
-                    continue
 
-                fragments = line.split()
-                if not fragments:
-                    continue
+meshCache = MeshCache()
+textureCache = MeshCache(TEXTURE_CACHE_DIR)
 
-                if fragments[0] == "v":
-                    tempVertices.append(fragments[1:4])
 
-                elif fragments[0] == "vn":
-                    tempNormals.append(fragments[1:4])
+def parseFloatBlock(lines, width):
+    data = np.fromstring(" ".join(lines), dtype=np.float32, sep=" ")
+    if data.size != len(lines) * width:
+        # drop optional extra components such as w
+        data = np.array([line.split()[:width] for line in lines], dtype=np.float32)
+    return data.reshape(-1, width)
 
-                elif fragments[0] == "vt":
-                    tempTexCoords.append(fragments[1:3])
 
-                elif line.startswith("f "):
-                    face_i = []
-                    text_i = []
-                    norm_i = []
+def parseFaceCorners(faces):
+    # raw v, vt and vn index columns of every face corner, missing elements are 0
+    tokens = [token for face in faces for token in face]
+    if not tokens:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
 
-                    for v in fragments[1:4]:
-                        w = v.split('/')
-                        face_i.append(int(w[0]) - 1)
-                        text_i.append(int(w[1]) - 1)
-                        norm_i.append(int(w[2]) - 1)
+    joined = " ".join(tokens)
+    slashes = tokens[0].count("/")
+    doubleSlash = "//" in tokens[0]
 
-                    verticesI.append(face_i)
-                    textureCoordsI.append(text_i)
-                    normalsI.append(norm_i)
+    if joined.count("/") == slashes * len(tokens) and joined.count("//") == (len(tokens) if doubleSlash else 0):
+        ints = np.fromstring(joined.replace("//", "/0/").replace("/", " "), dtype=np.int64, sep=" ")
+        ints = ints.reshape(-1, slashes + 1)
+    else:
+        ints = np.array([(token.replace("//", "/0/").split("/") + ["0", "0"])[:3] for token in tokens],
+                        dtype=np.int64)
 
-        verticesI = [y for x in verticesI for y in x]
-        textureCoordsI = [y for x in textureCoordsI for y in x]
-        normalsI = [y for x in normalsI for y in x]
+    zeros = np.zeros(len(ints), dtype=np.int64)
+    verticesI = ints[:, 0]
+    textureCoordsI = ints[:, 1] if ints.shape[1] > 1 else zeros
+    normalsI = ints[:, 2] if ints.shape[1] > 2 else zeros
+    return verticesI, textureCoordsI, normalsI
 
-        for i in verticesI:
-            self.vertices.extend(tempVertices[i])
 
-        for i in textureCoordsI:
-            self.textureCoords.extend(tempTexCoords[i])
+def resolveIndices(indices, count):
+    # 1-based and negative OBJ indices to 0-based, missing (0) becomes -1
+    return np.where(indices < 0, indices + count, indices - 1)
 
-        for i in normalsI:
-            self.normals.extend(tempNormals[i])
 
-        self.vertices = np.array(self.vertices, dtype=np.float32)
-        self.textureCoords = np.array(self.textureCoords, dtype=np.float32)
-        self.normals = np.array(self.normals, dtype=np.float32)
+class OBJModel:
+    indices = None
+    bounds = None
+
+    def __init__(self, filepath, indexed=False):
+        variant = "indexed" if indexed else ""
+        arrays = meshCache.load(filepath, variant)
+        if arrays is not None:
+            self.vertices = arrays["vertices"]
+            self.textureCoords = arrays["textureCoords"]
+            self.normals = arrays["normals"]
+            self.indices = arrays.get("indices")
+        else:
+            self.parseFile(filepath, indexed)
+            arrays = {
+                "vertices": self.vertices,
+                "textureCoords": self.textureCoords,
+                "normals": self.normals,
+            }
+            if indexed:
+                arrays["indices"] = self.indices
+            meshCache.store(filepath, arrays, variant)
+
+    def parseFile(self, filepath, indexed=False):
+        with open(filepath, "r") as file:
+            lines = file.read().splitlines()
+
+        blocks = {"v": [], "vt": [], "vn": [], "f": []}
+        for line in lines:
+            parts = line.split(None, 1)
+            if len(parts) == 2 and parts[0] in blocks:
+                blocks[parts[0]].append(parts[1])
+
+        tempVertices = parseFloatBlock(blocks["v"], 3)
+        tempTexCoords = parseFloatBlock(blocks["vt"], 2)
+        tempNormals = parseFloatBlock(blocks["vn"], 3)
+
+        faces = [line.split() for line in blocks["f"]]
+        verticesI, textureCoordsI, normalsI = parseFaceCorners(faces)
+
+        verticesI = resolveIndices(verticesI, len(tempVertices))
+        textureCoordsI = resolveIndices(textureCoordsI, len(tempTexCoords))
+        normalsI = resolveIndices(normalsI, len(tempNormals))
+
+        # fan triangulation
+        counts = np.fromiter(map(len, faces), dtype=np.int64, count=len(faces))
+        triCounts = counts - 2
+        faceStarts = np.repeat(np.cumsum(counts) - counts, triCounts)
+        fanStep = np.arange(len(faceStarts)) - np.repeat(np.cumsum(triCounts) - triCounts, triCounts) + 1
+        corners = np.stack((faceStarts, faceStarts + fanStep, faceStarts + fanStep + 1), axis=1).reshape(-1)
+
+        verticesI = verticesI[corners]
+        textureCoordsI = textureCoordsI[corners]
+        normalsI = normalsI[corners]
+
+        vertices = tempVertices[verticesI]
+
+        tempTexCoords = np.concatenate((tempTexCoords, np.zeros((1, 2), dtype=np.float32)))
+        textureCoords = tempTexCoords[textureCoordsI]
+
+        # corners without a normal get the flat normal of their triangle
+        normals = tempNormals[np.maximum(normalsI, 0)] if len(tempNormals) else np.zeros_like(vertices)
+        missingNormals = normalsI < 0
+        if missingNormals.any():
+            triangles = vertices.reshape(-1, 3, 3)
+            faceNormals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+            lengths = np.linalg.norm(faceNormals, axis=1, keepdims=True)
+            faceNormals = np.divide(faceNormals, lengths, out=np.zeros_like(faceNormals), where=lengths > 0)
+            normals[missingNormals] = np.repeat(faceNormals, 3, axis=0)[missingNormals]
+            # keep flat normals from being merged
+            normalsI = np.where(missingNormals, -2 - np.arange(len(normalsI)) // 3, normalsI)
+
+        self.indices = None
+        if indexed:
+            keys = np.stack((verticesI, textureCoordsI, normalsI), axis=1)
+            _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+            # in order of first use, for vertex cache locality
+            order = np.argsort(first)
+            remap = np.empty(len(first), dtype=np.uint32)
+            remap[order] = np.arange(len(first), dtype=np.uint32)
+            self.indices = remap[inverse.reshape(-1)]
+            first = first[order]
+            vertices = vertices[first]
+            textureCoords = textureCoords[first]
+            normals = normals[first]
+
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float32).reshape(-1)
+        self.textureCoords = np.ascontiguousarray(textureCoords, dtype=np.float32).reshape(-1)
+        self.normals = np.ascontiguousarray(normals, dtype=np.float32).reshape(-1)
+
+    def getTriangles(self):
+        # (n, 3, 3) triangle positions
+        positions = self.vertices.reshape(-1, 3)
+        if self.indices is not None:
+            positions = positions[self.indices]
+        return positions.reshape(-1, 3, 3)
 
-    def createRawModel(self):
-        return RawModel.loadPTN(self.vertices, self.textureCoords, self.normals)
+    @classmethod
+    def fromArrays(cls, vertices, textureCoords, normals, indices=None):
+        model = cls.__new__(cls)
+        model.vertices = np.ascontiguousarray(vertices, dtype=np.float32).reshape(-1)
+        model.textureCoords = np.ascontiguousarray(textureCoords, dtype=np.float32).reshape(-1)
+        model.normals = np.ascontiguousarray(normals, dtype=np.float32).reshape(-1)
+        model.indices = None if indices is None else np.ascontiguousarray(indices, dtype=np.uint32).reshape(-1)
+        return model
+
+    def simplify(self, resolution):
+        # Vertex clustering: vertices in the same cell collapse onto their mean and degenerate triangles are
+        # dropped. Triangles keep their texture coordinates and get a flat normal
+        positions = self.vertices.reshape(-1, 3)
+        textureCoords = self.textureCoords.reshape(-1, 2)
+        normals = self.normals.reshape(-1, 3)
+        indices = self.indices if self.indices is not None else np.arange(len(positions), dtype=np.uint32)
+
+        bounds = self.getBounds()
+        cellSize = max(float((bounds.max - bounds.min).max()) / resolution, 1e-6)
+        cells = np.floor((positions - bounds.min) / cellSize).astype(np.int64)
+        _, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        clusteredPositions = np.zeros((inverse.max() + 1, 3), dtype=np.float64)
+        np.add.at(clusteredPositions, inverse, positions)
+        clusteredPositions /= np.bincount(inverse)[:, None]
+
+        corners = indices.reshape(-1, 3)
+        triangles = inverse[corners]
+        keep = ((triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2])
+                & (triangles[:, 0] != triangles[:, 2]))
+        corners = corners[keep]
+        triangles = clusteredPositions[triangles[keep]]
+
+        faceNormals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        # face the same way as the original corner normals
+        flip = (faceNormals * normals[corners].sum(axis=1)).sum(axis=1) < 0
+        faceNormals[flip] = -faceNormals[flip]
+        lengths = np.linalg.norm(faceNormals, axis=1, keepdims=True)
+        faceNormals = np.divide(faceNormals, lengths, out=np.zeros_like(faceNormals), where=lengths > 0)
+
+        return OBJModel.fromArrays(triangles, textureCoords[corners], np.repeat(faceNormals, 3, axis=0),
+                                   np.arange(3 * len(corners), dtype=np.uint32))
+
+    def getBounds(self):
+        if self.bounds is None:
+            positions = self.vertices.reshape(-1, 3)
+            low = positions.min(axis=0)
+            high = positions.max(axis=0)
+            centre = (low + high) / 2
+            radius = float(np.sqrt(((positions - centre) ** 2).sum(axis=1).max()))
+            self.bounds = Bounds(low, high, centre, radius)
+        return self.bounds
+
+    def createRawModel(self, vertexFormat=None):
+        # vertexFormat defaults to Reference.VERTEX_FORMAT
+        vertexFormat = getVertexFormat(Reference.VERTEX_FORMAT if vertexFormat is None else vertexFormat)
+        arrays = {"position": self.vertices, "textureCoords": self.textureCoords, "normal": self.normals}
+        rawModel = RawModel.loadInterleaved(vertexFormat, arrays, self.indices)
+        rawModel.bounds = self.getBounds()
+        return rawModel
 
     @classmethod
-    def importFile(cls, filepath):
-        if filepath in cachedObjects:
-            return cachedObjects[filepath]
+    def importFile(cls, filepath, indexed=False):
+        key = (filepath, indexed)
+        if key in cachedObjects:
+            return cachedObjects[key]
         else:
-            obj = cls(filepath)
-            cachedObjects[filepath] = obj
+            obj = cls(filepath, indexed)
+            cachedObjects[key] = obj
             return obj
 
 
+def benchmarkMeshCache(filepath, repeats=10):
+    # parsing the OBJ text (cold) against loading the cached arrays (warm)
+    enabled = meshCache.enabled
+
+    meshCache.enabled = False
+    start = time.perf_counter()
+    for _ in range(repeats):
+        OBJModel(filepath)
+    cold = (time.perf_counter() - start) / repeats
+
+    meshCache.enabled = True
+    OBJModel(filepath)  # make sure the entry exists
+    start = time.perf_counter()
+    for _ in range(repeats):
+        OBJModel(filepath)
+    warm = (time.perf_counter() - start) / repeats
+
+    meshCache.enabled = enabled
+    print(f"{filepath}: cold {cold * 1000:.2f} ms, warm {warm * 1000:.2f} ms ({cold / warm:.1f}x)")
+    return cold, warm
+
+
+def benchmarkVertexFormats(filepath, repeats=20):
+    # upload time and GPU bytes of separate attribute buffers against each interleaved vertex format
+    from core.VertexFormat import VERTEX_FORMATS
+    mesh = OBJModel.importFile(filepath, indexed=True)
+    methods = [("separate buffers", lambda: RawModel.loadPTNI(mesh.vertices, mesh.textureCoords, mesh.normals,
+                                                              mesh.indices))]
+    for name in VERTEX_FORMATS:
+        methods.append(("interleaved " + name, lambda name=name: mesh.createRawModel(name)))
+
+    # keep the buffer pool out of the timings
+    maxPooledBytes = resources.maxPooledBytes
+    resources.maxPooledBytes = 0
+    results = {}
+    for name, load in methods:
+        load().release()
+        glFinish()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model = load()
+            glFinish()
+            byteSize = model.getByteSize()
+            model.release()
+        seconds = (time.perf_counter() - start) / repeats
+        results[name] = (seconds, byteSize)
+        print(f"{name:>20}: {seconds * 1000:7.3f} ms, {byteSize / 1024:8.1f} KiB")
+    resources.maxPooledBytes = maxPooledBytes
+    return results
+
+
 class RawModel:
+    # Reference counted through core/Resources.py, starting with one for whoever created it. Other owners
+    # retain(), everyone calls release() when done
     ID = 0
     vertexCount = 0
+    # GL type of the index buffer, None for models drawn with glDrawArrays
+    indexType = None
+    # model space Bounds, None when unknown (never culled)
+    bounds = None
+    # layout of the single vertex buffer of models made by loadInterleaved(), None with a buffer per attribute
+    vertexFormat = None
 
     def __init__(self, vertexCount):
         self.createVAO()
         self.vertexCount = vertexCount
 
     def createVAO(self):
-        self.ID = glGenVertexArrays(1)
-        vaos.append(self.ID)
+        self.vao = resources.register("vertexArray", glGenVertexArrays(1))
+        self.ID = self.vao.ID
+        self.buffers = []
+        self.vao.onDelete.append(self.releaseBuffers)
         glBindVertexArray(self.ID)
 
     def bindIndicesBuffer(self, indices):
-        iboID = glGenBuffers(1)
-        vbos.append(iboID)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, iboID)
-        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
+        self.buffers.append(resources.createBuffer(GL_ELEMENT_ARRAY_BUFFER, indices))
 
     def storeDataInAttributeList(self, attributeNumber, coordinateSize, data):
-        vboID = glGenBuffers(1)
-        vbos.append(vboID)
-        glBindBuffer(GL_ARRAY_BUFFER, vboID)
-        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data, GL_STATIC_DRAW)
+        self.buffers.append(resources.createBuffer(GL_ARRAY_BUFFER, data))
         glVertexAttribPointer(attributeNumber, coordinateSize, GL_FLOAT, GL_FALSE, data.itemsize * coordinateSize,
                               ctypes.c_void_p(0))
 
     def unbind(self):
         glBindVertexArray(0)
 
+    def retain(self):
+        resources.retain(self.vao)
+        return self
+
+    def release(self):
+        resources.release(self.vao)
+
+    def releaseBuffers(self, vao):
+        for buffer in self.buffers:
+            resources.release(buffer)
+        self.buffers = []
+
+    def getByteSize(self):
+        return sum(buffer.size for buffer in self.buffers)
+
+    @classmethod
+    def loadInterleaved(cls, vertexFormat, arrays, indices=None):
+        # arrays maps the attribute names of vertexFormat (core/VertexFormat.py) to their data
+        vertices = vertexFormat.pack(arrays)
+        obj = cls(len(vertices) if indices is None else len(indices))
+        obj.vertexFormat = vertexFormat
+        if indices is not None:
+            obj.indexType = GL_UNSIGNED_INT
+            obj.bindIndicesBuffer(indices.astype(np.uint32, copy=False))
+        obj.buffers.append(resources.createBuffer(GL_ARRAY_BUFFER, vertices.view(np.uint8)))
+        vertexFormat.setAttributePointers()
+        obj.unbind()
+        return obj
+
     @classmethod
     def loadPI(cls, positions, indices):
         obj = cls(len(indices))
@@ -133,7 +475,7 @@ class RawModel:
 
     @classmethod
     def loadP(cls, positions):
-        obj = cls(len(positions))
+        obj = cls(len(positions) // 3)
         obj.storeDataInAttributeList(0, 3, positions)
         obj.unbind()
         return obj
@@ -149,7 +491,18 @@ class RawModel:
 
     @classmethod
     def loadPTN(cls, positions, texCoords, normals):
-        obj = cls(len(positions))
+        obj = cls(len(positions) // 3)
+        obj.storeDataInAttributeList(0, 3, positions)
+        obj.storeDataInAttributeList(1, 2, texCoords)
+        obj.storeDataInAttributeList(2, 3, normals)
+        obj.unbind()
+        return obj
+
+    @classmethod
+    def loadPTNI(cls, positions, texCoords, normals, indices):
+        obj = cls(len(indices))
+        obj.indexType = GL_UNSIGNED_INT
+        obj.bindIndicesBuffer(indices.astype(np.uint32, copy=False))
         obj.storeDataInAttributeList(0, 3, positions)
         obj.storeDataInAttributeList(1, 2, texCoords)
         obj.storeDataInAttributeList(2, 3, normals)
@@ -158,7 +511,7 @@ class RawModel:
 
     @classmethod
     def loadPN(cls, positions, normals):
-        obj = cls(len(positions))
+        obj = cls(len(positions) // 3)
         obj.storeDataInAttributeList(0, 3, positions)
         obj.storeDataInAttributeList(1, 3, normals)
         obj.unbind()
@@ -171,20 +524,86 @@ class RawModel:
         return self.vertexCount
 
 
+class InstanceBuffer:
+    # Per-instance model matrices for one RawModel, a mat4 attribute with divisor 1 grown by doubling
+
+    FIRST_ATTRIBUTE = 3
+    MATRIX_SIZE = 16 * 4
+
+    def __init__(self, rawModel):
+        self.buffer = resources.register("buffer", glGenBuffers(1), label="instances")
+        self.ID = self.buffer.ID
+        self.capacity = 0
+
+        glBindVertexArray(rawModel.getID())
+        glBindBuffer(GL_ARRAY_BUFFER, self.ID)
+        for column in range(4):
+            attribute = self.FIRST_ATTRIBUTE + column
+            glVertexAttribPointer(attribute, 4, GL_FLOAT, GL_FALSE, self.MATRIX_SIZE, ctypes.c_void_p(16 * column))
+            glVertexAttribDivisor(attribute, 1)
+            glEnableVertexAttribArray(attribute)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def upload(self, matrices):
+        # (n, 4, 4) float32 in pyrr layout
+        glBindBuffer(GL_ARRAY_BUFFER, self.ID)
+        if matrices.nbytes > self.capacity:
+            self.capacity = max(matrices.nbytes, 2 * self.capacity)
+        # orphan the old storage so the driver doesn't wait on last frame's draws
+        glBufferData(GL_ARRAY_BUFFER, self.capacity, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, matrices.nbytes, matrices)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        resources.resize(self.buffer, self.capacity)
+
+    def delete(self):
+        resources.release(self.buffer)
+
+
 class TexturedModel:
+    # takes over the creator's reference to model and retains texture
     def __init__(self, model, texture):
         self.rawModel = model
-        self.texture = texture
+        self.texture = texture.retain()
+
+    def release(self):
+        self.rawModel.release()
+        self.texture.release()
 
     def getID(self):
         return self.rawModel.getID()
 
+    @property
+    def bounds(self):
+        return self.rawModel.bounds
+
+
+class GLCallCounter:
+    # GL calls issued through Shader, call endFrame() once per frame
+
+    def __init__(self):
+        self.calls = 0
+        self.lastFrame = 0
+
+    def count(self, n=1):
+        self.calls += n
+
+    def endFrame(self):
+        self.lastFrame = self.calls
+        self.calls = 0
+        return self.lastFrame
+
+
+glCallCounter = GLCallCounter()
+
 
 class Shader:
-    uniforms = {}
 
     def __init__(self, filepath):
+        # uniform name -> location
+        self.uniforms = {}
         self.createShader(filepath)
+        self.cacheUniformLocations()
 
     def createShader(self, filepath):
         vertexShaderCode = ""
@@ -202,7 +621,8 @@ class Shader:
                     else:
                         fragmentShaderCode += line
 
-        self.ID = glCreateProgram()
+        self.program = resources.register("program", glCreateProgram(), label=filepath)
+        self.ID = self.program.ID
         vs_id = self.addShader(vertexShaderCode, GL_VERTEX_SHADER)
         frag_id = self.addShader(fragmentShaderCode, GL_FRAGMENT_SHADER)
 
@@ -212,7 +632,7 @@ class Shader:
 
         if glGetProgramiv(self.ID, GL_LINK_STATUS) != GL_TRUE:
             info = glGetProgramInfoLog(self.ID)
-            glDeleteProgram(self.ID)
+            resources.release(self.program)
             glDeleteShader(vs_id)
             glDeleteShader(frag_id)
             raise RuntimeError('Error linking program: %s' % (info))
@@ -232,91 +652,252 @@ class Shader:
             glDeleteShader(shader_id)
             raise
 
+    def cacheUniformLocations(self):
+        for i in range(glGetProgramiv(self.ID, GL_ACTIVE_UNIFORMS)):
+            name, size, uniformType = glGetActiveUniform(self.ID, i)
+            name = name.decode() if isinstance(name, bytes) else name
+            # arrays are reported as "name[0]"
+            baseName = name[:-3] if name.endswith("[0]") else name
+            self.uniforms[baseName] = glGetUniformLocation(self.ID, baseName)
+            if size > 1 or name.endswith("[0]"):
+                for element in range(size):
+                    elementName = f"{baseName}[{element}]"
+                    self.uniforms[elementName] = glGetUniformLocation(self.ID, elementName)
+
     def getUniformLocation(self, name):
-        # if not name in self.uniforms:
-        #     location = glGetUniformLocation(self.ID, name)
-        #     self.uniforms[name] = location
-        # else:
-        #     location = self.uniforms[name]
-        location = glGetUniformLocation(self.ID, name)
+        location = self.uniforms.get(name)
+        if location is None:
+            location = glGetUniformLocation(self.ID, name)
+            self.uniforms[name] = location
+            glCallCounter.count()
         return location
 
+    def release(self):
+        resources.release(self.program)
+
     def bind(self):
         glUseProgram(self.ID)
+        glCallCounter.count()
 
     def unbind(self):
         glUseProgram(0)
+        glCallCounter.count()
 
     def setUniform4f(self, name, v1, v2, v3, v4):
         location = self.getUniformLocation(name)
         glUniform4f(location, v1, v2, v3, v4)
+        glCallCounter.count()
 
     def setUniform3f(self, name, v1, v2, v3):
         location = self.getUniformLocation(name)
         glUniform3f(location, v1, v2, v3)
+        glCallCounter.count()
 
     def setUniform2f(self, name, v1, v2):
         location = self.getUniformLocation(name)
         glUniform2f(location, v1, v2)
+        glCallCounter.count()
 
     def setUniform1f(self, name, v1):
         location = self.getUniformLocation(name)
         glUniform1f(location, v1)
+        glCallCounter.count()
+
+    # values is an (n, k) array written to name[0] .. name[n - 1]
+    def setUniform4fv(self, name, values):
+        location = self.getUniformLocation(name)
+        values = np.ascontiguousarray(values, dtype=np.float32)
+        glUniform4fv(location, len(values), values)
+        glCallCounter.count()
 
-    # def setUniform4fv(self, name, v):
-    #    self.bind()
-    #    location = self.getUniformLocation(name)
-    #    glUniform4f(location, v1, v2, v3, v4)
-    #    self.unbind()
+    def setUniform3fv(self, name, values):
+        location = self.getUniformLocation(name)
+        values = np.ascontiguousarray(values, dtype=np.float32)
+        glUniform3fv(location, len(values), values)
+        glCallCounter.count()
 
     def setUniformMat4fv(self, name, mat):
         location = self.getUniformLocation(name)
         glUniformMatrix4fv(location, 1, GL_FALSE, mat)
+        glCallCounter.count()
 
     def setUniform1i(self, name, value):
         location = self.getUniformLocation(name)
         glUniform1i(location, value)
+        glCallCounter.count()
+
+
+def decodeImage(filepath, flipped=True):
+    image = Image.open(filepath)
+    if flipped:
+        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+    return DecodedImage(image.width, image.height, image.convert("RGBA").tobytes())
+
+
+def textureVariant(flipped, compression, mipmaps):
+    return "%s:%s:%s" % ("flipped" if flipped else "", compression or "rgba8", "mipmaps" if mipmaps else "")
+
+
+def buildTextureLevels(filepath, flipped=True, compression=None, mipmaps=True):
+    # compression is "bc1", "bc3", "auto" or None
+    image = decodeImage(filepath, flipped)
+    pixels = np.frombuffer(image.data, dtype=np.uint8).reshape(image.height, image.width, 4)
+    compression = chooseCompression(pixels, compression)
+    levels = encodeLevels(pixels, compression, mipmaps)
+    return TextureLevels(compression or "rgba8", [(width, height) for width, height, _ in levels],
+                         [data for _, _, data in levels])
+
+
+def textureLevelArrays(levels):
+    arrays = {
+        "format": np.array([TEXTURE_FORMATS.index(levels.format)], dtype=np.uint8),
+        "sizes": np.array(levels.sizes, dtype=np.int32),
+    }
+    for level, data in enumerate(levels.data):
+        arrays["level%d" % level] = data
+    return arrays
+
+
+def textureLevelsFromArrays(arrays):
+    sizes = arrays["sizes"].reshape(-1, 2)
+    return TextureLevels(TEXTURE_FORMATS[int(arrays["format"][0])],
+                         [(int(width), int(height)) for width, height in sizes],
+                         [arrays["level%d" % level] for level in range(len(sizes))])
+
+
+def preprocessTexture(filepath, flipped=True, compression=None, mipmaps=True):
+    levels = buildTextureLevels(filepath, flipped, compression, mipmaps)
+    textureCache.store(filepath, textureLevelArrays(levels), textureVariant(flipped, compression, mipmaps))
+    return levels
+
+
+def loadTextureLevels(filepath, flipped=True, compression=None, mipmaps=True):
+    # runs on the loader pool, the levels are built and cached on a miss
+    arrays = textureCache.load(filepath, textureVariant(flipped, compression, mipmaps))
+    if arrays is None:
+        return preprocessTexture(filepath, flipped, compression, mipmaps)
+    return textureLevelsFromArrays(arrays)
+
+
+maxAnisotropy = None
+
+
+def getMaxAnisotropy():
+    # 1 where anisotropic filtering isn't supported
+    global maxAnisotropy
+    if maxAnisotropy is None:
+        try:
+            maxAnisotropy = float(glGetFloatv(GL_MAX_TEXTURE_MAX_ANISOTROPY_EXT))
+        except GLError:
+            maxAnisotropy = 1.0
+    return maxAnisotropy
+
+
+def benchmarkTextureLoading(filepath, repeats=5):
+    # load time and upload bandwidth of a texture: PIL plus GPU mipmaps against the texture cache
+    def decoded():
+        return TextureAtlas(None, 1, image=decodeImage(filepath))
+
+    methods = [("decode + glGenerateMipmap", decoded)]
+    for compression in (None, "auto"):
+        preprocessTexture(filepath, compression=compression)
+        methods.append(("cache " + (compression or "rgba8"),
+                        lambda compression=compression: TextureAtlas(filepath, 1, compression=compression)))
+
+    results = {}
+    for name, load in methods:
+        load().release()  # warm up the page cache and the driver
+        glFinish()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            texture = load()
+            glFinish()
+            texture.release()
+        seconds = (time.perf_counter() - start) / repeats
+        results[name] = (seconds, texture.byteSize, texture.format)
+        print(f"{name:>26}: {seconds * 1000:7.2f} ms, {texture.format} {texture.byteSize / 1024:8.1f} KiB "
+              f"on the GPU, {texture.byteSize / seconds / 2 ** 20:8.1f} MiB/s")
+    return results
 
 
 class TextureAtlas:
     ID = 0
+    # set by core/AtlasPacking.py
     nTextures = 0
+    regions = None
 
     shineDamper = 1
     reflectivity = 0
 
-    def __init__(self, filepath, nTextures, flipped=True):
+    def __init__(self, filepath, nTextures, flipped=True, image=None, levels=None, compression=None, mipmaps=True,
+                 anisotropy=16):
+        # Uploads levels (TextureLevels), image (a DecodedImage, mipmapped on the GPU) or what loadTextureLevels()
+        # gives. compression is "bc1", "bc3" or "auto"
         self.nTextures = nTextures
 
-        image = Image.open(filepath)
-        if flipped:
-            image = image.transpose(Image.FLIP_TOP_BOTTOM)
-
-        imageData = image.convert("RGBA").tobytes()
+        if image is None and levels is None:
+            levels = loadTextureLevels(filepath, flipped, compression, mipmaps)
 
-        self.width = image.width
-        self.height = image.height
-
-        self.ID = glGenTextures(1)
+        self.texture = resources.register("texture", glGenTextures(1), label=filepath)
+        self.ID = self.texture.ID
         glBindTexture(GL_TEXTURE_2D, self.ID)
         # Set the texture wrapping parameters
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
-        # Set texture filtering parameters
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
 
-        # TODO: add mip-mapping and anisotropic filtering
+        if image is not None:
+            self.width = image.width
+            self.height = image.height
+            self.format = "rgba8"
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, self.width, self.height, 0, GL_RGBA, GL_UNSIGNED_BYTE, image.data)
+            self.levelCount = 1
+            self.byteSize = len(image.data)
+            if mipmaps:
+                glGenerateMipmap(GL_TEXTURE_2D)
+                self.levelCount = int(np.log2(max(self.width, self.height))) + 1
+                self.byteSize = self.byteSize * 4 // 3
+        else:
+            self.width, self.height = levels.sizes[0]
+            self.format = levels.format
+            self.levelCount = len(levels.data)
+            self.byteSize = sum(data.nbytes for data in levels.data)
+            for level, ((width, height), data) in enumerate(zip(levels.sizes, levels.data)):
+                if self.format == "rgba8":
+                    glTexImage2D(GL_TEXTURE_2D, level, GL_RGBA8, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, data)
+                else:
+                    glCompressedTexImage2D(GL_TEXTURE_2D, level, COMPRESSED_FORMATS[self.format], width, height, 0,
+                                           data)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, self.levelCount - 1)
 
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height, 0, GL_RGBA, GL_UNSIGNED_BYTE, imageData)
+        # Set texture filtering parameters
+        mipmapped = self.levelCount > 1
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR if mipmapped else GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        if mipmapped and anisotropy > 1 and getMaxAnisotropy() > 1:
+            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAX_ANISOTROPY_EXT, min(anisotropy, getMaxAnisotropy()))
 
         glBindTexture(GL_TEXTURE_2D, 0)
 
-        textures.append(self.ID)
+        self.texture.size = self.byteSize
+        self.texture.onDelete.append(self.uncache)
 
     def getID(self):
         return self.ID
 
+    # reference counted like RawModel
+    def retain(self):
+        resources.retain(self.texture)
+        return self
+
+    def release(self):
+        resources.release(self.texture)
+
+    def uncache(self, texture):
+        # a deleted texture mustn't be handed out by importFile() again
+        for filepath, cached in list(cachedTextures.items()):
+            if cached is self:
+                del cachedTextures[filepath]
+
     @classmethod
     def importFile(cls, filepath, nTextures):
         if filepath in cachedTextures:
@@ -327,11 +908,12 @@ class TextureAtlas:
             return tex
 
 
-def cleanUp():
-    for vao in vaos:
-        glDeleteVertexArrays(1, vao)
-    for vbo in vbos:
-        glDeleteBuffers(vbo)
-
-    # textures
-    # shaders
+def cleanUp(verbose=True):
+    # for shutdown, returns the resources that were never released
+    leaked = resources.releaseAll()
+    cachedTextures.clear()
+    if verbose and leaked:
+        print("%d GPU resources were never released:" % len(leaked))
+        for resource in leaked:
+            print("    %r" % resource)
+    return leaked
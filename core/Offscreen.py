@@ -0,0 +1,290 @@
+import ctypes
+import os
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+from OpenGL.GL import *
+# the wrapped versions insist on returning the pixels, with a pixel pack buffer bound we pass an offset instead
+from OpenGL.raw.GL.VERSION.GL_1_0 import glReadPixels as rawReadPixels, glGetTexImage as rawGetTexImage
+from PIL import Image
+
+from core.Resources import resources
+
+
+def createEGLContext(width, height):
+    # A GL 4.3 core context without any window system, for CI boxes running Mesa. PyOpenGL only talks to EGL
+    # when PYOPENGL_PLATFORM=egl is set before OpenGL is first imported, with Mesa also set EGL_PLATFORM=surfaceless
+    # when there is no display at all
+    if os.environ.get("PYOPENGL_PLATFORM") != "egl":
+        raise RuntimeError("Headless rendering without a window system needs PYOPENGL_PLATFORM=egl "
+                           "(and EGL_PLATFORM=surfaceless on Mesa) set before starting")
+    from OpenGL import EGL
+
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError("Could not initialise an EGL display")
+
+    configAttributes = (EGL.EGLint * 13)(
+        EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8,
+        EGL.EGL_BLUE_SIZE, 8, EGL.EGL_DEPTH_SIZE, 24, EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+    config = EGL.EGLConfig()
+    configCount = EGL.EGLint()
+    if not EGL.eglChooseConfig(display, configAttributes, ctypes.pointer(config), 1, ctypes.pointer(configCount)) \
+            or configCount.value == 0:
+        raise RuntimeError("No EGL config for desktop GL rendering")
+
+    # rendering goes to a Framebuffer, the pbuffer surface only exists to make the context current
+    surfaceAttributes = (EGL.EGLint * 5)(EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE)
+    surface = EGL.eglCreatePbufferSurface(display, config, surfaceAttributes)
+
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    contextAttributes = (EGL.EGLint * 7)(
+        EGL.EGL_CONTEXT_MAJOR_VERSION, 4, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+        EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT, EGL.EGL_NONE)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, contextAttributes)
+    if not context or not EGL.eglMakeCurrent(display, surface, surface, context):
+        raise RuntimeError("Could not create an EGL OpenGL 4.3 context")
+    return display, surface, context
+
+
+def destroyEGLContext(display, surface, context):
+    # undoes createEGLContext(), so a process can create another one later
+    from OpenGL import EGL
+
+    EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+    EGL.eglDestroyContext(display, context)
+    if surface:
+        EGL.eglDestroySurface(display, surface)
+    EGL.eglTerminate(display)
+
+
+class Framebuffer:
+    # An offscreen render target, RGBA8 colour texture plus depth renderbuffer
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+        self.framebuffer = resources.register("framebuffer", glGenFramebuffers(1), label="offscreen")
+        self.ID = self.framebuffer.ID
+        glBindFramebuffer(GL_FRAMEBUFFER, self.ID)
+
+        self.colour = resources.register("texture", glGenTextures(1), width * height * 4, "framebuffer colour")
+        self.colourTexture = self.colour.ID
+        glBindTexture(GL_TEXTURE_2D, self.colourTexture)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.colourTexture, 0)
+
+        self.depth = resources.register("renderbuffer", glGenRenderbuffers(1), width * height * 4, "framebuffer depth")
+        self.depthBuffer = self.depth.ID
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depthBuffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depthBuffer)
+
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("Framebuffer incomplete: 0x%x" % status)
+
+    def bind(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, self.ID)
+        glViewport(0, 0, self.width, self.height)
+
+    def unbind(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def delete(self):
+        for resource in (self.framebuffer, self.colour, self.depth):
+            resources.release(resource)
+
+
+def writeImage(filepath, pixels):
+    # Writes a (height, width, 4) frame as .png/.jpg/.bmp, .npy, .raw or .exr (needs imageio), renamed into
+    # place once complete
+    root, extension = os.path.splitext(filepath)
+    extension = extension.lower()
+    partial = root + ".partial" + extension
+    if extension == ".npy":
+        np.save(partial, pixels)
+    elif extension == ".raw":
+        pixels.tofile(partial)
+    elif extension == ".exr":
+        try:
+            import imageio
+        except ImportError:
+            raise RuntimeError("Writing .exr frames needs the imageio package (with its freeimage plugin)")
+        imageio.imwrite(partial, pixels.astype(np.float32))
+    else:
+        if pixels.dtype != np.uint8:
+            pixels = (np.clip(pixels, 0, 1) * 255 + 0.5).astype(np.uint8)
+        mode = "RGBA" if extension == ".png" else "RGB"
+        Image.fromarray(np.ascontiguousarray(pixels[:, :, :len(mode)]), mode).save(partial)
+    os.replace(partial, filepath)
+
+
+class FrameWriter:
+    # Encodes and writes frames on a background thread. The queue is bounded, so if the disk can't keep up
+    # submit() waits rather than letting frames pile up in memory
+
+    def __init__(self, maxQueued=8):
+        self.queue = queue.Queue(maxQueued)
+        self.written = 0
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, name="FrameWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, filepath, pixels):
+        self.queue.put((filepath, pixels))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            filepath, pixels = item
+            try:
+                directory = os.path.dirname(filepath)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                writeImage(filepath, pixels)
+                self.written += 1
+            except Exception as error:
+                self.errors.append((filepath, error))
+            self.queue.task_done()
+
+    def wait(self):
+        # blocks until every submitted frame is on disk
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class FrameCapture:
+    # Asynchronous readback through a ring of pixel pack buffers. capture() only queues the copy into a PBO and
+    # drops a fence behind it, the PBO is mapped a frame or two later once the fence has signalled, so the CPU
+    # never waits on the GPU unless every buffer in the ring is still in flight. Finished frames go to a FrameWriter
+
+    # how long one blocking poll() waits on a fence (nanoseconds), and how many of those acquire() tries before
+    # giving up on the GPU
+    WAIT_TIMEOUT = 10 ** 10
+    MAX_WAITS = 6
+
+    def __init__(self, width, height, writer=None, ringSize=3, floatingPoint=False):
+        self.width = width
+        self.height = height
+        self.floatingPoint = floatingPoint
+        self.pixelType = GL_FLOAT if floatingPoint else GL_UNSIGNED_BYTE
+        self.dtype = np.float32 if floatingPoint else np.uint8
+        self.size = width * height * 4 * np.dtype(self.dtype).itemsize
+
+        self.ownsWriter = writer is None
+        self.writer = FrameWriter() if writer is None else writer
+
+        self.pboResources = [resources.register("buffer", pbo, self.size, "readback")
+                             for pbo in np.atleast_1d(glGenBuffers(ringSize))]
+        self.pbos = [pbo.ID for pbo in self.pboResources]
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self.size, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        self.free = list(self.pbos)
+        self.pending = deque()  # (pbo, fence, filepath), oldest first
+        self.captured = 0
+
+    def waitUntil(self, done):
+        # A blocking poll() can time out without freeing anything, so keep waiting a few times before calling it a
+        # hang
+        waits = 0
+        while not done():
+            if waits == self.MAX_WAITS:
+                raise RuntimeError("No readback buffer was freed after waiting %g s on the GPU fences"
+                                   % (self.MAX_WAITS * self.WAIT_TIMEOUT / 1e9))
+            pending = len(self.pending)
+            self.poll(wait=True)
+            waits = 0 if len(self.pending) < pending else waits + 1
+
+    def acquire(self):
+        # the whole ring in flight is the only place capturing can stall
+        self.waitUntil(lambda: self.free)
+        return self.free.pop()
+
+    def insertFence(self):
+        fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        # make sure the copy actually gets submitted, poll() doesn't flush
+        glFlush()
+        return fence
+
+    def capture(self, filepath, framebufferID=0):
+        # queues a copy of a framebuffer's first colour attachment
+        pbo = self.acquire()
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, framebufferID)
+        glReadBuffer(GL_COLOR_ATTACHMENT0 if framebufferID else GL_BACK)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        rawReadPixels(0, 0, self.width, self.height, GL_RGBA, self.pixelType, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+        self.pending.append((pbo, self.insertFence(), filepath))
+        self.poll()
+
+    def captureTexture(self, textureID, filepath):
+        # queues a copy of a texture's base level, e.g. the ray tracer's RGBA32F output for float frames
+        pbo = self.acquire()
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glBindTexture(GL_TEXTURE_2D, textureID)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        rawGetTexImage(GL_TEXTURE_2D, 0, GL_RGBA, self.pixelType, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending.append((pbo, self.insertFence(), filepath))
+        self.poll()
+
+    def poll(self, wait=False):
+        # hands every finished readback to the writer, with wait=True blocks until at least the oldest one is done
+        while self.pending:
+            pbo, fence, filepath = self.pending[0]
+            if wait:
+                status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, self.WAIT_TIMEOUT)
+            else:
+                status = glClientWaitSync(fence, 0, 0)
+            if status == GL_WAIT_FAILED:
+                raise RuntimeError("glClientWaitSync failed on a readback fence")
+            if status not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                break
+            glDeleteSync(fence)
+            self.pending.popleft()
+
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.size, GL_MAP_READ_BIT)
+            data = ctypes.cast(pointer, ctypes.POINTER(ctypes.c_ubyte * self.size)).contents
+            # GL rows start at the bottom
+            pixels = np.frombuffer(data, dtype=self.dtype).reshape(self.height, self.width, 4)[::-1].copy()
+            glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+            self.free.append(pbo)
+            self.captured += 1
+            self.writer.submit(filepath, pixels)
+            wait = False
+
+    def flush(self):
+        # waits for every queued readback and every queued write
+        self.waitUntil(lambda: not self.pending)
+        self.writer.wait()
+
+    def delete(self):
+        self.flush()
+        if self.ownsWriter:
+            self.writer.close()
+        for pbo in self.pboResources:
+            resources.release(pbo)
+        self.pboResources = []
+        self.pbos = []
@@ -0,0 +1,178 @@
+import csv
+import functools
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from core.GUI import GUIDivision
+
+
+class Profiler:
+    # Per frame timings of named scopes, GPU times arrive a frame or two late. GPU scopes don't nest, an inner
+    # one is timed on the CPU only
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, history=600):
+        self.enabled = True
+        self.history = history
+
+        self.records = deque(maxlen=history)  # {"frame": ms, scope: ms, "gpu:" + scope: ms, ...} per frame
+        self.names = []  # every column seen, in first seen order
+        self.current = {}
+        self.frameStart = None
+        self.frameCount = 0
+
+        self.gpuTimers = {}  # scope name -> GPUTimer
+        self.gpuActive = False
+
+    def beginFrame(self):
+        if not self.enabled:
+            return
+        self.current = {}
+        self.frameStart = time.perf_counter()
+
+    def endFrame(self):
+        if not self.enabled or self.frameStart is None:
+            return
+        self.current["frame"] = (time.perf_counter() - self.frameStart) * 1000
+        # GPU results lag behind, a frame records the ones that arrived during it (summed, like a CPU scope run
+        # several times), frames where none did get no GPU sample
+        for name, timer in self.gpuTimers.items():
+            timer.collect()
+            newTimes = timer.takeNewTimes()
+            if newTimes:
+                self.current["gpu:" + name] = sum(newTimes)
+
+        for name in self.current:
+            if name not in self.names:
+                self.names.append(name)
+        self.records.append(self.current)
+        self.current = {}
+        self.frameStart = None
+        self.frameCount += 1
+
+    def getGPUTimer(self, name):
+        if name not in self.gpuTimers:
+            # imported here so CPU only profiling never needs GL
+            from core.GPUTimer import GPUTimer
+            self.gpuTimers[name] = GPUTimer(history=self.history)
+        return self.gpuTimers[name]
+
+    def addGPUTimer(self, name, timer):
+        # reports a GPUTimer owned by someone else, e.g. the ray tracer's dispatch timer
+        self.gpuTimers[name] = timer
+
+    def removeGPUTimer(self, name):
+        # for owners of added timers before they delete them
+        self.gpuTimers.pop(name, None)
+
+    def deleteGPUTimers(self):
+        # deletes the scopes' timers (and any added one still here), before the GL context goes
+        for timer in self.gpuTimers.values():
+            timer.delete()
+        self.gpuTimers = {}
+
+    def record(self, name, milliseconds):
+        # adds time to a scope of the current frame by hand
+        if self.enabled:
+            self.current[name] = self.current.get(name, 0.0) + milliseconds
+
+    @contextmanager
+    def scope(self, name, gpu=False):
+        if not self.enabled:
+            yield
+            return
+
+        timer = None
+        if gpu and not self.gpuActive:
+            timer = self.getGPUTimer(name)
+            timer.begin()
+            self.gpuActive = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+            if timer is not None:
+                timer.end()
+                self.gpuActive = False
+
+    def profiled(self, name, gpu=False):
+        # decorator form of scope()
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.scope(name, gpu):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def getTimes(self, name):
+        return np.array([record[name] for record in self.records if name in record], dtype=np.float64)
+
+    def getStats(self, name):
+        # mean, max and p50/p95/p99 in milliseconds over the history, None if the scope never ran
+        times = self.getTimes(name)
+        if len(times) == 0:
+            return None
+        stats = {"mean": float(times.mean()), "max": float(times.max()), "samples": len(times)}
+        for percentile, value in zip(self.PERCENTILES, np.percentile(times, self.PERCENTILES)):
+            stats["p%d" % percentile] = float(value)
+        return stats
+
+    def getAllStats(self):
+        return {name: self.getStats(name) for name in self.names}
+
+    def exportCSV(self, filepath):
+        # one row per frame in the history, one column per scope
+        with open(filepath, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=self.names, restval="")
+            writer.writeheader()
+            writer.writerows(self.records)
+
+    def exportJSON(self, filepath):
+        with open(filepath, "w") as file:
+            json.dump({"frames": self.frameCount, "stats": self.getAllStats(), "records": list(self.records)},
+                      file, indent=1)
+
+    def report(self):
+        # one line per scope, frame first
+        lines = []
+        for name in sorted(self.names, key=lambda name: name != "frame"):
+            stats = self.getStats(name)
+            lines.append("%s %.2f ms (p50 %.2f p95 %.2f p99 %.2f)"
+                         % (name, stats["mean"], stats["p50"], stats["p95"], stats["p99"]))
+        return "\n".join(lines)
+
+    def reset(self):
+        self.records.clear()
+        self.names = []
+        self.frameCount = 0
+
+
+profiler = Profiler()
+
+
+class ProfilerOverlay(GUIDivision):
+    # The profiler's report as on screen text, add it to a GUI like any other division and call update() once a
+    # frame. The text is only rebuilt every interval seconds so it stays readable
+
+    def __init__(self, font, profiler=profiler, interval=0.25, x=-0.98, y=0.95, scale=0.35, colour=(1, 1, 0)):
+        super().__init__(x, y, 0, 0)
+        self.profiler = profiler
+        self.interval = interval
+        self.lastUpdate = None
+        self.text = font.constructGuiText("", scale, 0.15, list(colour), capacity=512)
+        self.text.setPosition(x, y)
+        self.addComponent(self.text)
+
+    def update(self):
+        now = time.perf_counter()
+        if self.lastUpdate is not None and now - self.lastUpdate < self.interval:
+            return
+        self.lastUpdate = now
+        self.text.setText(self.profiler.report())
@@ -1,11 +1,16 @@
 import itertools
+import time
 
+import numpy as np
 import pyrr
 from OpenGL.GL import *
 
 import Reference
 from core import GUI
-from core.Loader import Shader
+from core.Culling import Frustum, FrustumCuller
+from core.LOD import LODSystem
+from core.Profiler import profiler
+from core.Loader import Shader, InstanceBuffer
 
 
 class Light:
@@ -19,46 +24,129 @@ class Light:
         self.attenuation = attenuation
 
 
-class EntityRenderer:
-    texturedEntityMap = {}
-    colouredEntities = []
+class RenderBatch:
+    # The entities drawn with one model, kept between frames. Removal swaps the last entity into the gap
+    # so both add and remove are O(1), the store rows are only regathered after a change
+
+    def __init__(self, model):
+        self.model = model
+        self.entities = []
+        self.indices = {}  # entity -> position in entities
+        self.rows = None
+
+    def add(self, entity):
+        self.indices[entity] = len(self.entities)
+        self.entities.append(entity)
+        self.rows = None
+
+    def remove(self, entity):
+        index = self.indices.pop(entity)
+        last = self.entities.pop()
+        if last is not entity:
+            self.entities[index] = last
+            self.indices[last] = index
+        self.rows = None
+
+    def getRows(self):
+        if self.rows is None:
+            self.rows = np.fromiter((entity.row for entity in self.entities), dtype=np.int64,
+                                    count=len(self.entities))
+        return self.rows
 
+    def __len__(self):
+        return len(self.entities)
+
+
+class EntityRenderer:
     MAX_LIGHTS = 4
 
     def __init__(self):
         self.entityShader = Shader("res/shaders/EntityShader.txt")
         self.texturedEntityShader = Shader("res/shaders/TexturedEntityShader.txt")
 
+        # last uploaded light arrays, see loadLights()
+        self.lightPositions = None
+        self.lightColours = None
+
+        # RawModel -> InstanceBuffer holding the model matrices of every textured entity drawn with it
+        self.instanceBuffers = {}
+
+        # Retained render queues: entities are registered once and stay queued until unregistered.
+        # model -> RenderBatch, with the draw order kept sorted by texture and VAO so binds are not repeated
+        self.texturedBatches = {}
+        self.colouredBatches = {}
+        self.texturedOrder = []
+        self.colouredOrder = []
+        # entity -> the model it was queued under, so a model change can be spotted and requeued
+        self.registered = {}
+
+        # View frustum culling, one FrustumCuller (spatial grid) per EntityStore. The visibility masks are
+        # worked out once per frame and store, the counts cover the last rendered frame
+        self.culling = True
+        self.frustum = Frustum()
+        self.cullers = {}
+        self.visibleMasks = {}
+        self.visibleCount = 0
+        self.culledCount = 0
+        # glBindTexture calls in the last frame, models sharing an atlas only need the first
+        self.textureBinds = 0
+        self.boundTexture = None
+
+    def registerEntity(self, entity):
+        if entity in self.registered:
+            return
+        model = entity.model
+        self.registered[entity] = model
+        batches = self.texturedBatches if entity.textured else self.colouredBatches
+        if model not in batches:
+            batches[model] = RenderBatch(model)
+            self.sortBatches()
+        batches[model].add(entity)
+
+    def unregisterEntity(self, entity):
+        if entity not in self.registered:
+            return
+        model = self.registered.pop(entity)
+        batches = self.texturedBatches if entity.textured else self.colouredBatches
+        batches[model].remove(entity)
+        if not batches[model]:
+            del batches[model]
+            self.sortBatches()
+
+    def updateEntity(self, entity):
+        # Call after entity.model changes, moves the entity to its new batch
+        if self.registered.get(entity) is not entity.model:
+            self.unregisterEntity(entity)
+            self.registerEntity(entity)
+
     def processEntity(self, entity):
-        if not entity.textured:
-            self.colouredEntities.append(entity)
-        else:
-            if entity.model in self.texturedEntityMap:
-                self.texturedEntityMap[entity.model].append(entity)
-            else:
-                self.texturedEntityMap[entity.model] = [entity]
+        # kept for old callers, registering twice does nothing
+        self.registerEntity(entity)
 
-    def loadLights(self, lights):
-        for i in range(self.MAX_LIGHTS):
-            if i < len(lights):
-                light = lights[i]
-                self.entityShader.bind()
-                self.entityShader.setUniform3f(f"lightPosition[{i}]", *light.position)
-                self.entityShader.setUniform3f(f"lightColour[{i}]", *light.colour)
-
-                self.texturedEntityShader.bind()
-                self.texturedEntityShader.setUniform3f(f"lightPosition[{i}]", *light.position)
-                self.texturedEntityShader.setUniform3f(f"lightColour[{i}]", *light.colour)
-                self.texturedEntityShader.unbind()
-            else:
-                self.entityShader.bind()
-                self.entityShader.setUniform3f(f"lightPosition[{i}]", 0, 0, 0)
-                self.entityShader.setUniform3f(f"lightColour[{i}]", 0, 0, 0)
+    def sortBatches(self):
+        self.texturedOrder = sorted(self.texturedBatches.values(),
+                                    key=lambda batch: (batch.model.texture.getID(), batch.model.rawModel.getID()))
+        self.colouredOrder = sorted(self.colouredBatches.values(), key=lambda batch: batch.model.getID())
 
-                self.texturedEntityShader.bind()
-                self.texturedEntityShader.setUniform3f(f"lightPosition[{i}]", 0, 0, 0)
-                self.texturedEntityShader.setUniform3f(f"lightColour[{i}]", 0, 0, 0)
-                self.texturedEntityShader.unbind()
+    def loadLights(self, lights):
+        # Every light array is uploaded with one call per shader, and only when the lights changed
+        positions = np.zeros((self.MAX_LIGHTS, 3), dtype=np.float32)
+        colours = np.zeros((self.MAX_LIGHTS, 3), dtype=np.float32)
+        for i, light in enumerate(lights[:self.MAX_LIGHTS]):
+            positions[i] = light.position
+            colours[i] = light.colour
+
+        if (self.lightPositions is not None and np.array_equal(positions, self.lightPositions)
+                and np.array_equal(colours, self.lightColours)):
+            return
+        self.lightPositions = positions
+        self.lightColours = colours
+
+        for shader in (self.entityShader, self.texturedEntityShader):
+            shader.bind()
+            shader.setUniform3fv("lightPosition", positions)
+            shader.setUniform3fv("lightColour", colours)
+            shader.unbind()
 
     def setup(self):
 
@@ -66,20 +154,84 @@ class EntityRenderer:
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
-    def renderEntity(self, entity):
-        self.entityShader.setUniformMat4fv("modelMatrix", entity.getModelMatrix())
-        self.entityShader.setUniform4f("colour", *entity.colour)
-        glBindVertexArray(entity.model.getID())
+    def getCuller(self, store):
+        if store not in self.cullers:
+            self.cullers[store] = FrustumCuller(store)
+        return self.cullers[store]
+
+    def cullBatch(self, batch):
+        # (store rows, positions in batch.entities) of the batch's entities the camera can see
+        rows = batch.getRows()
+        if not self.culling:
+            self.visibleCount += len(rows)
+            return rows, range(len(rows))
+
+        store = batch.entities[0].store
+        if store not in self.visibleMasks:
+            self.visibleMasks[store] = self.getCuller(store).getVisibleMask(self.frustum)
+        indices = np.flatnonzero(self.visibleMasks[store][rows])
+        self.visibleCount += len(indices)
+        self.culledCount += len(rows) - len(indices)
+        return rows[indices], indices
+
+    def getCullingStats(self):
+        # (visible, culled) entity counts of the last frame
+        return self.visibleCount, self.culledCount
+
+    def renderColouredBatch(self, batch):
+        rows, indices = self.cullBatch(batch)
+        if len(rows) == 0:
+            return
+
+        # the VAO is bound once, each entity only changes its model matrix and colour
+        glBindVertexArray(batch.model.getID())
         glEnableVertexAttribArray(0)
         glEnableVertexAttribArray(1)
         glEnableVertexAttribArray(2)
-        glDrawArrays(GL_TRIANGLES, 0, entity.model.getVertexCount())
+        matrices = batch.entities[0].store.getModelMatrices(rows)
+        for index, matrix in zip(indices, matrices):
+            self.entityShader.setUniformMat4fv("modelMatrix", matrix)
+            self.entityShader.setUniform4f("colour", *batch.entities[index].colour)
+            self.drawModel(batch.model)
+
+    def drawModel(self, rawModel, instances=None):
+        if instances is not None:
+            if rawModel.indexType is not None:
+                glDrawElementsInstanced(GL_TRIANGLES, rawModel.getVertexCount(), rawModel.indexType, None, instances)
+            else:
+                glDrawArraysInstanced(GL_TRIANGLES, 0, rawModel.getVertexCount(), instances)
+        elif rawModel.indexType is not None:
+            glDrawElements(GL_TRIANGLES, rawModel.getVertexCount(), rawModel.indexType, None)
+        else:
+            glDrawArrays(GL_TRIANGLES, 0, rawModel.getVertexCount())
+
+    def getInstanceBuffer(self, rawModel):
+        if rawModel not in self.instanceBuffers:
+            self.instanceBuffers[rawModel] = InstanceBuffer(rawModel)
+            # the buffer goes with the model's VAO
+            rawModel.vao.onDelete.append(lambda vao: self.deleteInstanceBuffer(rawModel))
+        return self.instanceBuffers[rawModel]
+
+    def deleteInstanceBuffer(self, rawModel):
+        instanceBuffer = self.instanceBuffers.pop(rawModel, None)
+        if instanceBuffer is not None:
+            instanceBuffer.delete()
+
+    def cleanUp(self):
+        for rawModel in list(self.instanceBuffers):
+            self.deleteInstanceBuffer(rawModel)
+        self.entityShader.release()
+        self.texturedEntityShader.release()
 
     def setupTexturedModel(self, model):
-        glBindTexture(GL_TEXTURE_2D, model.texture.getID())
+        # batches are sorted by texture, so the texture and its material only change between runs of batches
+        if model.texture is not self.boundTexture:
+            glBindTexture(GL_TEXTURE_2D, model.texture.getID())
+            self.texturedEntityShader.setUniform1f("shineDamper", model.texture.shineDamper)
+            self.texturedEntityShader.setUniform1f("reflectivity", model.texture.reflectivity)
+            self.boundTexture = model.texture
+            self.textureBinds += 1
         glBindVertexArray(model.rawModel.getID())
-        self.texturedEntityShader.setUniform1f("shineDamper", model.texture.shineDamper)
-        self.texturedEntityShader.setUniform1f("reflectivity", model.texture.reflectivity)
         glEnableVertexAttribArray(0)
         glEnableVertexAttribArray(1)
         glEnableVertexAttribArray(2)
@@ -94,22 +246,27 @@ class EntityRenderer:
         glDisable(GL_DEPTH_TEST)
         glDisable(GL_BLEND)
 
-        self.texturedEntityMap = {}
-        self.colouredEntities = []
-
     def render(self, projectionMatrix, camera):
+        viewMatrix = camera.getViewMatrix()
+        self.frustum.update(projectionMatrix, viewMatrix)
+        self.visibleMasks = {}
+        self.visibleCount = 0
+        self.culledCount = 0
+        self.textureBinds = 0
+        self.boundTexture = None
+
         self.setup()
 
         self.entityShader.bind()
 
         # could have a separate method to optimise
         self.entityShader.setUniformMat4fv("projMatrix", projectionMatrix)
-        self.entityShader.setUniformMat4fv("viewMatrix", camera.getViewMatrix())
+        self.entityShader.setUniformMat4fv("viewMatrix", viewMatrix)
         self.entityShader.setUniform1f("shineDamper", 1)
         self.entityShader.setUniform1f("reflectivity", 0)
 
-        for entity in self.colouredEntities:
-            self.renderEntity(entity)
+        for batch in self.colouredOrder:
+            self.renderColouredBatch(batch)
 
         self.reset()
 
@@ -118,17 +275,24 @@ class EntityRenderer:
         self.texturedEntityShader.bind()
         # could have a separate method that could be called once to optimise
         self.texturedEntityShader.setUniformMat4fv("projMatrix", projectionMatrix)
-        self.texturedEntityShader.setUniformMat4fv("viewMatrix", camera.getViewMatrix())
+        self.texturedEntityShader.setUniformMat4fv("viewMatrix", viewMatrix)
 
         glActiveTexture(GL_TEXTURE0)
         self.texturedEntityShader.setUniform1i("textureSampler", 0)
 
-        for model in self.texturedEntityMap:
-            self.setupTexturedModel(model)
-            for entity in self.texturedEntityMap[model]:
-                self.texturedEntityShader.setUniformMat4fv("modelMatrix", entity.getModelMatrix())
+        # one instanced draw per model, the model matrices travel in a per-instance vertex buffer
+        for batch in self.texturedOrder:
+            rows, _ = self.cullBatch(batch)
+            if len(rows) == 0:
+                continue
+
+            model = batch.model
+            # entities drawn together share a store, their matrices come out of it in one vectorized pass
+            matrices = batch.entities[0].store.getModelMatrices(rows)
+            self.getInstanceBuffer(model.rawModel).upload(matrices)
 
-                glDrawArrays(GL_TRIANGLES, 0, model.rawModel.getVertexCount())
+            self.setupTexturedModel(model)
+            self.drawModel(model.rawModel, len(rows))
 
             self.reset()
 
@@ -144,6 +308,27 @@ class GUIRenderer:
         self.fontShader.setUniform2f("translation", 0.0, 0.0)
         self.fontShader.unbind()
 
+        # FontType -> GUI.TextBatch, all text of one font goes out in a single draw
+        self.textBatches = {}
+
+    def getTextBatch(self, font):
+        if font not in self.textBatches:
+            self.textBatches[font] = GUI.TextBatch(font)
+        return self.textBatches[font]
+
+    def removeText(self, text):
+        # frees the text's slot in its font's batch, see GUIText.remove()
+        textBatch = self.textBatches.get(text.font)
+        if textBatch is not None:
+            textBatch.release(text)
+
+    def cleanUp(self):
+        for textBatch in self.textBatches.values():
+            textBatch.delete()
+        self.textBatches = {}
+        self.GUIShader.release()
+        self.fontShader.release()
+
     def render(self, gui):
         components = gui.getComponents()
         components = list(itertools.chain(*components))
@@ -151,23 +336,23 @@ class GUIRenderer:
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
         glDisable(GL_DEPTH_TEST)
 
+        # group the texts by font, keeping the order fonts first appear in
+        texts = {}
         for component in components:
             if isinstance(component, GUI.GUIText):
-                self.fontShader.bind()
-                self.fontShader.setUniform3f("colour", *component.colour)
-                glActiveTexture(GL_TEXTURE0)
-                glBindTexture(GL_TEXTURE_2D, component.font.fontSheetTexture.getID())
-                glBindVertexArray(component.model.getID())
-                glEnableVertexAttribArray(0)
-                glEnableVertexAttribArray(1)
-                glDrawElements(GL_TRIANGLES, component.model.getVertexCount(), GL_UNSIGNED_BYTE, None)
+                texts.setdefault(component.font, []).append(component)
 
-        glDisableVertexAttribArray(0)
-        glDisableVertexAttribArray(1)
-        glBindVertexArray(0)
+        if texts:
+            self.fontShader.bind()
+            glActiveTexture(GL_TEXTURE0)
+            for font, fontTexts in texts.items():
+                glBindTexture(GL_TEXTURE_2D, font.fontSheetTexture.getID())
+                self.getTextBatch(font).draw(fontTexts)
+            self.fontShader.unbind()
 
         glDisable(GL_BLEND)
 
+
 class MasterRenderer:
     projectionMatrix = pyrr.matrix44.create_perspective_projection_matrix(
         Reference.CAMERA_FOV, Reference.WINDOW_WIDTH / Reference.WINDOW_HEIGHT, 0.1, 1000.0)
@@ -175,14 +360,92 @@ class MasterRenderer:
     def __init__(self):
         self.entityRenderer = EntityRenderer()
         self.guiRenderer = GUIRenderer()
-
-    def renderScene(self, camera, entities, islands, lights):
+        # entities with an lodModel switch model as the camera moves, and get requeued when they do
+        self.lodSystem = LODSystem(self.entityRenderer.updateEntity)
+
+    def registerEntity(self, entity):
+        if entity.lodModel is not None:
+            self.lodSystem.add(entity)
+        self.entityRenderer.registerEntity(entity)
+        entity.onModelChange = self.updateEntity
+
+    def unregisterEntity(self, entity):
+        if entity.lodModel is not None:
+            self.lodSystem.remove(entity)
+        self.entityRenderer.unregisterEntity(entity)
+        entity.onModelChange = None
+
+    def updateEntity(self, entity):
+        # Call after an entity's model changed outside the LODSystem, e.g. its placeholder was swapped for the
+        # loaded model. Entities that only gained an lodModel now join the LODSystem
+        if entity.lodModel is not None:
+            self.lodSystem.add(entity)
+        self.entityRenderer.updateEntity(entity)
+
+    def registerEntities(self, entities):
         for entity in entities:
-            self.entityRenderer.processEntity(entity)
+            self.registerEntity(entity)
+
+    def getCullingStats(self):
+        # (visible, culled) entity counts of the last renderScene()
+        return self.entityRenderer.getCullingStats()
 
+    @profiler.profiled("renderScene", gpu=True)
+    def renderScene(self, camera, lights):
+        # draws every registered entity, register them once with registerEntity() rather than every frame
+        self.lodSystem.update(camera.position)
         self.entityRenderer.loadLights(lights)
 
         self.entityRenderer.render(self.projectionMatrix, camera)
 
+    @profiler.profiled("renderGUI", gpu=True)
     def renderGUI(self, gui):
         self.guiRenderer.render(gui)
+
+    def cleanUp(self):
+        # the renderers' own GL objects, models and textures belong to whoever created them
+        self.entityRenderer.cleanUp()
+        self.guiRenderer.cleanUp()
+
+
+def benchmarkRenderQueues(masterRenderer, camera, lights, createEntity, counts=(100, 1000, 5000), frames=30):
+    # CPU ms per frame of rebuilding the queues every frame against the retained ones, returns
+    # {count: (rebuild ms, retained ms)}
+    renderer = masterRenderer.entityRenderer
+
+    def timeFrames(frame):
+        elapsed = 0
+        for _ in range(frames):
+            glFinish()
+            start = time.perf_counter()
+            frame()
+            elapsed += time.perf_counter() - start
+        glFinish()
+        return elapsed * 1000 / frames
+
+    results = {}
+    for count in counts:
+        entities = [createEntity() for _ in range(count)]
+        for i, entity in enumerate(entities):
+            entity.position = (i % 100 * 2.0, 0, -(i // 100) * 2.0)
+
+        # rebuilding: every entity is queued and dropped again each frame, as processEntity() used to
+        def rebuildFrame():
+            masterRenderer.registerEntities(entities)
+            masterRenderer.renderScene(camera, lights)
+            for entity in entities:
+                masterRenderer.unregisterEntity(entity)
+        rebuild = timeFrames(rebuildFrame)
+
+        # retained: queued once, each frame is draw submission only
+        masterRenderer.registerEntities(entities)
+        retained = timeFrames(lambda: masterRenderer.renderScene(camera, lights))
+
+        for entity in entities:
+            masterRenderer.unregisterEntity(entity)
+            entity.delete()
+
+        results[count] = (rebuild, retained)
+        print(f"{count:>6} entities: rebuild {rebuild:8.2f} ms/frame, retained {retained:8.2f} ms/frame "
+              f"({rebuild / retained:.1f}x)")
+    return results
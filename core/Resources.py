@@ -0,0 +1,164 @@
+from collections import OrderedDict
+
+from OpenGL.GL import *
+
+
+class GPUResource:
+    # one GL object, refs starts at 1 for whoever created it
+
+    def __init__(self, kind, ID, size=0, label=None):
+        self.kind = kind
+        self.ID = int(ID)
+        self.size = size
+        self.label = label
+        self.refs = 1
+        self.usage = None  # buffers only, their glBufferData usage
+        self.onDelete = []  # called with the resource once it is gone
+
+    def __repr__(self):
+        return "<%s %d %s %d bytes, %d refs>" % (self.kind, self.ID, self.label or "", self.size, self.refs)
+
+
+def deleteBuffer(ID):
+    glDeleteBuffers(1, [ID])
+
+
+DELETERS = {
+    "buffer": deleteBuffer,
+    "vertexArray": lambda ID: glDeleteVertexArrays(1, [ID]),
+    "texture": lambda ID: glDeleteTextures(1, [ID]),
+    "program": glDeleteProgram,
+    "framebuffer": lambda ID: glDeleteFramebuffers(1, [ID]),
+    "renderbuffer": lambda ID: glDeleteRenderbuffers(1, [ID]),
+    "query": lambda ID: glDeleteQueries(1, [ID]),
+}
+
+
+class ResourceRegistry:
+    # Every GL object the engine creates, reference counted. Released static buffers go to a pool keyed by
+    # size and usage and are reused instead of reallocated
+
+    POOLED_USAGES = (GL_STATIC_DRAW,)
+
+    def __init__(self, maxPooledBytes=64 * 2 ** 20):
+        self.live = OrderedDict()  # (kind, ID) -> GPUResource, in creation order
+        self.pool = OrderedDict()  # buffer ID -> (size, usage), oldest first
+        self.pooledBytes = 0
+        self.maxPooledBytes = maxPooledBytes
+        self.created = dict.fromkeys(DELETERS, 0)
+        self.deleted = dict.fromkeys(DELETERS, 0)
+        self.reused = 0
+
+    def register(self, kind, ID, size=0, label=None):
+        resource = GPUResource(kind, ID, size, label)
+        self.live[(kind, resource.ID)] = resource
+        self.created[kind] += 1
+        return resource
+
+    def createBuffer(self, target, data=None, size=None, usage=GL_STATIC_DRAW, label=None):
+        # a buffer bound to target, taken from the pool when one of the same size and usage is there
+        size = data.nbytes if size is None else size
+        for ID, (pooledSize, pooledUsage) in self.pool.items():
+            if pooledSize == size and pooledUsage == usage:
+                del self.pool[ID]
+                self.pooledBytes -= size
+                self.reused += 1
+                glBindBuffer(target, ID)
+                if data is not None:
+                    glBufferSubData(target, 0, size, data)
+                resource = GPUResource("buffer", ID, size, label)
+                resource.usage = usage
+                self.live[("buffer", ID)] = resource
+                return resource
+
+        resource = self.register("buffer", glGenBuffers(1), size, label)
+        resource.usage = usage
+        glBindBuffer(target, resource.ID)
+        glBufferData(target, size, data, usage)
+        return resource
+
+    def resize(self, resource, size):
+        # call after glBufferData gave a buffer new storage
+        resource.size = size
+
+    def retain(self, resource):
+        resource.refs += 1
+        return resource
+
+    def release(self, resource):
+        # drops one reference, the object goes once none are left. Returns True if it did
+        if resource.refs <= 0:
+            return False
+        resource.refs -= 1
+        if resource.refs > 0:
+            return False
+        self.destroy(resource)
+        return True
+
+    def destroy(self, resource, pool=True):
+        if self.live.pop((resource.kind, resource.ID), None) is None:
+            return
+        if pool and resource.kind == "buffer" and resource.usage in self.POOLED_USAGES \
+                and resource.size <= self.maxPooledBytes:
+            self.pool[resource.ID] = (resource.size, resource.usage)
+            self.pooledBytes += resource.size
+            self.trimPool()
+        else:
+            DELETERS[resource.kind](resource.ID)
+            self.deleted[resource.kind] += 1
+        for callback in resource.onDelete:
+            callback(resource)
+
+    def trimPool(self, maxBytes=None):
+        maxBytes = self.maxPooledBytes if maxBytes is None else maxBytes
+        while self.pooledBytes > maxBytes:
+            ID, (size, _) = self.pool.popitem(last=False)
+            deleteBuffer(ID)
+            self.deleted["buffer"] += 1
+            self.pooledBytes -= size
+
+    def releaseAll(self):
+        # deletes everything, returns what still had references
+        leaked = [resource for resource in self.live.values() if resource.refs > 0]
+        for resource in reversed(list(self.live.values())):
+            self.destroy(resource, pool=False)
+        self.trimPool(0)
+        return leaked
+
+    def getCounts(self):
+        counts = dict.fromkeys(DELETERS, 0)
+        for kind, _ in self.live:
+            counts[kind] += 1
+        return counts
+
+    def getMemory(self):
+        # live GPU bytes per kind, pooled buffers not included
+        memory = dict.fromkeys(DELETERS, 0)
+        for resource in self.live.values():
+            memory[resource.kind] += resource.size
+        return memory
+
+    def report(self):
+        counts = self.getCounts()
+        memory = self.getMemory()
+        lines = ["%s: %d live, %.2f MiB" % (kind, counts[kind], memory[kind] / 2 ** 20)
+                 for kind in DELETERS if counts[kind]]
+        lines.append("buffer pool: %d buffers, %.2f MiB, %d reused" % (len(self.pool), self.pooledBytes / 2 ** 20,
+                                                                     self.reused))
+        return "\n".join(lines)
+
+
+resources = ResourceRegistry()
+
+
+def benchmarkSceneReloads(loadScene, unloadScene, reloads=10, registry=resources):
+    # Loads and unloads a scene repeatedly, printing live GPU memory and objects created, which should stay
+    # flat. Returns the live bytes after each unload
+    liveBytes = []
+    for reload in range(reloads):
+        unloadScene(loadScene())
+        live = sum(registry.getMemory().values())
+        liveBytes.append(live)
+        print(f"reload {reload + 1:>3}: {live / 2 ** 20:8.2f} MiB live, {registry.pooledBytes / 2 ** 20:8.2f} MiB "
+              f"pooled, {sum(registry.created.values())} objects created, {registry.reused} buffers reused")
+    return liveBytes
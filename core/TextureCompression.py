@@ -0,0 +1,159 @@
+import numpy as np
+
+# Mip chains and S3TC block compression on (height, width, 4) uint8 RGBA arrays
+
+# bytes per 4x4 block
+BLOCK_BYTES = {"bc1": 8, "bc3": 16}
+
+
+def generateMipmaps(pixels):
+    # every level down to 1x1 like glGenerateMipmap, averaged from the float level above
+    levels = [pixels]
+    level = pixels.astype(np.float32)
+    while level.shape[0] > 1 or level.shape[1] > 1:
+        height, width = level.shape[:2]
+        if height > 1:
+            even = height // 2 * 2
+            level = (level[0:even:2] + level[1:even:2]) / 2
+        if width > 1:
+            even = width // 2 * 2
+            level = (level[:, 0:even:2] + level[:, 1:even:2]) / 2
+        levels.append((level + 0.5).astype(np.uint8))
+    return levels
+
+
+def compressedSize(width, height, compression):
+    return -(-width // 4) * -(-height // 4) * BLOCK_BYTES[compression]
+
+
+def toBlocks(pixels):
+    # (blocks, 16, 4) float32, sizes that aren't a multiple of 4 repeat the edge texels
+    height, width = pixels.shape[:2]
+    paddedHeight, paddedWidth = -(-height // 4) * 4, -(-width // 4) * 4
+    pixels = np.pad(pixels, ((0, paddedHeight - height), (0, paddedWidth - width), (0, 0)), mode="edge")
+    blocks = pixels.reshape(paddedHeight // 4, 4, paddedWidth // 4, 4, 4).transpose(0, 2, 1, 3, 4)
+    return blocks.reshape(-1, 16, 4).astype(np.float32)
+
+
+def packRGB565(colours):
+    colours = np.clip(np.rint(colours * np.array([31, 63, 31]) / 255), 0, [31, 63, 31]).astype(np.uint16)
+    return (colours[:, 0] << 11) | (colours[:, 1] << 5) | colours[:, 2]
+
+
+def unpackRGB565(packed):
+    packed = packed.astype(np.uint32)
+    red = (packed >> 11) & 31
+    green = (packed >> 5) & 63
+    blue = packed & 31
+    return np.stack((red * 255 // 31, green * 255 // 63, blue * 255 // 31), axis=-1).astype(np.float32)
+
+
+def packIndices(indices, bits):
+    # indices (blocks, 16) into one little endian integer per block, texel i at bit i * bits
+    shifts = np.arange(16, dtype=np.uint64) * np.uint64(bits)
+    return (indices.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+
+
+def encodeColourBlocks(colours):
+    # BC1 colours of (blocks, 16, 3) texels, endpoints on each block's principal axis
+    mean = colours.mean(axis=1, keepdims=True)
+    centred = colours - mean
+    covariance = np.einsum("bki,bkj->bij", centred, centred)
+    axis = centred.max(axis=1) - centred.min(axis=1)
+    for _ in range(4):
+        axis = np.einsum("bij,bj->bi", covariance, axis)
+        axis /= np.maximum(np.linalg.norm(axis, axis=1, keepdims=True), 1e-6)
+    projections = np.einsum("bki,bi->bk", centred, axis)
+    low, high = projections.min(axis=1), projections.max(axis=1)
+    inset = (high - low) / 16
+    endpoint0 = mean[:, 0] + axis * (high - inset)[:, None]
+    endpoint1 = mean[:, 0] + axis * (low + inset)[:, None]
+
+    colour0 = packRGB565(endpoint0)
+    colour1 = packRGB565(endpoint1)
+    # four colour mode needs colour0 > colour1, equal endpoints make a flat block where index 0 is enough
+    swap = colour0 < colour1
+    colour0, colour1 = np.where(swap, colour1, colour0), np.where(swap, colour0, colour1)
+
+    first, second = unpackRGB565(colour0), unpackRGB565(colour1)
+    palette = np.stack((first, second, (2 * first + second) / 3, (first + 2 * second) / 3), axis=1)
+    distances = ((colours[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(axis=3)
+    indices = distances.argmin(axis=2)
+    indices[colour0 == colour1] = 0
+
+    encoded = np.zeros((len(colours), 8), dtype=np.uint8)
+    encoded[:, 0:2] = colour0.astype("<u2").view(np.uint8).reshape(-1, 2)
+    encoded[:, 2:4] = colour1.astype("<u2").view(np.uint8).reshape(-1, 2)
+    encoded[:, 4:8] = packIndices(indices, 2).astype("<u4").view(np.uint8).reshape(-1, 4)
+    return encoded
+
+
+def encodeAlphaBlocks(alphas):
+    # BC3 alphas of (blocks, 16) alphas, in the 8 value mode between the block's max and min
+    alpha0 = alphas.max(axis=1).astype(np.int64)
+    alpha1 = alphas.min(axis=1).astype(np.int64)
+    steps = np.arange(1, 7)
+    between = ((7 - steps) * alpha0[:, None] + steps * alpha1[:, None]) // 7
+    palette = np.concatenate((alpha0[:, None], alpha1[:, None], between), axis=1)
+    indices = np.abs(alphas[:, :, None] - palette[:, None, :]).argmin(axis=2)
+    indices[alpha0 == alpha1] = 0
+
+    encoded = np.zeros((len(alphas), 8), dtype=np.uint8)
+    encoded[:, 0] = alpha0
+    encoded[:, 1] = alpha1
+    encoded[:, 2:8] = packIndices(indices, 3).astype("<u8").view(np.uint8).reshape(-1, 8)[:, :6]
+    return encoded
+
+
+def encodeBC1(pixels):
+    # opaque DXT1, alpha is ignored
+    return encodeColourBlocks(toBlocks(pixels)[:, :, :3]).reshape(-1)
+
+
+def encodeBC3(pixels):
+    # DXT5, interpolated alpha followed by a BC1 colour block
+    blocks = toBlocks(pixels)
+    return np.concatenate((encodeAlphaBlocks(blocks[:, :, 3]), encodeColourBlocks(blocks[:, :, :3])),
+                          axis=1).reshape(-1)
+
+
+ENCODERS = {"bc1": encodeBC1, "bc3": encodeBC3}
+
+
+def chooseCompression(pixels, compression):
+    # "auto" keeps opaque images at BC1's 4 bits per texel and gives anything with alpha BC3
+    if compression == "auto":
+        return "bc1" if (pixels[:, :, 3] == 255).all() else "bc3"
+    if compression is not None and compression not in ENCODERS:
+        raise ValueError("Unknown texture compression: %s" % compression)
+    return compression
+
+
+def encodeLevel(pixels, compression=None):
+    return ENCODERS[compression](pixels) if compression else np.ascontiguousarray(pixels).reshape(-1)
+
+
+def encodeLevels(pixels, compression=None, mipmaps=True):
+    # [(width, height, uint8 array)]
+    levels = generateMipmaps(pixels) if mipmaps else [pixels]
+    return [(level.shape[1], level.shape[0], encodeLevel(level, compression)) for level in levels]
+
+
+if __name__ == "__main__":
+    # python -m core.TextureCompression res/textures/*.png --compression auto
+    import argparse
+
+    from core.Loader import preprocessTexture
+
+    parser = argparse.ArgumentParser(description="Write mipmapped (and optionally compressed) textures to the cache")
+    parser.add_argument("textures", nargs="+")
+    parser.add_argument("--compression", choices=("none", "bc1", "bc3", "auto"), default="none")
+    parser.add_argument("--no-flip", action="store_true", help="for textures loaded with flipped=False (fonts)")
+    parser.add_argument("--no-mipmaps", action="store_true")
+    arguments = parser.parse_args()
+    for texture in arguments.textures:
+        levels = preprocessTexture(texture, not arguments.no_flip,
+                                   None if arguments.compression == "none" else arguments.compression,
+                                   not arguments.no_mipmaps)
+        print("%s: %s, %d levels, %d bytes" % (texture, levels.format, len(levels.data),
+                                               sum(data.nbytes for data in levels.data)))
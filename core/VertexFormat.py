@@ -0,0 +1,96 @@
+import ctypes
+from collections import namedtuple
+
+import numpy as np
+from OpenGL.GL import *
+
+# One vertex attribute: the shader location it feeds, how many components the source data has per vertex and how
+# they are stored, one of ATTRIBUTE_KINDS
+VertexAttribute = namedtuple("VertexAttribute", ["name", "location", "size", "kind"])
+
+# kind -> (GL type, normalized, bytes per component, or None for packed kinds which take 4 bytes in all)
+ATTRIBUTE_KINDS = {
+    "float": (GL_FLOAT, GL_FALSE, 4),
+    "half": (GL_HALF_FLOAT, GL_FALSE, 2),
+    # xyz as signed normalized 10 bit integers in one 32 bit word, for unit vectors such as normals
+    "int2101010": (GL_INT_2_10_10_10_REV, GL_TRUE, None),
+}
+
+
+def packInt2101010(vectors):
+    # (n, 3) floats in [-1, 1] into GL_INT_2_10_10_10_REV words: x in the low 10 bits, then y and z, w left 0
+    components = np.rint(np.clip(vectors, -1, 1) * 511).astype(np.int32) & 0x3FF
+    return components[:, 0] | (components[:, 1] << 10) | (components[:, 2] << 20)
+
+
+def unpackInt2101010(packed):
+    # back to (n, 3) floats, the way GL reads them
+    shifts = np.array([0, 10, 20], dtype=np.int32)
+    components = (packed[:, None].astype(np.int32) >> shifts) & 0x3FF
+    components = np.where(components >= 512, components - 1024, components)
+    return np.maximum(components / 511, -1).astype(np.float32)
+
+
+class VertexFormat:
+    # the layout of an interleaved vertex buffer, each attribute 4 byte aligned
+
+    def __init__(self, attributes):
+        self.attributes = list(attributes)
+        names, formats, self.offsets = [], [], []
+        offset = 0
+        for attribute in self.attributes:
+            _, _, componentBytes = ATTRIBUTE_KINDS[attribute.kind]
+            if componentBytes is None:
+                formats.append("<i4")
+                size = 4
+            else:
+                formats.append(("<f%d" % componentBytes, (attribute.size,)))
+                size = componentBytes * attribute.size
+            names.append(attribute.name)
+            self.offsets.append(offset)
+            offset += -(-size // 4) * 4
+        self.stride = offset
+        self.dtype = np.dtype({"names": names, "formats": formats, "offsets": self.offsets, "itemsize": self.stride})
+
+    def pack(self, arrays):
+        # {attribute name: flat or (n, size) float array} -> (n,) structured array. Padding bytes are zeroed so the
+        # same data always packs to the same bytes
+        first = self.attributes[0]
+        count = np.asarray(arrays[first.name]).size // first.size
+        vertices = np.zeros(count, dtype=self.dtype)
+        for attribute in self.attributes:
+            data = np.asarray(arrays[attribute.name], dtype=np.float32).reshape(count, attribute.size)
+            if attribute.kind == "int2101010":
+                vertices[attribute.name] = packInt2101010(data)
+            else:
+                vertices[attribute.name] = data
+        return vertices
+
+    def setAttributePointers(self):
+        # with the VAO and the vertex buffer bound
+        for attribute, offset in zip(self.attributes, self.offsets):
+            glType, normalized, componentBytes = ATTRIBUTE_KINDS[attribute.kind]
+            # packed kinds always hand GL 4 components, the shader's vec3 ignores w
+            size = 4 if componentBytes is None else attribute.size
+            glVertexAttribPointer(attribute.location, size, glType, normalized, self.stride, ctypes.c_void_p(offset))
+
+
+VERTEX_FORMATS = {
+    # 32 bytes, exactly what the separate position, texture coordinate and normal buffers held
+    "float": VertexFormat([
+        VertexAttribute("position", 0, 3, "float"),
+        VertexAttribute("textureCoords", 1, 2, "float"),
+        VertexAttribute("normal", 2, 3, "float"),
+    ]),
+    # 20 bytes: half float texture coordinates (about 1/2048 steps below 1) and 10 bit normals
+    "packed": VertexFormat([
+        VertexAttribute("position", 0, 3, "float"),
+        VertexAttribute("textureCoords", 1, 2, "half"),
+        VertexAttribute("normal", 2, 3, "int2101010"),
+    ]),
+}
+
+
+def getVertexFormat(vertexFormat):
+    # a VertexFormat, or one of VERTEX_FORMATS by name
+    return VERTEX_FORMATS[vertexFormat] if isinstance(vertexFormat, str) else vertexFormat
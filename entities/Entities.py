@@ -1,37 +1,245 @@
-import numpy as np
-from pyrr import Vector3, matrix44
+from pyrr import Vector3
 
-from core.Loader import OBJModel, TextureAtlas, TexturedModel
+from core.Assets import getPlaceholderModel
+from core.AtlasPacking import buildAtlasLevels, buildTextureAtlas, createAtlasModel
+from core.LOD import LODModel
+from core.Loader import OBJModel, cachedObjects
+from entities.EntityStore import entityStore
+
+# every entity texture shares one atlas, so entity types draw without texture switches
+ENTITY_TEXTURES = {
+    "tree": "res/textures/tree.png",
+    "lowPolyTree": "res/textures/lowPolyTree.png",
+}
+ENTITY_ATLAS_COMPRESSION = "auto"
+entityAtlas = None
+
+
+def loadEntityAtlasLevels():
+    return buildAtlasLevels(ENTITY_TEXTURES, compression=ENTITY_ATLAS_COMPRESSION)
+
+
+def createEntityAtlas(built):
+    global entityAtlas
+    if entityAtlas is None:
+        entityAtlas = buildTextureAtlas(ENTITY_TEXTURES, built=built)
+        # material of every model drawn from the atlas
+        entityAtlas.reflectivity = 0.1
+        entityAtlas.shineDamper = 0.8
+    return entityAtlas
+
+
+def getEntityAtlas(assets=None):
+    if assets is not None:
+        if entityAtlas is not None:
+            return assets.ready("entityAtlas", entityAtlas)
+        return assets.load("entityAtlas", loadEntityAtlasLevels, upload=createEntityAtlas)
+    return createEntityAtlas(loadEntityAtlasLevels())
+
+
+def releaseSharedModels(assets=None):
+    # Gives back the models and atlas shared by each entity type, unregister their entities first
+    global entityAtlas
+    if Ellipsoid.rawModel is not None:
+        Ellipsoid.rawModel.release()
+        Ellipsoid.rawModel = None
+    if Tree.lodModel is not None:
+        for model in Tree.lodModel.models:
+            model.release()
+        Tree.lodModel = None
+        Tree.mesh = None
+    if LowPolyTree.texturedModel is not None:
+        LowPolyTree.texturedModel.release()
+        LowPolyTree.texturedModel = None
+    if entityAtlas is not None:
+        entityAtlas.release()
+        entityAtlas = None
+    if assets is not None:
+        assets.forget("Ellipsoid", "Tree", "LowPolyTree", "entityAtlas")
 
 
 class Entity:
+    # a view onto one row of an EntityStore
 
-    position = Vector3([0, 0, 0])  # xyz
     textured = True
+    lodModel = None
+    # set by the MasterRenderer, called when loaded assets swap the model
+    onModelChange = None
+    deleted = False
+
+    def __init__(self, model=None, store=None):
+        self.store = entityStore if store is None else store
+        self.model = model
+        self.row = self.store.add(model, self.getTextureID())
+
+    def getTextureID(self):
+        if self.textured and self.model is not None:
+            return self.model.texture.getID()
+        return -1
+
+    def setModel(self, model):
+        self.model = model
+        self.store.setModel(self.row, model, self.getTextureID())
+
+    def setLoadedModel(self, model):
+        if self.deleted:
+            # the row may belong to another entity by now
+            return
+        self.setModel(model)
+        if self.onModelChange is not None:
+            self.onModelChange(self)
+
+    @property
+    def position(self):  # xyz
+        return self.store.positions[self.row].view(Vector3)
+
+    @position.setter
+    def position(self, value):
+        self.store.positions[self.row] = value
+
+    @property
+    def scale(self):  # xyz
+        return self.store.scales[self.row].view(Vector3)
+
+    @scale.setter
+    def scale(self, value):
+        self.store.scales[self.row] = value
+
+    @property
+    def rotation(self):  # euler angles in radians about x, y, z
+        return self.store.rotations[self.row].view(Vector3)
+
+    @rotation.setter
+    def rotation(self, value):
+        self.store.rotations[self.row] = value
 
     def getModelMatrix(self):
-        return matrix44.create_from_translation(self.position)
+        return self.store.getModelMatrix(self.row)
+
+    def delete(self):
+        self.store.remove(self.row)
+        self.deleted = True
 
 
 class Ellipsoid(Entity):
-    radius = [1, 1, 1]  # xyz
     colour = [.1, 0.2, .4, 1]  # rgba
     textured = False
 
-    def __init__(self):
-        self.mesh = OBJModel.importFile("res/models/UnitSphere.obj")
-        self.model = self.mesh.createRawModel()
+    # ray traced material
+    specular = 0.5
+    shininess = 32
 
-    def getModelMatrix(self):
-        return matrix44.create_from_translation(self.position) * matrix44.create_from_scale(np.array(self.radius))
+    # shared by every ellipsoid
+    rawModel = None
+    MODEL_PATH = "res/models/UnitSphere.obj"
+
+    def __init__(self, store=None, assets=None):
+        if Ellipsoid.rawModel is None and assets is not None:
+            self.mesh = None
+            super().__init__(getPlaceholderModel(textured=False), store)
+            Ellipsoid.loadAsync(assets).then(self.onAssetsLoaded)
+            return
+        self.mesh = OBJModel.importFile(self.MODEL_PATH, indexed=True)
+        if Ellipsoid.rawModel is None:
+            Ellipsoid.rawModel = self.mesh.createRawModel()
+        super().__init__(Ellipsoid.rawModel, store)
+
+    @classmethod
+    def loadAsync(cls, assets):
+        def build(mesh):
+            if cls.rawModel is None:
+                cls.rawModel = mesh.createRawModel()
+            return mesh
+        return assets.combine("Ellipsoid", [assets.loadOBJ(cls.MODEL_PATH, indexed=True)], build)
+
+    def onAssetsLoaded(self, mesh):
+        self.mesh = mesh
+        self.setLoadedModel(Ellipsoid.rawModel)
+
+    # the radii are the entity's scale
+    @property
+    def radius(self):  # xyz
+        return self.scale
+
+    @radius.setter
+    def radius(self, value):
+        self.scale = value
+
+
+def loadLODMeshes(filepath, resolutions, mesh=None):
+    # the full mesh followed by one simplified copy per resolution
+    if mesh is None:
+        mesh = OBJModel(filepath, indexed=True)
+    return [mesh] + [mesh.simplify(resolution) for resolution in resolutions]
+
+
+def cacheLODMeshes(filepath, meshes):
+    # only on the GL thread, like AssetManager.loadOBJ()
+    meshes[0] = cachedObjects.setdefault((filepath, True), meshes[0])
+    return meshes
 
 
 class Tree(Entity):
+    # Shared by every tree so they batch into one instanced draw, further out come vertex clustered copies
+    LOD_RESOLUTIONS = (8, 4)
+    LOD_SCREEN_SIZES = (0.08, 0.03)
+    MODEL_PATH = "res/models/tree.obj"
+    TEXTURE_NAME = "tree"
+    mesh = None
+
+    def __init__(self, store=None, assets=None):
+        # with an AssetManager a placeholder is drawn until the assets are loaded
+        if Tree.lodModel is None and assets is not None:
+            super().__init__(getPlaceholderModel(textured=True), store)
+            Tree.loadAsync(assets).then(self.onAssetsLoaded)
+            return
+        if Tree.lodModel is None:
+            meshes = loadLODMeshes(self.MODEL_PATH, self.LOD_RESOLUTIONS, cachedObjects.get((self.MODEL_PATH, True)))
+            Tree.createLODModel(cacheLODMeshes(self.MODEL_PATH, meshes), getEntityAtlas())
+        super().__init__(Tree.lodModel.models[0], store)
+
+    @classmethod
+    def createLODModel(cls, meshes, atlas):
+        if cls.lodModel is None:
+            cls.mesh = meshes[0]
+            cls.lodModel = LODModel([createAtlasModel(mesh, atlas, cls.TEXTURE_NAME) for mesh in meshes],
+                                    cls.LOD_SCREEN_SIZES)
+        return cls.lodModel
+
+    @classmethod
+    def loadAsync(cls, assets):
+        meshes = assets.load("Tree.meshes", loadLODMeshes, cls.MODEL_PATH, cls.LOD_RESOLUTIONS,
+                             cachedObjects.get((cls.MODEL_PATH, True)),
+                             upload=lambda meshes: cacheLODMeshes(cls.MODEL_PATH, meshes))
+        return assets.combine("Tree", [meshes, getEntityAtlas(assets)], cls.createLODModel)
+
+    def onAssetsLoaded(self, lodModel):
+        self.setLoadedModel(lodModel.models[0])
+
+
+class LowPolyTree(Entity):
+    # a larger, low poly tree, textured from the same atlas as Tree
+    MODEL_PATH = "res/models/lowPolyTree.obj"
+    TEXTURE_NAME = "lowPolyTree"
+    # shared by every low poly tree
+    texturedModel = None
+
+    def __init__(self, store=None, assets=None):
+        if LowPolyTree.texturedModel is None and assets is not None:
+            super().__init__(getPlaceholderModel(textured=True), store)
+            LowPolyTree.loadAsync(assets).then(self.setLoadedModel)
+            return
+        if LowPolyTree.texturedModel is None:
+            LowPolyTree.createModel(OBJModel.importFile(self.MODEL_PATH, indexed=True), getEntityAtlas())
+        super().__init__(LowPolyTree.texturedModel, store)
 
-    def __init__(self):
-        texture = TextureAtlas.importFile("res/textures/tree.png", 1)
-        texture.reflectivity = 0.1
-        texture.shineDamper = 0.8
-        self.mesh = OBJModel.importFile("res/models/tree.obj")
-        self.model = TexturedModel(self.mesh.createRawModel(), texture)
+    @classmethod
+    def createModel(cls, mesh, atlas):
+        if cls.texturedModel is None:
+            cls.texturedModel = createAtlasModel(mesh, atlas, cls.TEXTURE_NAME)
+        return cls.texturedModel
 
+    @classmethod
+    def loadAsync(cls, assets):
+        return assets.combine("LowPolyTree", [assets.loadOBJ(cls.MODEL_PATH, indexed=True), getEntityAtlas(assets)],
+                              cls.createModel)
@@ -0,0 +1,182 @@
+import numpy as np
+
+
+class EntityStore:
+    # Structure-of-arrays storage, one row per entity, with model matrices cached per row. Growing reallocates
+    # the arrays, so never hold on to a row view across add() calls
+
+    def __init__(self, capacity=64):
+        self.count = 0  # rows in use, including freed ones below the high water mark
+        self.freeRows = []
+
+        self.positions = np.zeros((capacity, 3), dtype=np.float32)
+        self.scales = np.ones((capacity, 3), dtype=np.float32)
+        # euler angles in radians, applied roll (z), then pitch (x), then yaw (y)
+        self.rotations = np.zeros((capacity, 3), dtype=np.float32)
+
+        self.modelIDs = np.full(capacity, -1, dtype=np.int32)
+        self.textureIDs = np.full(capacity, -1, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+
+        # pyrr layout (row vectors, translation in the last row), which GL reads as column-major
+        self.modelMatrices = np.tile(np.identity(4, dtype=np.float32), (capacity, 1, 1))
+        # transforms the cached matrices were built from, compared to find changed rows
+        self.builtTransforms = np.full((capacity, 9), np.nan, dtype=np.float32)
+
+        # model space bounding sphere of each row's model, an infinite radius means no bounds (never culled)
+        self.boundCentres = np.zeros((capacity, 3), dtype=np.float32)
+        self.boundRadii = np.full(capacity, np.inf, dtype=np.float32)
+
+        # goes up whenever a row's matrix or bounds change, so spatial structures know to rebuild
+        self.version = 0
+
+        # handle -> object tables for modelIDs. A handle is dropped (and reused) once no row uses its model, so
+        # released models aren't kept alive by the store
+        self.models = []
+        self.modelHandles = {}
+        self.modelRowCounts = []
+        self.freeModelHandles = []
+
+    def grow(self, capacity):
+        def resize(array, fill):
+            grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            grown[len(array):] = fill
+            return grown
+
+        self.positions = resize(self.positions, 0)
+        self.scales = resize(self.scales, 1)
+        self.rotations = resize(self.rotations, 0)
+        self.modelIDs = resize(self.modelIDs, -1)
+        self.textureIDs = resize(self.textureIDs, -1)
+        self.alive = resize(self.alive, False)
+        self.modelMatrices = resize(self.modelMatrices, np.identity(4, dtype=np.float32))
+        self.builtTransforms = resize(self.builtTransforms, np.nan)
+        self.boundCentres = resize(self.boundCentres, 0)
+        self.boundRadii = resize(self.boundRadii, np.inf)
+
+    def getModelHandle(self, model):
+        if model is None:
+            return -1
+        if model not in self.modelHandles:
+            if self.freeModelHandles:
+                handle = self.freeModelHandles.pop()
+                self.models[handle] = model
+            else:
+                handle = len(self.models)
+                self.models.append(model)
+                self.modelRowCounts.append(0)
+            self.modelHandles[model] = handle
+        return self.modelHandles[model]
+
+    def releaseModelHandle(self, handle):
+        # one row less uses the handle's model
+        if handle < 0:
+            return
+        self.modelRowCounts[handle] -= 1
+        if self.modelRowCounts[handle] == 0:
+            del self.modelHandles[self.models[handle]]
+            self.models[handle] = None
+            self.freeModelHandles.append(handle)
+
+    def add(self, model=None, textureID=-1):
+        if self.freeRows:
+            row = self.freeRows.pop()
+        else:
+            if self.count == len(self.alive):
+                self.grow(2 * len(self.alive))
+            row = self.count
+            self.count += 1
+
+        self.positions[row] = 0
+        self.scales[row] = 1
+        self.rotations[row] = 0
+        self.alive[row] = True
+        self.builtTransforms[row] = np.nan
+        self.setModel(row, model, textureID)
+        return row
+
+    def remove(self, row):
+        self.alive[row] = False
+        self.releaseModelHandle(int(self.modelIDs[row]))
+        self.modelIDs[row] = -1
+        self.freeRows.append(row)
+        self.version += 1
+
+    def setModel(self, row, model, textureID=-1):
+        handle = self.getModelHandle(model)
+        if handle >= 0:
+            self.modelRowCounts[handle] += 1
+        # after counting the new handle, so setting the same model again never drops it
+        self.releaseModelHandle(int(self.modelIDs[row]))
+        self.modelIDs[row] = handle
+        self.textureIDs[row] = textureID
+
+        bounds = getattr(model, "bounds", None)
+        if bounds is None:
+            self.boundCentres[row] = 0
+            self.boundRadii[row] = np.inf
+        else:
+            self.boundCentres[row] = bounds.centre
+            self.boundRadii[row] = bounds.radius
+        self.version += 1
+
+    def transforms(self, rows):
+        return np.concatenate((self.positions[rows], self.scales[rows], self.rotations[rows]), axis=1)
+
+    def buildMatrices(self, rows):
+        # model = scale * rotation * translation in pyrr's row-vector convention
+        if len(rows) == 0:
+            return
+        sx, sy, sz = np.sin(self.rotations[rows]).T
+        cx, cy, cz = np.cos(self.rotations[rows]).T
+
+        # column-vector rotation R = Ry * Rx * Rz, stored transposed for row vectors
+        rotation = np.empty((len(rows), 3, 3), dtype=np.float32)
+        rotation[:, 0, 0] = cy * cz + sy * sx * sz
+        rotation[:, 1, 0] = -cy * sz + sy * sx * cz
+        rotation[:, 2, 0] = sy * cx
+        rotation[:, 0, 1] = cx * sz
+        rotation[:, 1, 1] = cx * cz
+        rotation[:, 2, 1] = -sx
+        rotation[:, 0, 2] = -sy * cz + cy * sx * sz
+        rotation[:, 1, 2] = sy * sz + cy * sx * cz
+        rotation[:, 2, 2] = cy * cx
+
+        matrices = np.zeros((len(rows), 4, 4), dtype=np.float32)
+        matrices[:, :3, :3] = self.scales[rows][:, :, None] * rotation
+        matrices[:, 3, :3] = self.positions[rows]
+        matrices[:, 3, 3] = 1.0
+
+        self.modelMatrices[rows] = matrices
+        self.builtTransforms[rows] = self.transforms(rows)
+        self.version += 1
+
+    def updateMatrices(self, rows=None):
+        # Rebuilds the cached matrices of the given rows (default: every live row) whose transform changed
+        if rows is None:
+            rows = np.flatnonzero(self.alive[:self.count])
+        rows = np.asarray(rows, dtype=np.int64)
+        dirty = (self.transforms(rows) != self.builtTransforms[rows]).any(axis=1)
+        self.buildMatrices(rows[dirty])
+
+    def getModelMatrices(self, rows):
+        # (len(rows), 4, 4) float32 model matrices, up to date
+        self.updateMatrices(rows)
+        return self.modelMatrices[rows]
+
+    def getWorldSpheres(self, rows):
+        # world space bounding spheres of the given rows as (centres, radii)
+        self.updateMatrices(rows)
+        matrices = self.modelMatrices[rows]
+        # row vector convention, centre' = (centre, 1) * M
+        centres = np.einsum("ni,nij->nj", self.boundCentres[rows], matrices[:, :3, :3]) + matrices[:, 3, :3]
+        radii = self.boundRadii[rows] * np.abs(self.scales[rows]).max(axis=1)
+        return centres, radii
+
+    def getModelMatrix(self, row):
+        self.updateMatrices([row])
+        return self.modelMatrices[row]
+
+
+entityStore = EntityStore()
@@ -0,0 +1,247 @@
+import numpy as np
+
+EPSILON = 1e-7
+
+
+def surfaceArea(bmin, bmax):
+    extent = bmax - bmin
+    return 2.0 * (extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0])
+
+
+class BVH:
+    # Binned SAH BVH flattened depth-first, the left child is the next node. nodeOffset is the right child of
+    # interior nodes and the first triangle of leaves (nodeCount > 0)
+
+    SAH_BINS = 12
+    MAX_LEAF_SIZE = 8
+    TRAVERSAL_COST = 1.0
+    INTERSECTION_COST = 1.0
+
+    # rays traced at once, bounds the size of the (ray, node) work lists
+    BATCH_SIZE = 1 << 16
+
+    def __init__(self, triangles):
+        triangles = np.ascontiguousarray(triangles, dtype=np.float32).reshape(-1, 3, 3)
+
+        self.build(triangles)
+
+        # triangles are stored in leaf order, triIndices maps back to the original order
+        self.triangles = triangles[self.triIndices]
+        self.v0 = np.ascontiguousarray(self.triangles[:, 0])
+        self.edge1 = self.triangles[:, 1] - self.triangles[:, 0]
+        self.edge2 = self.triangles[:, 2] - self.triangles[:, 0]
+
+    @classmethod
+    def fromOBJModel(cls, model):
+        return cls(model.getTriangles())
+
+    def build(self, triangles):
+        triMin = triangles.min(axis=1)
+        triMax = triangles.max(axis=1)
+        centroids = (triMin + triMax) * 0.5
+
+        order = np.arange(len(triangles), dtype=np.int32)
+
+        nodeMin = []
+        nodeMax = []
+        nodeOffset = []
+        nodeCount = []
+
+        # (start, end, parent) - children of a split are pushed right first so the left child is allocated next
+        stack = [(0, len(triangles), -1)]
+        while stack:
+            start, end, parent = stack.pop()
+            nodeIndex = len(nodeMin)
+            if parent >= 0:
+                nodeOffset[parent] = nodeIndex
+
+            indices = order[start:end]
+            bmin = triMin[indices].min(axis=0)
+            bmax = triMax[indices].max(axis=0)
+            nodeMin.append(bmin)
+            nodeMax.append(bmax)
+
+            split = self.findSplit(indices, centroids, triMin, triMax, bmin, bmax)
+            if split is None:
+                nodeOffset.append(start)
+                nodeCount.append(end - start)
+                continue
+
+            axis, position = split
+            left = centroids[indices, axis] < position
+            nLeft = int(left.sum())
+            order[start:end] = np.concatenate((indices[left], indices[~left]))
+
+            nodeOffset.append(-1)
+            nodeCount.append(0)
+            stack.append((start + nLeft, end, nodeIndex))
+            stack.append((start, start + nLeft, -1))
+
+        self.nodeMin = np.array(nodeMin, dtype=np.float32).reshape(-1, 3)
+        self.nodeMax = np.array(nodeMax, dtype=np.float32).reshape(-1, 3)
+        self.nodeOffset = np.array(nodeOffset, dtype=np.int32)
+        self.nodeCount = np.array(nodeCount, dtype=np.int32)
+        self.triIndices = order
+
+    def findSplit(self, indices, centroids, triMin, triMax, bmin, bmax):
+        # Returns (axis, position) for the cheapest binned SAH split, None if a leaf is cheaper
+        count = len(indices)
+        if count <= 1:
+            return None
+
+        c = centroids[indices]
+        cmin = c.min(axis=0)
+        cmax = c.max(axis=0)
+        extent = cmax - cmin
+
+        parentArea = surfaceArea(bmin, bmax)
+        leafCost = count * self.INTERSECTION_COST
+        bestCost = np.inf
+        best = None
+
+        for axis in range(3):
+            if extent[axis] <= 0:
+                continue
+
+            bins = ((c[:, axis] - cmin[axis]) * (self.SAH_BINS / extent[axis])).astype(np.int32)
+            np.clip(bins, 0, self.SAH_BINS - 1, out=bins)
+
+            binCount = np.bincount(bins, minlength=self.SAH_BINS)
+            binMin = np.full((self.SAH_BINS, 3), np.inf, dtype=np.float32)
+            binMax = np.full((self.SAH_BINS, 3), -np.inf, dtype=np.float32)
+            np.minimum.at(binMin, bins, triMin[indices])
+            np.maximum.at(binMax, bins, triMax[indices])
+
+            # sweep: split k puts bins [0, k] on the left
+            leftCount = np.cumsum(binCount)[:-1]
+            rightCount = count - leftCount
+            leftMin = np.minimum.accumulate(binMin, axis=0)[:-1]
+            leftMax = np.maximum.accumulate(binMax, axis=0)[:-1]
+            rightMin = np.minimum.accumulate(binMin[::-1], axis=0)[::-1][1:]
+            rightMax = np.maximum.accumulate(binMax[::-1], axis=0)[::-1][1:]
+
+            valid = (leftCount > 0) & (rightCount > 0)
+            if not valid.any():
+                continue
+
+            with np.errstate(invalid="ignore"):
+                cost = self.TRAVERSAL_COST + self.INTERSECTION_COST * (
+                        leftCount * surfaceArea(leftMin, leftMax) +
+                        rightCount * surfaceArea(rightMin, rightMax)) / max(parentArea, EPSILON)
+            cost = np.where(valid, cost, np.inf)
+
+            k = int(np.argmin(cost))
+            if cost[k] < bestCost:
+                bestCost = cost[k]
+                best = (axis, cmin[axis] + (k + 1) * extent[axis] / self.SAH_BINS)
+
+        if best is None:
+            # every centroid coincides, nothing left to split on
+            return None
+        if bestCost >= leafCost and count <= self.MAX_LEAF_SIZE:
+            return None
+        return best
+
+    def intersectTriangles(self, rayO, rayD, tris):
+        # Moller-Trumbore over matching arrays of rays and triangles
+        edge1 = self.edge1[tris]
+        edge2 = self.edge2[tris]
+
+        p = np.cross(rayD, edge2)
+        det = np.einsum("ij,ij->i", edge1, p)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            invDet = 1.0 / det
+            s = rayO - self.v0[tris]
+            u = np.einsum("ij,ij->i", s, p) * invDet
+            q = np.cross(s, edge1)
+            v = np.einsum("ij,ij->i", rayD, q) * invDet
+            t = np.einsum("ij,ij->i", edge2, q) * invDet
+
+        hit = (np.abs(det) > EPSILON) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > EPSILON)
+        return hit, t, u, v
+
+    def traverse(self, rayO, rayD, tHit, triHit, u, v, anyHit):
+        # Breadth-first traversal of every ray at once over a flat list of (ray, node) pairs
+        with np.errstate(divide="ignore"):
+            invD = 1.0 / rayD
+
+        rays = np.arange(len(rayO), dtype=np.int32)
+        nodes = np.zeros(len(rayO), dtype=np.int32)
+
+        while len(rays):
+            o = rayO[rays]
+            with np.errstate(invalid="ignore"):
+                t0 = (self.nodeMin[nodes] - o) * invD[rays]
+                t1 = (self.nodeMax[nodes] - o) * invD[rays]
+            # fmin/fmax skip the NaNs from rays lying exactly on a slab
+            tNear = np.fmax.reduce(np.fmin(t0, t1), axis=1)
+            tFar = np.fmin.reduce(np.fmax(t0, t1), axis=1)
+
+            keep = (tNear <= tFar) & (tFar >= 0.0) & (tNear < tHit[rays])
+            rays = rays[keep]
+            nodes = nodes[keep]
+
+            leaf = self.nodeCount[nodes] > 0
+            leafRays = rays[leaf]
+            leafNodes = nodes[leaf]
+            if len(leafRays):
+                # expand each (ray, leaf) into one (ray, triangle) pair per triangle in the leaf
+                counts = self.nodeCount[leafNodes]
+                pairRays = np.repeat(leafRays, counts)
+                firsts = np.cumsum(counts) - counts
+                pairTris = (np.repeat(self.nodeOffset[leafNodes], counts) +
+                            np.arange(len(pairRays), dtype=np.int32) - np.repeat(firsts, counts))
+
+                hit, t, hu, hv = self.intersectTriangles(rayO[pairRays], rayD[pairRays], pairTris)
+                hit &= t < tHit[pairRays]
+
+                pairRays = pairRays[hit]
+                pairTris = pairTris[hit]
+                t = t[hit]
+                np.minimum.at(tHit, pairRays, t)
+
+                closest = t == tHit[pairRays]
+                triHit[pairRays[closest]] = pairTris[closest]
+                u[pairRays[closest]] = hu[hit][closest]
+                v[pairRays[closest]] = hv[hit][closest]
+
+            interior = ~leaf
+            innerRays = rays[interior]
+            innerNodes = nodes[interior]
+            rays = np.concatenate((innerRays, innerRays))
+            nodes = np.concatenate((innerNodes + 1, self.nodeOffset[innerNodes]))
+
+            if anyHit:
+                pending = triHit[rays] < 0
+                rays = rays[pending]
+                nodes = nodes[pending]
+
+    def query(self, rayO, rayD, tMax, anyHit):
+        rayO = np.asarray(rayO, dtype=np.float32).reshape(-1, 3)
+        rayD = np.broadcast_to(np.asarray(rayD, dtype=np.float32), rayO.shape)
+        n = len(rayO)
+
+        tHit = np.empty(n, dtype=np.float32)
+        tHit[:] = tMax
+        triHit = np.full(n, -1, dtype=np.int32)
+        u = np.zeros(n, dtype=np.float32)
+        v = np.zeros(n, dtype=np.float32)
+
+        for start in range(0, n, self.BATCH_SIZE):
+            batch = slice(start, start + self.BATCH_SIZE)
+            # the slices are views, so traverse() writes its results straight into the full arrays
+            self.traverse(rayO[batch], rayD[batch], tHit[batch], triHit[batch], u[batch], v[batch], anyHit)
+
+        return tHit, triHit, u, v
+
+    def closestHit(self, rayO, rayD, tMax=np.inf):
+        # Returns (t, triangle, u, v) per ray. Triangles index the original mesh order, -1 and t = tMax on a miss
+        tHit, triHit, u, v = self.query(rayO, rayD, tMax, False)
+        hit = triHit >= 0
+        triHit[hit] = self.triIndices[triHit[hit]]
+        return tHit, triHit, u, v
+
+    def anyHit(self, rayO, rayD, tMax=np.inf):
+        # Returns a bool per ray, True if anything is hit before tMax. Used for shadow rays
+        _, triHit, _, _ = self.query(rayO, rayD, tMax, True)
+        return triHit >= 0
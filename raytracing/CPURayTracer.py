@@ -0,0 +1,257 @@
+import os
+import time
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+from raytracing.Scene import Scene, MATERIAL_UNLIT
+
+# Orthographic view extents, mirrored from BasicComputeShader.txt
+MAX_X = 5.0
+MAX_Y = 5.0
+
+RAY_DIRECTION = np.array([0.0, 0.0, -1.0], dtype=np.float32)
+
+
+def dot(a, b):
+    return np.einsum("ij,ij->i", a, b)
+
+
+def normalize(v):
+    return v / np.sqrt(dot(v, v))[:, None]
+
+
+def reflect(incident, normal):
+    # same as GLSL reflect()
+    return incident - 2.0 * dot(normal, incident)[:, None] * normal
+
+
+def sphereIntersect(rayO, rayD, sphere):
+    # Same as sphereIntersect() in the compute shader: nearest distance in front of each ray, inf on a miss
+    radius = sphere["radius"][:3]
+    omc = (rayO - sphere["centre"][:3]) / radius
+    d = rayD / radius
+    a = dot(d, d)
+    b = dot(d, omc)
+    c = dot(omc, omc) - 1.0
+    bsqmc = b * b - a * c
+
+    t = np.full(len(rayO), np.inf, dtype=np.float32)
+    hit = bsqmc >= 0.0
+    root = np.sqrt(bsqmc[hit])
+    t0 = (-b[hit] - root) / a[hit]
+    t1 = (-b[hit] + root) / a[hit]
+    # t1 when the ray starts inside the sphere
+    t[hit] = np.where(t0 > 0.0, t0, np.where(t1 > 0.0, t1, np.inf))
+    return t
+
+
+def halton(index, base):
+    # Low discrepancy sequence in [0, 1), used for sub-pixel jitter
+    result = 0.0
+    f = 1.0
+    while index > 0:
+        f /= base
+        result += f * (index % base)
+        index //= base
+    return result
+
+
+def sampleJitter(sampleIndex):
+    # Sub-pixel offset for a progressive sample, the first sample is the pixel corner like a plain frame
+    if sampleIndex == 0:
+        return 0.0, 0.0
+    return halton(sampleIndex, 2) - 0.5, halton(sampleIndex, 3) - 0.5
+
+
+def primaryRays(x0, y0, x1, y1, width, height, jitter=(0.0, 0.0), cameraPos=(0.0, 0.0, 0.0)):
+    # One orthographic ray per pixel in [x0, x1) x [y0, y1), row-major with y as the outer axis
+    px = np.arange(x0, x1, dtype=np.float32) + np.float32(jitter[0])
+    py = np.arange(y0, y1, dtype=np.float32) + np.float32(jitter[1])
+    x = -((px * 2 - width) / width)
+    y = (py * 2 - height) / height
+
+    rayO = np.zeros((len(py), len(px), 3), dtype=np.float32)
+    rayO[:, :, 0] = x[None, :] * MAX_X
+    rayO[:, :, 1] = y[:, None] * MAX_Y
+    rayO = rayO.reshape(-1, 3) + np.asarray(cameraPos, dtype=np.float32)
+    rayD = np.broadcast_to(RAY_DIRECTION, rayO.shape)
+    return rayO, rayD
+
+
+def shade(rayO, rayD, t, sphere, scene):
+    # Phong lighting for rays that hit one sphere, mirrors shade() in the compute shader
+    if int(sphere["radius"][3]) == MATERIAL_UNLIT:
+        return np.broadcast_to(sphere["colour"], (len(rayO), 4))
+
+    pHit = rayO + t[:, None] * rayD
+    radius = sphere["radius"][:3]
+    normal = normalize((pHit - sphere["centre"][:3]) / (radius * radius))
+    viewD = normalize(scene.cameraPos - pHit)
+
+    lighting = np.full((len(rayO), 3), scene.ambientLight, dtype=np.float32)
+    for light in scene.lights:
+        lightColour = light["colour"][:3]
+        lightD = normalize(light["position"][:3] - pHit)
+
+        diff = np.maximum(dot(normal, lightD), 0.0)
+        diffuse = diff[:, None] * lightColour
+
+        reflectDir = reflect(-lightD, normal)
+        spec = np.maximum(dot(viewD, reflectDir), 0.0) ** sphere["material"][1]
+        specular = sphere["material"][0] * spec[:, None] * lightColour
+
+        lighting += diffuse + specular
+
+    pixels = np.ones((len(rayO), 4), dtype=np.float32)
+    pixels[:, :3] = sphere["colour"][:3] * lighting
+    return pixels
+
+
+def traceRays(rayO, rayD, scene):
+    # Shades a batch of rays against the scene, returns an (n, 4) RGBA32F array
+    pixels = np.zeros((len(rayO), 4), dtype=np.float32)
+    pixels[:, 3] = 1.0
+
+    # Closest intersection over every sphere
+    tClosest = np.full(len(rayO), np.inf, dtype=np.float32)
+    closest = np.full(len(rayO), -1, dtype=np.int32)
+    for i, sphere in enumerate(scene.spheres):
+        t = sphereIntersect(rayO, rayD, sphere)
+        nearer = t < tClosest
+        tClosest[nearer] = t[nearer]
+        closest[nearer] = i
+
+    for i, sphere in enumerate(scene.spheres):
+        indices = np.flatnonzero(closest == i)
+        if len(indices):
+            pixels[indices] = shade(rayO[indices], rayD[indices], tClosest[indices], sphere, scene)
+    return pixels
+
+
+class CPURayTracer:
+    # Traces the same scene as BasicComputeShader.txt with NumPy, no GL context required.
+    # framebuffer uses the same layout as texOutput: (texHeight, texWidth, RGBA32F), row 0 at the bottom
+
+    def __init__(self, texWidth, texHeight, framebuffer=None, scene=None):
+        self.texWidth = texWidth
+        self.texHeight = texHeight
+        self.scene = Scene.default() if scene is None else scene
+        if framebuffer is None:
+            framebuffer = np.zeros((texHeight, texWidth, 4), dtype=np.float32)
+        self.framebuffer = framebuffer
+
+    def traceTile(self, x0, y0, x1, y1, jitter=(0.0, 0.0), sampleCount=0, framebuffer=None):
+        # sampleCount > 0 folds this sample into the running average of the previous sampleCount samples
+        if framebuffer is None:
+            framebuffer = self.framebuffer
+
+        rayO, rayD = primaryRays(x0, y0, x1, y1, self.texWidth, self.texHeight, jitter, self.scene.cameraPos)
+        pixels = traceRays(rayO, rayD, self.scene).reshape(y1 - y0, x1 - x0, 4)
+        if sampleCount == 0:
+            framebuffer[y0:y1, x0:x1] = pixels
+        else:
+            region = framebuffer[y0:y1, x0:x1]
+            region += (pixels - region) / np.float32(sampleCount + 1)
+
+    def render(self, jitter=(0.0, 0.0), sampleCount=0):
+        self.traceTile(0, 0, self.texWidth, self.texHeight, jitter, sampleCount)
+        return self.framebuffer
+
+    def close(self):
+        pass
+
+
+# Per-process state for the pool workers, set up once by initWorker
+workerShm = None
+workerTracer = None
+
+
+def initWorker(shmName, texWidth, texHeight):
+    global workerShm, workerTracer
+    workerShm = shared_memory.SharedMemory(name=shmName)
+    framebuffer = np.ndarray((texHeight, texWidth, 4), dtype=np.float32, buffer=workerShm.buf)
+    workerTracer = CPURayTracer(texWidth, texHeight, framebuffer)
+
+
+def traceTileWorker(task):
+    tile, jitter, sampleCount, scene = task
+    workerTracer.scene = scene
+    workerTracer.traceTile(*tile, jitter, sampleCount)
+
+
+class ParallelCPURayTracer(CPURayTracer):
+    # Splits the frame into tiles and traces them on a process pool. Every worker writes straight into one
+    # shared-memory framebuffer, so only the tile rectangles and the (small) packed scene are sent between processes
+
+    def __init__(self, texWidth, texHeight, workers=None, tileSize=64, scene=None):
+        self.workers = workers or os.cpu_count()
+        self.tileSize = tileSize
+
+        nbytes = texWidth * texHeight * 4 * np.dtype(np.float32).itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        framebuffer = np.ndarray((texHeight, texWidth, 4), dtype=np.float32, buffer=self.shm.buf)
+        framebuffer[:] = 0
+        super().__init__(texWidth, texHeight, framebuffer, scene)
+
+        self.tiles = [(x0, y0, min(x0 + tileSize, texWidth), min(y0 + tileSize, texHeight))
+                      for y0 in range(0, texHeight, tileSize)
+                      for x0 in range(0, texWidth, tileSize)]
+
+        self.pool = Pool(self.workers, initializer=initWorker, initargs=(self.shm.name, texWidth, texHeight))
+
+    def render(self, jitter=(0.0, 0.0), sampleCount=0):
+        tasks = [(tile, jitter, sampleCount, self.scene) for tile in self.tiles]
+        self.pool.map(traceTileWorker, tasks, chunksize=1)
+        return self.framebuffer
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+        # the framebuffer view has to go before the shared memory can be released
+        self.framebuffer = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def createCPURayTracer(texWidth, texHeight, workers=None, tileSize=64, scene=None):
+    if workers == 1:
+        return CPURayTracer(texWidth, texHeight, scene=scene)
+    return ParallelCPURayTracer(texWidth, texHeight, workers, tileSize, scene)
+
+
+def scalingReport(texWidth=1024, texHeight=1024, tileSize=64, frames=5, maxWorkers=None):
+    # Times the tile renderer at 1, 2, 4, ... N workers, returns (workers, seconds per frame, Mrays/s) rows
+    maxWorkers = maxWorkers or os.cpu_count()
+    counts = []
+    n = 1
+    while n < maxWorkers:
+        counts.append(n)
+        n *= 2
+    counts.append(maxWorkers)
+
+    report = []
+    for workers in counts:
+        tracer = createCPURayTracer(texWidth, texHeight, workers, tileSize)
+        tracer.render()  # warm up
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            tracer.render()
+        frameTime = (time.perf_counter() - start) / frames
+        tracer.close()
+
+        mrays = texWidth * texHeight / frameTime / 1e6
+        report.append((workers, frameTime, mrays))
+        print(f"{workers:>3} workers: {frameTime * 1000:8.2f} ms/frame {mrays:8.2f} Mrays/s "
+              f"speedup {report[0][1] / frameTime:5.2f}x")
+
+    return report
+
+
+if __name__ == "__main__":
+    scalingReport()
@@ -1,28 +1,75 @@
 # Tutorial from: https://antongerdelan.net/opengl/compute.html
 
+import os
+import time
+
 import numpy as np
 from OpenGL.GL import *
+from core.GPUTimer import GPUTimer
 from core.Loader import Shader, RawModel, TextureAtlas
+from core.Profiler import profiler
+from core.Resources import resources
+from raytracing.CPURayTracer import createCPURayTracer, sampleJitter
+from raytracing.Scene import Scene, SceneBuffer, SPHERE_BINDING, LIGHT_BINDING
+
+
 class RayTracer:
-    def __init__(self, texWidth, texHeight):
+    cpuTracer = None
+    texOutput = None
+
+    def __init__(self, texWidth, texHeight, cpu=False, headless=False, workers=None, tileSize=64,
+                 progressive=False, maxSamples=256, workgroupSize=(8, 8), scene=None):
         self.texWidth = texWidth
         self.texHeight = texHeight
 
-        # Creating a test texture
-        # self.testTex = TextureAtlas.importFile("res/textures/example.jpg", 1)
+        # defaults to the sphere, glass ball and light the shader used to hard-code
+        self.scene = Scene.default() if scene is None else scene
+        self.sceneVersion = self.scene.version
+
+        # headless rendering never touches GL, so it always runs on the CPU
+        # workers=None uses every core, workers=1 traces on this process only
+        self.headless = headless
+        self.cpu = cpu or headless
+        self.workers = workers
+        self.tileSize = tileSize
+        if self.cpu:
+            self.cpuTracer = createCPURayTracer(texWidth, texHeight, workers, tileSize, self.scene)
+
+        # Progressive mode averages one jittered sample per frame into texOutput until maxSamples is reached,
+        # starting over whenever the camera, scene or resolution changes
+        self.progressive = progressive
+        self.maxSamples = maxSamples
+        self.sampleCount = 0
+
+        # local size of the compute shader, each workgroup shades workgroupSize[0] x workgroupSize[1] pixels
+        self.workgroupSize = tuple(workgroupSize)
 
+        if not headless:
+            self.initGL()
+
+    def createOutputTexture(self):
         # Generating a texture the compute shader can output to
-        self.texOutput = glGenTextures(1)
+        if self.texOutput is not None:
+            resources.release(self.outputTexture)
+        self.outputTexture = resources.register("texture", glGenTextures(1), self.texWidth * self.texHeight * 16,
+                                                "ray traced output")
+        self.texOutput = self.outputTexture.ID
         glActiveTexture(GL_TEXTURE0)
         glBindTexture(GL_TEXTURE_2D, self.texOutput)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, texWidth, texHeight, 0, GL_RGBA, GL_FLOAT, None)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, self.texWidth, self.texHeight, 0, GL_RGBA, GL_FLOAT, None)
+
+        # To write to a texture we use image storing, read access is needed for accumulation
+        glBindImageTexture(0, self.texOutput, 0, GL_FALSE, 0, GL_READ_WRITE, GL_RGBA32F)
+
+    def initGL(self):
+        # Creating a test texture
+        # self.testTex = TextureAtlas.importFile("res/textures/example.jpg", 1)
 
-        # To write to a texture we use image storing
-        glBindImageTexture(0, self.texOutput, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_RGBA32F)
+        self.createOutputTexture()
 
         # Getting Max Work Groups
         # workGroupCounts = [None, None, None]
@@ -30,29 +77,19 @@ class RayTracer:
         # workGroupCounts[1] = glGetIntegeri_v(GL_MAX_COMPUTE_WORK_GROUP_COUNT, 1)
         # workGroupCounts[2] = glGetIntegeri_v(GL_MAX_COMPUTE_WORK_GROUP_COUNT, 2)
 
-        with open("raytracing\\BasicComputeShader.txt") as file:
-            shaderSource = file.read()
+        self.rayProgram = None
+        self.compileRayProgram()
 
-        rayShader = glCreateShader(GL_COMPUTE_SHADER)
-        glShaderSource(rayShader, shaderSource)
-        glCompileShader(rayShader)
-
-        if glGetShaderiv(rayShader, GL_COMPILE_STATUS) != GL_TRUE:
-            info = glGetShaderInfoLog(rayShader)
-            raise RuntimeError('Shader compilation failed: %s' % info)
-
-        self.rayProgram = glCreateProgram()
-        glAttachShader(self.rayProgram, rayShader)
-        glLinkProgram(self.rayProgram)
+        # scene records live in shader storage buffers, uploaded by uploadScene()
+        self.sphereBuffer = SceneBuffer(SPHERE_BINDING)
+        self.lightBuffer = SceneBuffer(LIGHT_BINDING)
 
-        if glGetProgramiv(self.rayProgram, GL_LINK_STATUS) != GL_TRUE:
-            info = glGetProgramInfoLog(self.rayProgram)
-            glDeleteProgram(self.rayProgram)
-            glDeleteShader(rayShader)
-            raise RuntimeError('Error linking program: %s' % info)
+        # GL_TIME_ELAPSED timing of every dispatch, see getDispatchTime()
+        self.dispatchTimer = GPUTimer()
+        profiler.addGPUTimer("RayTracer.dispatch", self.dispatchTimer)
 
         # Creating the quad to draw using texture from compute shader
-        self.quadShader = Shader("raytracing\\QuadShader.txt")
+        self.quadShader = Shader(os.path.join("raytracing", "QuadShader.txt"))
         vertices = np.array([
             -1, -1,
             -1, 1,
@@ -72,14 +109,183 @@ class RayTracer:
 
         self.quadModel = RawModel.loadPTI(vertices, texCoords, quadIndices)
 
+    def compileRayProgram(self):
+        with open(os.path.join("raytracing", "BasicComputeShader.txt")) as file:
+            shaderSource = file.read()
+
+        # the workgroup size is a compile time constant, define it right after the #version line
+        version, rest = shaderSource.split("\n", 1)
+        shaderSource = "%s\n#define LOCAL_SIZE_X %d\n#define LOCAL_SIZE_Y %d\n%s" % (
+            version, self.workgroupSize[0], self.workgroupSize[1], rest)
+
+        rayShader = glCreateShader(GL_COMPUTE_SHADER)
+        glShaderSource(rayShader, shaderSource)
+        glCompileShader(rayShader)
 
-    def render(self):
-        # Run compute shader
+        if glGetShaderiv(rayShader, GL_COMPILE_STATUS) != GL_TRUE:
+            info = glGetShaderInfoLog(rayShader)
+            glDeleteShader(rayShader)
+            raise RuntimeError('Shader compilation failed: %s' % info)
+
+        programResource = resources.register("program", glCreateProgram(), label="ray tracing")
+        program = programResource.ID
+        glAttachShader(program, rayShader)
+        glLinkProgram(program)
+
+        if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+            info = glGetProgramInfoLog(program)
+            resources.release(programResource)
+            glDeleteShader(rayShader)
+            raise RuntimeError('Error linking program: %s' % info)
+        glDeleteShader(rayShader)
+
+        if self.rayProgram is not None:
+            resources.release(self.rayProgramResource)
+        self.rayProgram = program
+        self.rayProgramResource = programResource
+
+        self.jitterLocation = glGetUniformLocation(self.rayProgram, "jitter")
+        self.sampleCountLocation = glGetUniformLocation(self.rayProgram, "sampleCount")
+        self.sphereCountLocation = glGetUniformLocation(self.rayProgram, "sphereCount")
+        self.lightCountLocation = glGetUniformLocation(self.rayProgram, "lightCount")
+        self.ambientLightLocation = glGetUniformLocation(self.rayProgram, "ambientLight")
+        self.cameraPosLocation = glGetUniformLocation(self.rayProgram, "cameraPos")
+
+    def setWorkgroupSize(self, x, y):
+        if (x, y) == self.workgroupSize:
+            return
+        self.workgroupSize = (x, y)
+        self.resetAccumulation()
+        if not self.headless:
+            self.compileRayProgram()
+
+    def getDispatchCounts(self):
+        # ceiling division, the shader skips the pixels hanging over the edge
+        return (-(-self.texWidth // self.workgroupSize[0]),
+                -(-self.texHeight // self.workgroupSize[1]))
+
+    def getDispatchTime(self):
+        # GPU time of the most recent finished dispatch in milliseconds, None until one has finished
+        if self.cpuTracer is not None:
+            return None
+        return self.dispatchTimer.getLastTime()
+
+    def getAverageDispatchTime(self):
+        if self.cpuTracer is not None:
+            return None
+        return self.dispatchTimer.getAverageTime()
+
+    def benchmarkWorkgroups(self, sizes=((1, 1), (8, 8), (16, 8), (16, 16), (32, 8), (32, 32)), frames=60):
+        # {(x, y): (GPU ms or None, wall clock ms)} per dispatch at each workgroup size
+        original = self.workgroupSize
+        results = {}
+        for size in sizes:
+            self.setWorkgroupSize(*size)
+            # one untimed dispatch first, the first after a recompile (or in a new context) can be far off
+            self.trace()
+            self.drainDispatchTimer()
+            self.dispatchTimer.times.clear()
+            # benchmark dispatches stay out of the profiler's frame records
+            self.dispatchTimer.takeNewTimes()
+            glFinish()
+            start = time.perf_counter()
+            for _ in range(frames):
+                self.sampleCount = 0
+                self.trace()
+            glFinish()
+            wallTime = (time.perf_counter() - start) * 1000 / frames
+            self.drainDispatchTimer()
+            gpuTime = self.dispatchTimer.getAverageTime()
+            results[size] = (gpuTime, wallTime)
+            gpuText = "     n/a" if gpuTime is None else f"{gpuTime:8.3f}"
+            print(f"workgroup {size[0]:>2}x{size[1]:<2}: {gpuText} ms GPU {wallTime:8.3f} ms wall")
+
+        self.setWorkgroupSize(*original)
+        return results
+
+    def drainDispatchTimer(self):
+        # waits for every query in flight, not just the oldest
+        while self.dispatchTimer.pending:
+            self.dispatchTimer.collect(wait=True)
+
+    def resetAccumulation(self):
+        # Call when the scene changes, the next frame starts a fresh average
+        self.sampleCount = 0
+
+    def getSampleCount(self):
+        return self.sampleCount
+
+    def resize(self, texWidth, texHeight):
+        if (texWidth, texHeight) == (self.texWidth, self.texHeight):
+            return
+        self.texWidth = texWidth
+        self.texHeight = texHeight
+        self.resetAccumulation()
+
+        if self.cpuTracer is not None:
+            self.cpuTracer.close()
+            self.cpuTracer = createCPURayTracer(texWidth, texHeight, self.workers, self.tileSize, self.scene)
+        if not self.headless:
+            self.createOutputTexture()
+
+    def updateScene(self, entities, lights):
+        # Repacks entities and lights, only records that actually changed are uploaded on the next trace
+        self.scene.update(entities, lights)
+
+    def uploadScene(self):
         glUseProgram(self.rayProgram)
-        glDispatchCompute(self.texWidth, self.texHeight, 1)
+        self.sphereBuffer.upload(self.scene.spheres, self.scene.takeDirty("spheres"))
+        self.lightBuffer.upload(self.scene.lights, self.scene.takeDirty("lights"))
+        glUniform1i(self.sphereCountLocation, len(self.scene.spheres))
+        glUniform1i(self.lightCountLocation, len(self.scene.lights))
+        glUniform1f(self.ambientLightLocation, self.scene.ambientLight)
+        glUniform3f(self.cameraPosLocation, *self.scene.cameraPos)
+
+    def checkScene(self):
+        # Any scene or camera change restarts progressive accumulation
+        if self.scene.version != self.sceneVersion:
+            self.sceneVersion = self.scene.version
+            self.resetAccumulation()
 
-        # Make sure writing to image has finished before read
-        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+    def trace(self):
+        # Traces one frame (or one more progressive sample), returns False if the image has already converged
+        self.checkScene()
+        if self.progressive:
+            if self.sampleCount >= self.maxSamples:
+                return False
+            jitter = sampleJitter(self.sampleCount)
+            sampleCount = self.sampleCount
+            self.sampleCount += 1
+        else:
+            jitter = (0.0, 0.0)
+            sampleCount = 0
+
+        if self.cpuTracer is not None:
+            frame = self.cpuTracer.render(jitter, sampleCount)
+            if not self.headless:
+                glBindTexture(GL_TEXTURE_2D, self.texOutput)
+                glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self.texWidth, self.texHeight, GL_RGBA, GL_FLOAT, frame)
+        else:
+            # Run compute shader
+            self.uploadScene()
+            glUniform2f(self.jitterLocation, *jitter)
+            glUniform1i(self.sampleCountLocation, sampleCount)
+            self.dispatchTimer.begin()
+            glDispatchCompute(*self.getDispatchCounts(), 1)
+
+            # Make sure writing to image has finished before read
+            glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+            self.dispatchTimer.end()
+        return True
+
+    @profiler.profiled("RayTracer.render")
+    def render(self, camera=None):
+        if camera is not None:
+            self.scene.setCamera(camera.position)
+        self.trace()
+
+        if self.headless:
+            return self.cpuTracer.framebuffer
 
         # Normal Rendering
         self.quadShader.bind()
@@ -91,7 +297,16 @@ class RayTracer:
         glEnableVertexAttribArray(1)
         glDrawElements(GL_TRIANGLES, self.quadModel.getVertexCount(), GL_UNSIGNED_BYTE, None)
 
-
-
-
-
+    def cleanUp(self):
+        if self.cpuTracer is not None:
+            self.cpuTracer.close()
+        if self.texOutput is not None:
+            profiler.removeGPUTimer("RayTracer.dispatch")
+            self.dispatchTimer.delete()
+            self.sphereBuffer.delete()
+            self.lightBuffer.delete()
+            self.quadModel.release()
+            self.quadShader.release()
+            resources.release(self.rayProgramResource)
+            resources.release(self.outputTexture)
+            self.texOutput = None
@@ -0,0 +1,177 @@
+import numpy as np
+from OpenGL.GL import *
+
+from core.Resources import resources
+
+# Packed records, laid out to match the std430 structs in BasicComputeShader.txt (every member is a vec4)
+SPHERE_DTYPE = np.dtype([
+    ("centre", np.float32, 4),    # xyz, w unused
+    ("radius", np.float32, 4),    # xyz radii, so ellipsoids trace too. w is the material kind
+    ("colour", np.float32, 4),    # rgba
+    ("material", np.float32, 4),  # x specular strength, y shininess
+])
+
+LIGHT_DTYPE = np.dtype([
+    ("position", np.float32, 4),
+    ("colour", np.float32, 4),
+])
+
+# Material kinds, stored in radius.w
+MATERIAL_LIT = 0
+MATERIAL_UNLIT = 1
+
+# Shader storage buffer binding points
+SPHERE_BINDING = 1
+LIGHT_BINDING = 2
+
+
+def packSpheres(entities):
+    # Every entity with a radius (i.e. Ellipsoid) is traced as an ellipsoid, the rest are skipped
+    traced = [entity for entity in entities if hasattr(entity, "radius")]
+    spheres = np.zeros(len(traced), dtype=SPHERE_DTYPE)
+    for i, entity in enumerate(traced):
+        spheres["centre"][i, :3] = entity.position
+        spheres["radius"][i, :3] = entity.radius
+        spheres["radius"][i, 3] = MATERIAL_LIT if getattr(entity, "lit", True) else MATERIAL_UNLIT
+        spheres["colour"][i] = entity.colour
+        spheres["material"][i, 0] = getattr(entity, "specular", 0.0)
+        spheres["material"][i, 1] = getattr(entity, "shininess", 1.0)
+    return spheres
+
+
+def packLights(lights):
+    packed = np.zeros(len(lights), dtype=LIGHT_DTYPE)
+    for i, light in enumerate(lights):
+        packed["position"][i, :3] = light.position
+        packed["colour"][i, :3] = light.colour
+    return packed
+
+
+def changedRanges(old, new):
+    # [start, end) runs of records that differ between two packed arrays of the same length
+    if len(old) == 0:
+        return []
+    itemSize = old.dtype.itemsize
+    changed = (old.view(np.uint8).reshape(len(old), itemSize)
+               != new.view(np.uint8).reshape(len(new), itemSize)).any(axis=1)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], changed.view(np.int8), [0]))))
+    return [(int(start), int(end)) for start, end in zip(edges[0::2], edges[1::2])]
+
+
+class Scene:
+    # Packed sphere and light records for the ray tracer. Edits are diffed so only changed records are
+    # re-uploaded, version goes up on every change
+
+    def __init__(self, spheres=None, lights=None, ambientLight=0.1, cameraPos=(0.0, 0.0, 0.0)):
+        self.spheres = np.zeros(0, dtype=SPHERE_DTYPE) if spheres is None else spheres
+        self.lights = np.zeros(0, dtype=LIGHT_DTYPE) if lights is None else lights
+        self.ambientLight = ambientLight
+        self.cameraPos = np.array(cameraPos, dtype=np.float32)
+        self.version = 0
+
+        # None means the whole array has to be (re)allocated, otherwise a list of record ranges
+        self.dirty = {"spheres": None, "lights": None}
+
+    @classmethod
+    def fromEntities(cls, entities, lights, ambientLight=0.1):
+        return cls(packSpheres(entities), packLights(lights), ambientLight)
+
+    @classmethod
+    def default(cls):
+        # The scene BasicComputeShader.txt used to hard-code
+        spheres = np.zeros(2, dtype=SPHERE_DTYPE)
+        spheres[0] = ((0.0, 0.0, -10.0, 0.0), (1.0, 1.0, 1.0, MATERIAL_LIT), (0.4, 0.4, 1.0, 1.0), (0.5, 32.0, 0.0, 0.0))
+        # glass ball
+        spheres[1] = ((0.0, 0.0, -5.0, 0.0), (0.1, 0.1, 0.1, MATERIAL_UNLIT), (1.0, 1.0, 1.0, 1.0), (0.0, 1.0, 0.0, 0.0))
+
+        lights = np.zeros(1, dtype=LIGHT_DTYPE)
+        lights[0] = ((5.0, 15.0, 0.0, 0.0), (1.0, 1.0, 1.0, 0.0))
+        return cls(spheres, lights, 0.1)
+
+    def updateArray(self, name, packed):
+        old = getattr(self, name)
+        if len(old) != len(packed):
+            self.dirty[name] = None
+        else:
+            ranges = changedRanges(old, packed)
+            if not ranges:
+                return False
+            if self.dirty[name] is not None:
+                self.dirty[name].extend(ranges)
+        setattr(self, name, packed)
+        return True
+
+    def update(self, entities, lights):
+        # Repacks the scene from entities and RenderEngine.Light objects
+        changed = self.updateArray("spheres", packSpheres(entities))
+        changed = self.updateArray("lights", packLights(lights)) or changed
+        if changed:
+            self.version += 1
+        return changed
+
+    def setCamera(self, position):
+        position = np.array(position, dtype=np.float32)
+        if not np.array_equal(position, self.cameraPos):
+            self.cameraPos = position
+            self.version += 1
+
+    def takeDirty(self, name):
+        # Returns the pending ranges for one array and marks it clean
+        ranges = self.dirty[name]
+        self.dirty[name] = []
+        return ranges
+
+
+class SceneBuffer:
+    # One shader storage buffer holding a packed record array. Grows by doubling and otherwise
+    # only re-uploads the byte ranges of records that changed
+
+    def __init__(self, binding):
+        self.binding = binding
+        self.buffer = resources.register("buffer", glGenBuffers(1), label="scene records")
+        self.ID = self.buffer.ID
+        self.capacity = 0
+
+    def upload(self, records, ranges):
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.ID)
+        if records.nbytes > self.capacity:
+            self.capacity = max(records.nbytes, 2 * self.capacity, records.dtype.itemsize)
+            glBufferData(GL_SHADER_STORAGE_BUFFER, self.capacity, None, GL_DYNAMIC_DRAW)
+            resources.resize(self.buffer, self.capacity)
+            ranges = None
+        if ranges is None:
+            ranges = [(0, len(records))]
+
+        itemSize = records.dtype.itemsize
+        for start, end in ranges:
+            if end > start:
+                # every field is float32, so the records can go through PyOpenGL as a flat float array
+                glBufferSubData(GL_SHADER_STORAGE_BUFFER, start * itemSize, (end - start) * itemSize,
+                                records[start:end].view(np.float32))
+
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, self.binding, self.ID)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+    def delete(self):
+        resources.release(self.buffer)
+
+
+if __name__ == "__main__":
+    # python -m raytracing.Scene, checks the record diffing
+    records = np.zeros(5, dtype=SPHERE_DTYPE)
+    assert changedRanges(np.zeros(0, dtype=SPHERE_DTYPE), np.zeros(0, dtype=SPHERE_DTYPE)) == []
+    assert changedRanges(records, records.copy()) == []
+    edited = records.copy()
+    edited["centre"][1, 0] = 1
+    edited["colour"][3:5] = 1
+    assert changedRanges(records, edited) == [(1, 2), (3, 5)]
+
+    class Light:
+        position = (0, 5, 0)
+        colour = (1, 1, 1)
+
+    scene = Scene.fromEntities([], [Light()])
+    assert not scene.update([], [Light()])
+    assert scene.update([], [])
+    assert not scene.update([], [])
+    print("Scene checks passed")